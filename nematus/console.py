@@ -27,10 +27,34 @@ class ConsoleInterface(object):
         self._parser.add_argument('--models', '-m', type=str, nargs = '+', required=True, metavar="MODEL",
                                   help="model to use. Provide multiple models (with same vocabulary) for ensemble decoding")
         self._parser.add_argument('-p', type=int, default=1,
-                                  help="Number of processes (default: %(default)s))")
+                                  help="Number of processes; 0 translates in the calling process, without worker queues (default: %(default)s))")
         self._parser.add_argument('--device-list', '-dl', type=str, nargs='*', required=False, metavar="DEVICE",
                                   help="User specified device list for multi-thread decoding (default: [])")
         self._parser.add_argument('-v', action="store_true", help="verbose mode.")
+        self._parser.add_argument('--shortlist', type=str, default=None, metavar='PATH',
+                                  help="Lexical table for vocabulary selection, built with lexical_shortlist.py (default: full vocabulary)")
+        self._parser.add_argument('--shortlist-frequent', type=int, default=100, metavar='INT',
+                                  help="Number of most frequent target words always in the shortlist (default: %(default)s)")
+        self._parser.add_argument('--shortlist-translations', type=int, default=100, metavar='INT',
+                                  help="Number of translations per source word added to the shortlist (default: %(default)s)")
+        self._parser.add_argument('--cache-size', type=int, default=0, metavar='INT',
+                                  help="Number of decoding results to cache, so that repeated segments are not translated again (default: no cache)")
+        self._parser.add_argument('--cache-file', type=str, default=None, metavar='PATH',
+                                  help="Keep the cache in this on-disk store, so that it survives restarts (default: memory only)")
+        self._parser.add_argument('--greedy', action="store_true",
+                                  help="Also compile a greedy decoder that translates a whole batch in one call; used for requests with beam size 1 (single models without --shortlist only)")
+        self._parser.add_argument('--function-cache', type=str, default=None, metavar='DIR',
+                                  help="Directory in which compiled functions are cached across runs, see precompile.py (default: no cache)")
+        self._parser.add_argument('--no-shared-params', dest='shared_params', action="store_false",
+                                  help="Let each worker process load its own copy of the model parameters, instead of sharing one copy in memory")
+        self._parser.add_argument('--fused-ensemble', action="store_true",
+                                  help="Compile all models of an ensemble into one f_init and one f_next, which return the combined log-probabilities (word probabilities are then geometric means)")
+        self._parser.add_argument('--document-context', action="store_true",
+                                  help="Multi-source models whose auxiliary input is the previous sentence of the main input: encode each input on its own and reuse the contexts of the sentences of the current documents")
+        self._parser.add_argument('--max-retries', type=int, default=2, metavar='INT',
+                                  help="Number of times a segment that crashes a worker on its own is sent again before it is given up on (empty translation); crashed workers are restarted, unless one crashes more than this many times in a row without decoding a batch, e.g. while loading the models (default: %(default)s)")
+        self._parser.add_argument('--longest-first', action="store_true",
+                                  help="Send the batches of each chunk to the workers in order of decreasing estimated cost (source length x beam size x number of models) instead of increasing length")
 
     @abstractmethod
     def _add_arguments(self):
@@ -80,6 +104,18 @@ class ConsoleInterfaceDefault(ConsoleInterface):
                                   help="Write n-best list (of size k)")
         self._parser.add_argument('--suppress-unk', action="store_true",
                                   help="Suppress hypotheses containing UNK.")
+        self._parser.add_argument('--max-length', type=int, default=200, metavar='INT',
+                                  help="Maximum length of a translation (default: %(default)s)")
+        self._parser.add_argument('--max-length-ratio', type=float, default=None, metavar='FLOAT',
+                                  help="Maximum length of a translation as a multiple of the source length (default: no limit)")
+        self._parser.add_argument('--early-stopping', action="store_true",
+                                  help="Stop the search for a sentence once no hypothesis can beat the best finished one (n-best lists may be shorter)")
+        self._parser.add_argument('--prune-relative', type=float, default=None, metavar='FLOAT',
+                                  help="Prune hypotheses whose probability is below this fraction of the best one's in the beam (default: no pruning)")
+        self._parser.add_argument('--prune-absolute', type=float, default=None, metavar='FLOAT',
+                                  help="Prune hypotheses whose cost (negative log probability) exceeds the best one's in the beam by more than this (default: no pruning)")
+        self._parser.add_argument('--max-candidates-per-parent', type=int, default=None, metavar='INT',
+                                  help="Maximum number of hypotheses in the beam extending the same hypothesis (default: no limit)")
         self._parser.add_argument('--print-word-probabilities', '-wp',
                                   action="store_true", help="Print probabilities of each word")
         self._parser.add_argument('--search_graph', '-sg',
@@ -90,6 +126,16 @@ class ConsoleInterfaceDefault(ConsoleInterface):
         self._parser.add_argument('--predicted_trg', default=False, action='store_true',
                                   help='Use previous predicted target translation as additional input instead of auxiliary'
                                        'input provided. Overrides any additional input specified on command line.')
+        self._parser.add_argument('--document-index', type=argparse.FileType('r'), default=None, metavar='PATH',
+                                  help="With --predicted_trg: file with the document id of each input line "
+                                       "(default: a document starts where the first auxiliary input is empty or "
+                                       "'<START>', or the whole input is one document)")
+        self._parser.add_argument('--batch-size', type=int, default=1, metavar='INT',
+                                  help="Number of sentences (of similar length) decoded together by a worker (default: %(default)s)")
+        self._parser.add_argument('--max-tokens', type=int, default=None, metavar='INT',
+                                  help="Maximum number of source tokens (padded length times number of sentences) per batch (default: no limit)")
+        self._parser.add_argument('--chunk-size', type=int, default=1000, metavar='INT',
+                                  help="Number of input lines read and sent to the workers at a time; translations are written chunk by chunk (default: %(default)s)")
 
     def get_translation_settings(self):
         """
@@ -115,6 +161,10 @@ class ConsoleInterfaceServer(ConsoleInterface):
                                   help='Host address (default: localhost)')
         self._parser.add_argument('--port', type=int, default=8080,
                                   help='Host port (default: 8080)')
+        self._parser.add_argument('--batch-size', type=int, default=80, metavar='INT',
+                                  help="Number of segments (of similar length) of a request decoded together by a worker (default: %(default)s)")
+        self._parser.add_argument('--max-tokens', type=int, default=None, metavar='INT',
+                                  help="Maximum number of source tokens (padded length times number of segments) per batch (default: no limit)")
 
     def get_server_settings(self):
         """
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Reuse of encoder contexts for document-level multi-source decoding, where the
+auxiliary input of a sentence is the previous sentence of the same document.
+
+Instead of the combined f_init of a multi-source model, every input is encoded
+on its own (see `nmt.build_multi_encoders`), and the contexts of the sentences
+of the current documents are kept. If the main and the auxiliary encoder have
+the same weights, the context of a sentence computed as main input serves
+again as auxiliary context of the next sentence.
+"""
+
+import numpy
+
+from theano_util import embedding_name
+
+
+def encoder_groups(params, num_encoders, factors=1):
+    """
+    Returns, for each of the @param num_encoders encoders of a model with
+    parameters @param params, the index of the first encoder with exactly the
+    same weights (its own index if there is none). Encoders in the same group
+    compute the same context for the same input.
+    """
+    def encoder_params(i):
+        prefixes = ('encoder{0}_'.format(i), 'encoder_r{0}_'.format(i))
+        names = [embedding_name(factor) + str(i) for factor in xrange(factors)]
+        names += sorted(name for name in params if name.startswith(prefixes))
+        return [params[name] for name in names]
+
+    groups = []
+    weights = [encoder_params(i) for i in xrange(num_encoders)]
+    for i in xrange(num_encoders):
+        for j in xrange(i + 1):
+            if len(weights[j]) == len(weights[i]) and \
+                    all(numpy.array_equal(a, b) for a, b in zip(weights[j], weights[i])):
+                groups.append(j)
+                break
+    return groups
+
+
+class DocumentEncoder(object):
+    """
+    Drop-in replacement for the f_init of a multi-source model, built from
+    its per-encoder functions (`nmt.build_multi_encoders`). Each sentence is
+    encoded at most once per group of encoders (see `encoder_groups`) for as
+    long as its document is being decoded and it was used in the last batch,
+    so the cache holds at most two batches' worth of contexts.
+    """
+
+    def __init__(self, fs_encode, f_init_state, groups):
+        self._fs_encode = fs_encode
+        self._f_init_state = f_init_state
+        self._groups = groups
+        # (encoder group, input tokens) -> context (length x dim), the documents it was used in, and the
+        # last batch it was used in
+        self._contexts = {}
+        self._documents = {}
+        self._last_used = {}
+        self._batch = 0
+        self._doc_ids = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def set_documents(self, doc_ids):
+        """
+        Sets the document of each sentence of the next batch and evicts the
+        contexts of all other documents, and those not used in the last
+        batch (the auxiliary input of a sentence is the previous one).
+        """
+        self._doc_ids = doc_ids
+        self._batch += 1
+        current = set(doc_ids)
+        for key, documents in self._documents.items():
+            if not documents & current or self._last_used[key] < self._batch - 1:
+                del self._contexts[key]
+                del self._documents[key]
+                del self._last_used[key]
+
+    def __call__(self, *inps):
+        """
+        Takes and returns the same arguments as f_init: x_1, x_mask_1, x_2,
+        x_mask_2, ... for the inputs, and the initial state, the contexts and
+        the projected contexts.
+        """
+        xs, x_masks = inps[0::2], inps[1::2]
+        n_sent = xs[0].shape[2]
+        doc_ids = self._doc_ids if self._doc_ids is not None else [None] * n_sent
+        lengths = [x_mask.sum(0).astype('int64') for x_mask in x_masks]
+
+        # sentences to encode, per encoder group
+        keys = []
+        missing = {}
+        for i, x in enumerate(xs):
+            group = self._groups[i]
+            keys.append([])
+            for s in xrange(n_sent):
+                key = (group, x[:, :lengths[i][s], s].tostring())
+                keys[i].append(key)
+                if key in self._contexts or key in missing.get(group, {}):
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    missing.setdefault(group, {})[key] = x[:, :lengths[i][s], s]
+                self._documents.setdefault(key, set()).add(doc_ids[s])
+                self._last_used[key] = self._batch
+
+        for group, sentences in missing.iteritems():
+            sentence_keys = sentences.keys()
+            seqs = [sentences[key] for key in sentence_keys]
+            max_len = max(seq.shape[1] for seq in seqs)
+            x = numpy.zeros((seqs[0].shape[0], max_len, len(seqs)), dtype='int64')
+            x_mask = numpy.zeros((max_len, len(seqs)), dtype=x_masks[0].dtype)
+            for s, seq in enumerate(seqs):
+                x[:, :seq.shape[1], s] = seq
+                x_mask[:seq.shape[1], s] = 1.
+            ctx = self._fs_encode[group](x, x_mask)
+            for s, (key, seq) in enumerate(zip(sentence_keys, seqs)):
+                self._contexts[key] = ctx[:seq.shape[1], s].copy()
+
+        # padded contexts of the batch, one per input
+        ctxs = []
+        for i, x_mask in enumerate(x_masks):
+            dim = self._contexts[keys[i][0]].shape[1]
+            ctx = numpy.zeros((x_mask.shape[0], n_sent, dim), dtype=x_mask.dtype)
+            for s, key in enumerate(keys[i]):
+                ctx[:lengths[i][s], s] = self._contexts[key]
+            ctxs.append(ctx)
+
+        init_inps = []
+        for ctx, x_mask in zip(ctxs, x_masks):
+            init_inps.extend([ctx, x_mask])
+        ret = self._f_init_state(*init_inps)
+        return [ret[0]] + ctxs + list(ret[1:])
@@ -0,0 +1,133 @@
+'''
+Persistent cache of compiled Theano functions (samplers and scorers).
+
+Building and optimising the graphs of a model takes much longer than loading
+its parameters, and every worker process does it again. Compiled functions
+are therefore pickled to a cache directory, keyed by a hash of the model
+options, the function type, the relevant Theano flags and the source code of
+the model. Model parameters are not stored: they are set on the shared
+variables of the unpickled functions, so one cache entry serves all models
+with the same options.
+'''
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import tempfile
+import cPickle as pkl
+
+import numpy
+import theano
+
+# modules that define the computation graphs
+SOURCE_FILES = ['nmt.py', 'layers.py', 'theano_util.py', 'initializers.py']
+
+# pickling deep graphs (scan) recurses a lot
+RECURSION_LIMIT = 50000
+
+
+def code_version():
+    """
+    Returns a hash of the source files that define the graphs.
+    """
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    sha = hashlib.sha1()
+    for filename in SOURCE_FILES:
+        with open(os.path.join(source_dir, filename), 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def function_key(name, options, **kwargs):
+    """
+    Returns the cache key of the functions @param name (e.g. 'sampler')
+    built for model @param options with builder arguments @param kwargs.
+    """
+    config = theano.config
+    fields = {'name': name,
+              'options': options,
+              'args': kwargs,
+              'theano': [theano.__version__, config.device, config.floatX, config.mode,
+                         config.optimizer, config.optimizer_including, config.optimizer_excluding,
+                         config.linker],
+              'code': code_version()}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str)).hexdigest()
+
+
+def _model_variables(functions, params):
+    """
+    Returns the shared variables of @param functions that hold model
+    parameters, i.e. whose name is a key of @param params.
+    """
+    variables = {}
+    for f in functions:
+        for variable in f.get_shared():
+            if variable.name in params:
+                variables[id(variable)] = variable
+    return variables.values()
+
+
+def load_functions(cache_dir, key, params):
+    """
+    Returns the functions cached under @param key with the model parameters
+    @param params, or None if there are none.
+    """
+    path = os.path.join(cache_dir, key + '.pkl')
+    if not os.path.exists(path):
+        return None
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), RECURSION_LIMIT))
+    try:
+        with open(path, 'rb') as f:
+            functions = pkl.load(f)
+    except Exception as e:
+        logging.warning('Could not load compiled functions from {0}: {1}'.format(path, e))
+        return None
+
+    for variable in _model_variables(functions, params):
+        variable.set_value(params[variable.name], borrow=True)
+    logging.info('Loaded compiled functions from {0}'.format(path))
+    return functions
+
+
+def save_functions(cache_dir, key, functions, params):
+    """
+    Stores @param functions under @param key. The model parameters are
+    replaced by empty arrays while pickling.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    variables = _model_variables(functions, params)
+    values = [variable.get_value(borrow=True) for variable in variables]
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), RECURSION_LIMIT))
+    try:
+        for variable, value in zip(variables, values):
+            variable.set_value(numpy.zeros((0,) * value.ndim, dtype=value.dtype), borrow=True)
+        # write to a temporary file first, as other processes may be reading the cache
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp', delete=False) as f:
+            pkl.dump(functions, f, protocol=pkl.HIGHEST_PROTOCOL)
+        os.rename(f.name, os.path.join(cache_dir, key + '.pkl'))
+        logging.info('Saved compiled functions to {0}'.format(os.path.join(cache_dir, key + '.pkl')))
+    finally:
+        for variable, value in zip(variables, values):
+            variable.set_value(value, borrow=True)
+
+
+def compile_cached(cache_dir, name, options, params, build, **kwargs):
+    """
+    Returns the list of functions returned by @param build (called without
+    arguments), loaded from @param cache_dir if they were compiled before.
+    Without a cache directory, this simply calls @param build.
+    """
+    if cache_dir is None:
+        return build()
+
+    key = function_key(name, options, **kwargs)
+    functions = load_functions(cache_dir, key, params)
+    if functions is None:
+        functions = build()
+        save_functions(cache_dir, key, functions, params)
+    return functions
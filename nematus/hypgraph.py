@@ -1,52 +1,86 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
+from array import array
+
+import numpy
 
 class HypGraph(object):
-	
+	"""
+	Search graph of a beam search, stored as a prefix trie with integer node
+	ids. Node 0 is the start of the sentence; every other node is a target
+	word that extends the hypothesis of its parent node, with the probability
+	of the word and the cost of the hypothesis ending in it.
+	"""
+
+	ROOT = 0
+	# label of the root node (its word id, 0, is also the one of EOS)
+	BOS_SYMBOL = '<s>'
+
 	def __init__(self):
-		self.nodes = defaultdict(str) # {id = label}
-		self.edges = [] # (parent_node_id, child_node_id)
-		self.costs = defaultdict(float) # {node_id = cost}
-		self.word_probs = defaultdict(float) # {node_id = word_prob}
-				
-	def get_id(self, word, history):	
-		if history == []:
-			return str(word)
-		history = '-'.join([str(h) for h in reversed(history)])
-		return '%s-%s' % (word, history)
-	
-	def get_ids(self, words):	
-		ids = []
-		for i, w in enumerate(words):
-			history = words[:i]
-			ids.append(self.get_id(w, history))
-		return ids
-
-	def add(self, word, history, word_prob=None, cost=None):
-		history_labels = [0] + history
-		history_ids = self.get_ids(history_labels)	
-		word_label = word
-		word_id = self.get_id(word_label, history_labels)	
-		# store
-		self.nodes[word_id] = word_label
-		self.edges.append((history_ids[-1], word_id))
-		if word_prob != None:
-			self.word_probs[word_id] = word_prob
-		if cost != None:
-			self.costs[word_id] = cost
+		self.words = array('l', [0])
+		self.parents = array('l', [-1])
+		self.word_probs = array('d', [0.0])
+		self.costs = array('d', [0.0])
+
+	def __len__(self):
+		return len(self.words)
+
+	def add(self, words, parents, word_probs, costs):
+		"""
+		Adds one node per word in @param words (e.g. the hypotheses selected
+		for a sentence in one step of the beam search), as children of the
+		nodes @param parents. Returns the ids of the new nodes.
+		"""
+		first = len(self.words)
+		self.words.fromlist(numpy.asarray(words, dtype='int64').tolist())
+		self.parents.fromlist(numpy.asarray(parents, dtype='int64').tolist())
+		self.word_probs.fromlist(numpy.asarray(word_probs, dtype='float64').tolist())
+		self.costs.fromlist(numpy.asarray(costs, dtype='float64').tolist())
+		return numpy.arange(first, len(self.words))
+
+	def path(self, node_id):
+		"""
+		Returns the ids of the nodes from the root to @param node_id.
+		"""
+		path = []
+		while node_id != -1:
+			path.append(node_id)
+			node_id = self.parents[node_id]
+		return path[::-1]
+
+	def best_final_node(self, eos=0):
+		"""
+		Returns the id of the finished hypothesis (ending in @param eos) with
+		the lowest cost, or None if no hypothesis has finished.
+		"""
+		final = numpy.flatnonzero(numpy.array(self.words[1:]) == eos) + 1
+		if len(final) == 0:
+			return None
+		return int(final[numpy.array(self.costs)[final].argmin()])
+
+	def to_dict(self, word_dict=None):
+		"""
+		Returns the graph as a dictionary of parallel lists (words, parents,
+		word probabilities and costs, indexed by node id), e.g. for a compact
+		JSON export. Word ids are replaced by the entries of @param word_dict,
+		if given.
+		"""
+		words = self.words.tolist()
+		if word_dict is not None:
+			words = [word_dict[word] for word in words]
+			words[self.ROOT] = self.BOS_SYMBOL
+		return {'words': words,
+			'parents': self.parents.tolist(),
+			'word_probs': self.word_probs.tolist(),
+			'costs': self.costs.tolist()}
 
 class HypGraphRenderer(object):
 
 	def __init__(self, hyp_graph):
-		self.nodes = hyp_graph.nodes
-		self.edges = hyp_graph.edges
-		self.costs = hyp_graph.costs
-		self.word_probs = hyp_graph.word_probs
-		# constants
-		self.BOS_SYMBOLS = ['0']
-		self.EOS_SYMBOLS = ['<eos>']
+		self.hyp_graph = hyp_graph
+		self.labels = [str(word) for word in hyp_graph.words]
+		self.labels[HypGraph.ROOT] = HypGraph.BOS_SYMBOL
 
 	def _escape_label(self, label):
 		replacements = {
@@ -57,75 +91,65 @@ class HypGraphRenderer(object):
 			label = label.replace(original, replacement)
 		return label
 
-	def _render(self, costs=False, word_probs=False, highlight_best=False):	
+	def _render(self, costs=False, word_probs=False, highlight_best=False):
 		from pygraphviz import AGraph
-                graph = AGraph(directed=True)
-                for node_id, node_label in self.nodes.iteritems():
-                        attributes = self._node_attr(node_id, costs=costs, word_probs=word_probs)
-			graph.add_node(node_id, **attributes)
-                for (parent_node_id, child_node_id) in self.edges:
-                        graph.add_edge(parent_node_id, child_node_id)
+		graph = AGraph(directed=True)
+		for node_id in xrange(len(self.hyp_graph)):
+			attributes = self._node_attr(node_id, costs=costs, word_probs=word_probs)
+			graph.add_node(str(node_id), **attributes)
+		for node_id, parent_id in enumerate(self.hyp_graph.parents):
+			if parent_id != -1:
+				graph.add_edge(str(parent_id), str(node_id))
 		self.graph = graph
 		if highlight_best:
 			self._highlight_best()
 
-	def _node_attr(self, node_id, costs=False, word_probs=False):	
-		word = self.nodes[node_id].decode('utf-8')
-		cost = self.costs[node_id]
-		prob = self.word_probs[node_id]
+	def _node_attr(self, node_id, costs=False, word_probs=False):
+		word = self.labels[node_id].decode('utf-8')
+		cost = self.hyp_graph.costs[node_id]
+		prob = self.hyp_graph.word_probs[node_id]
 		attr = {}
 		if costs and word_probs:
 			attr['shape'] = "record"
 			attr['label'] = "{{%s|%.3f}|%.3f}" % (word, prob, cost)
 		elif costs:
 			attr['shape'] = "record"
-                        attr['label'] = "{{%s}|%.3f}" % (word, cost)
+			attr['label'] = "{{%s}|%.3f}" % (word, cost)
 		elif word_probs:
 			attr['shape'] = "record"
-                        attr['label'] = "{{%s|%.3f}}" % (word, prob)
+			attr['label'] = "{{%s|%.3f}}" % (word, prob)
 		else:
 			attr['label'] = word
 		attr['label'] = self._escape_label(attr['label'])
 		return attr
-	
+
 	def _highlight_best(self):
 		best_hyp_bg_color = '#CDE9EC'
-		best_hyp_cost = None
-		best_hyp_leaf_node_id = None
-		for node_id, label in self.nodes.iteritems():	
-			if label in self.EOS_SYMBOLS:
-				if best_hyp_cost == None or self.costs[node_id] < best_hyp_cost:
-					best_hyp_leaf_node_id = node_id
-					best_hyp_cost = self.costs[node_id]
-		if best_hyp_leaf_node_id:
-			best_hyp_leaf_node = self.graph.get_node(best_hyp_leaf_node_id)		
-			current_node = best_hyp_leaf_node
-			while current_node != []:	
-				current_node.attr['style'] = 'filled'
-				current_node.attr['fillcolor'] = best_hyp_bg_color
-				try:
-					current_node = self.graph.predecessors(current_node)[0]
-				except IndexError:
-					break
+		best_hyp_leaf_node_id = self.hyp_graph.best_final_node()
+		if best_hyp_leaf_node_id is not None:
+			for node_id in self.hyp_graph.path(best_hyp_leaf_node_id):
+				node = self.graph.get_node(str(node_id))
+				node.attr['style'] = 'filled'
+				node.attr['fillcolor'] = best_hyp_bg_color
 
 	def wordify(self, word_dict):
 		"""
 		Replace node labels (usually integers) with words, subwords, or
 		characters.
-		"""	
-		for node_id, label in self.nodes.iteritems():
-			self.nodes[node_id] = word_dict[label]	
+		"""
+		self.labels = [word_dict[label] for label in self.hyp_graph.words]
+		self.labels[HypGraph.ROOT] = HypGraph.BOS_SYMBOL
 
 	def save_png(self, filepath, detailed=False, highlight_best=False):
 		"""
 		Renders the graph as PNG image.
-		
+
 		@param filepath the taget file
 		@param detailed whether to include word probabilities and
-                       hypothesis costs.
+		       hypothesis costs.
 		@param highlight_best whether to highlight the best hypothesis.
 		"""
 		costs = True if detailed else False
-		word_probs = True if detailed else False	
+		word_probs = True if detailed else False
 		self._render(costs=costs, word_probs=word_probs, highlight_best=highlight_best)
 		self.graph.draw(filepath, prog="dot")
@@ -23,8 +23,7 @@ from collections import OrderedDict, namedtuple
 # layers: 'name': ('parameter initializer', 'feedforward')
 layers = {'ff': ('param_init_fflayer', 'fflayer'),
           'gru': ('param_init_gru', 'gru_layer'),
-          'bi_gru_cond': ('param_init_gru_cond', 'bi_gru_cond_layer'),
-          'tri_gru_cond': ('param_init_gru_cond', 'tri_gru_cond_layer'),
+          'multi_gru_cond': ('param_init_gru_cond', 'multi_gru_cond_layer'),
           'gru_cond': ('param_init_gru_cond', 'gru_cond_layer'),
           'embedding': ('param_init_embedding_layer', 'embedding_layer')
           }
@@ -100,7 +99,12 @@ def shared_dropout_layer(shape, use_noise, trng, value, scaled=True):
 # code from https://github.com/ryankiros/layer-norm
 def layer_norm(x, b, s):
     _eps = numpy_floatX(1e-5)
-    if x.ndim == 3:
+    if b.ndim == 2:
+        # stacked inputs (first dimension), each with its own parameters
+        output = (x - x.mean(-1, keepdims=True)) / tensor.sqrt((x.var(-1, keepdims=True) + _eps))
+        pattern = [0] + ['x'] * (x.ndim - 2) + [1]
+        output = s.dimshuffle(*pattern) * output + b.dimshuffle(*pattern)
+    elif x.ndim == 3:
         output = (x - x.mean(2)[:, :, None]) / tensor.sqrt((x.var(2)[:, :, None] + _eps))
         output = s[None, None, :] * output + b[None, None, :]
     else:
@@ -530,7 +534,7 @@ def param_init_gru_cond(options, params, prefix='gru_cond',
     # parameters still used for decoder initialisation in methods other than att-concat
     if options['multisource_type'] == 'att-concat':
         # linear projection
-        params[pp(prefix, 'W_projcomb_att')] = norm_weight(dimctx[0] + dimctx[1], dimctx[0])
+        params[pp(prefix, 'W_projcomb_att')] = norm_weight(sum(dimctx[:num_encoders]), dimctx[0])
         params[pp(prefix, 'b_projcomb')] = numpy.zeros((dimctx[0],)).astype(floatX)
         if options['layer_normalisation']:
             params[pp(prefix, 'W_projcomb_att_lnb')] = scale_add * numpy.ones((1 * dimctx[0])).astype(floatX)
@@ -573,7 +577,8 @@ def gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
                    pctx_=None,
                    recurrence_transition_depth=2,
                    truncate_gradient=-1,
-                   profile=False):
+                   profile=False,
+                   projected_below=None):
     assert context, 'Context must be provided'
 
     if one_step:
@@ -624,10 +629,13 @@ def gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
         return _x[:, n * dim:(n + 1) * dim]
 
     # state_below is the previous output word embedding
-    state_belowx = tensor.dot(state_below * below_dropout[0], wn(pp(prefix, 'Wx'))) + \
-                   tparams[pp(prefix, 'bx')]
-    state_below_ = tensor.dot(state_below * below_dropout[1], wn(pp(prefix, 'W'))) + \
-                   tparams[pp(prefix, 'b')]
+    if projected_below is None:
+        state_belowx = tensor.dot(state_below * below_dropout[0], wn(pp(prefix, 'Wx'))) + \
+                       tparams[pp(prefix, 'bx')]
+        state_below_ = tensor.dot(state_below * below_dropout[1], wn(pp(prefix, 'W'))) + \
+                       tparams[pp(prefix, 'b')]
+    else:
+        state_below_, state_belowx = projected_below
 
     # ----------- beginning of _step_slice -----------
     # step function (to be used by scan)
@@ -755,23 +763,29 @@ def gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
 #Attention = namedtuple('Attention', 'ctx_ pctx__ alpha')
 
 
-# Conditional GRU layer for multi-source inputs
-def bi_gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
-                         mask=None, context=None, one_step=False,
+# Conditional GRU layer for any number of inputs (multi-source).
+# The contexts of all inputs are padded to the same length and stacked, so
+# that the attention over all of them is computed in batched operations.
+# The resulting context vectors are combined as given by
+# options['multisource_type'] (att-concat, att-gate or att-hier).
+# Returns the hidden states, the combined contexts and one matrix of
+# attention weights per input.
+def multi_gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
+                         mask=None, contexts=None, one_step=False,
                          init_memory=None, init_state=None,
-                         context_mask=None,
+                         context_masks=None,
                          dropout_probability_below=0,
                          dropout_probability_ctx=0,
                          dropout_probability_rec=0,
-                         pctx_=None,
+                         pctxs_=None,
                          recurrence_transition_depth=2,
                          truncate_gradient=-1,
                          profile=False,
-                         extra_context=None,
-                         extra_pctx_=None,
-                         extra_context_mask=None):
+                         projected_below=None):
     # check inputs for multi-source inputs
-    assert context and extra_context, 'At least two contexts must be provided'
+    assert contexts and len(contexts) >= 2, 'At least two contexts must be provided'
+    num_inputs = len(contexts)
+    assert options['multisource_type'] != 'att-gate' or num_inputs == 2, 'att-gate combines exactly two contexts'
 
     if one_step:
         assert init_state, 'Previous state must be provided'
@@ -790,7 +804,9 @@ def bi_gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
 
     dim = tparams[pp(prefix, 'Wcx')].shape[1]
 
-    rec_dropout = dropout((n_samples, dim), dropout_probability_rec, num=2 + 2 * recurrence_transition_depth)
+    # one recurrent dropout mask per attention mechanism
+    rec_dropout = dropout((n_samples, dim), dropout_probability_rec,
+                          num=2 + num_inputs + 2 * (recurrence_transition_depth - 1))
 
     # utility function to look up parameters and apply weight normalization if enabled
     def wn(param_name):
@@ -806,24 +822,53 @@ def bi_gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
     if init_state is None:
         init_state = tensor.zeros((n_samples, dim))
 
-    assert context.ndim == 3, 'Context 1 must be 3-d: #annotation x #sample x dim'
-    assert extra_context.ndim == 3, 'Context 1 must be 3-d: #annotation x #sample x dim'
+    if pctxs_ is None:
+        pctxs_ = [None] * num_inputs
+    if context_masks is None:
+        context_masks = [None] * num_inputs
 
-    # first context
-    ctx_dropout = dropout((n_samples, 2 * options['dim']), dropout_probability_ctx, num=5)
-    if pctx_ is None:
-        pctx_ = tensor.dot(context * ctx_dropout[0], wn(pp(prefix, 'Wc_att0'))) + tparams[pp(prefix, 'b_att0')]
-    if options['layer_normalisation']:
-        pctx_ = layer_norm(pctx_, tparams[pp(prefix, 'Wc_att_lnb0')],
-                                   tparams[pp(prefix, 'Wc_att_lns0')])
-    # second context
-    extra_ctx_dropout = dropout((n_samples, 2 * options['dim']), dropout_probability_ctx, num=5)
-    if extra_pctx_ is None:
-        extra_pctx_ = tensor.dot(extra_context * extra_ctx_dropout[0], wn(pp(prefix, 'Wc_att1'))) + \
-                      tparams[pp(prefix, 'b_att1')]
+    # project each context for the attention mechanism
+    ctx_dropout = []
+    pctxs = []
+    masks = []
+    for i, (context, pctx_, context_mask) in enumerate(zip(contexts, pctxs_, context_masks)):
+        assert context.ndim == 3, 'Context %d must be 3-d: #annotation x #sample x dim' % (i + 1)
+        ctx_dropout.append(dropout((n_samples, 2 * options['dim']), dropout_probability_ctx, num=5))
+        if pctx_ is None:
+            pctx_ = tensor.dot(context * ctx_dropout[i][0], wn(pp(prefix, 'Wc_att' + str(i)))) + \
+                    tparams[pp(prefix, 'b_att' + str(i))]
+        if options['layer_normalisation']:
+            pctx_ = layer_norm(pctx_, tparams[pp(prefix, 'Wc_att_lnb' + str(i))],
+                               tparams[pp(prefix, 'Wc_att_lns' + str(i))])
+        pctxs.append(pctx_)
+        if context_mask is None:
+            context_mask = tensor.ones_like(context[:, :, 0])
+        masks.append(context_mask)
+
+    # pad all inputs to the same length and stack them: #input x #annotation x ...
+    max_len = tensor.max(tensor.stack([context.shape[0] for context in contexts]))
+
+    def _pad_and_stack(xs):
+        padded = []
+        for x in xs:
+            shape = [max_len] + [x.shape[d] for d in xrange(1, x.ndim)]
+            padded.append(tensor.set_subtensor(tensor.zeros(shape, dtype=x.dtype)[:x.shape[0]], x))
+        return tensor.stack(padded)
+
+    cc = _pad_and_stack(contexts)
+    pctx = _pad_and_stack(pctxs)
+    masks = _pad_and_stack(masks)
+    # 1 for the annotations of each input, 0 for padding
+    in_range = _pad_and_stack([tensor.ones_like(context[:, :, 0]) for context in contexts])
+    ctx_dropout = tensor.stack(ctx_dropout)
+
+    # attention parameters of all inputs
+    W_comb_att = tensor.stack([wn(pp(prefix, 'W_comb_att' + str(i))) for i in xrange(num_inputs)])
+    U_att = tensor.stack([wn(pp(prefix, 'U_att' + str(i)))[:, 0] for i in xrange(num_inputs)])
+    c_tt = tensor.stack([tparams[pp(prefix, 'c_tt' + str(i))][0] for i in xrange(num_inputs)])
     if options['layer_normalisation']:
-        extra_pctx_ = layer_norm(extra_pctx_, tparams[pp(prefix, 'Wc_att_lnb1')],
-                           tparams[pp(prefix, 'Wc_att_lns1')])
+        W_comb_att_lnb = tensor.stack([tparams[pp(prefix, 'W_comb_att_lnb' + str(i))] for i in xrange(num_inputs)])
+        W_comb_att_lns = tensor.stack([tparams[pp(prefix, 'W_comb_att_lns' + str(i))] for i in xrange(num_inputs)])
 
     # auxiliary slice function
     def _slice(_x, n, dim):
@@ -831,26 +876,32 @@ def bi_gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
             return _x[:, :, n * dim:(n + 1) * dim]
         return _x[:, n * dim:(n + 1) * dim]
 
+    # dropout mask j of every input, broadcastable to a stacked tensor with ndim dimensions
+    # (#input x #sample x dim during training, but only #input when sampling)
+    def _input_dropout(ctx_dropout, j, ndim):
+        d = ctx_dropout[:, j]
+        if d.ndim == 1:
+            return tensor.shape_padright(d, ndim - 1)
+        if ndim == 4:
+            return tensor.shape_padaxis(d, 1)
+        return d
+
     # state_below is the previous output word embedding
-    state_belowx = tensor.dot(state_below * below_dropout[0], wn(pp(prefix, 'Wx'))) + \
-                   tparams[pp(prefix, 'bx')]
-    state_below_ = tensor.dot(state_below * below_dropout[1], wn(pp(prefix, 'W'))) + \
-                   tparams[pp(prefix, 'b')]
+    if projected_below is None:
+        state_belowx = tensor.dot(state_below * below_dropout[0], wn(pp(prefix, 'Wx'))) + \
+                       tparams[pp(prefix, 'bx')]
+        state_below_ = tensor.dot(state_below * below_dropout[1], wn(pp(prefix, 'W'))) + \
+                       tparams[pp(prefix, 'b')]
+    else:
+        state_below_, state_belowx = projected_below
 
     # ----------- beginning of _step_slice -----------
     # step function (to be used by scan)
-    # TODO: cannot pass a list here, so only 2 inputs are possible for now
-    def _step_slice(m_, x_, xx_, h_, ctx_, alpha_, extra_alpha_, pctx_, extra_pctx_, cc_, extra_cc_, rec_dropout,
-                                                                                    ctx_dropout, extra_ctx_dropout):
+    def _step_slice(m_, x_, xx_, h_, ctx_, alpha_, pctx_, cc_, masks, in_range, rec_dropout, ctx_dropout):
         if options['layer_normalisation']:
             x_ = layer_norm(x_, tparams[pp(prefix, 'W_lnb')], tparams[pp(prefix, 'W_lns')])
             xx_ = layer_norm(xx_, tparams[pp(prefix, 'Wx_lnb')], tparams[pp(prefix, 'Wx_lns')])
 
-
-        # initialise decoder with average of extra input context (if asked)
-        #if options['multisource_type'] == "init-decoder":
-        #    h_ = theano.tensor.mean(extra_cc_, axis=0)#/extra_cc_.shape()[0]
-
         # ------------------------ GRU 1 ------------------------
         # compute of r'_j and z'_j (reset and update activations)
         preact1 = tensor.dot(h_ * rec_dropout[0], wn(pp(prefix, 'U')))
@@ -876,140 +927,57 @@ def bi_gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
         h1 = u1 * h_ + (1. - u1) * h1
         h1 = m_[:, None] * h1 + (1. - m_)[:, None] * h_
 
-        pstates_, pctxs__, alphas, ctxs_ = [], [], [], []
-        # -------------- attention mechanism(s) --------------
-        # fixed at 2 for now...
-        #for i in range(2):
-        # suffix for parameters
-
-        # FIRST ONE
-        suff = str(0)
-        i = 0
-
+        # -------------- attention mechanisms (all inputs at once) --------------
         # calculate e_ij (here pctx__)
-        pstates_.append(tensor.dot(h1 * rec_dropout[2+i], wn(pp(prefix, 'W_comb_att' + suff))))
+        pstates_ = tensor.batched_dot(tensor.stack([h1 * rec_dropout[2 + i] for i in xrange(num_inputs)]),
+                                      W_comb_att)
         if options['layer_normalisation']:
-            pstates_[i] = layer_norm(pstates_[i], tparams[pp(prefix, 'W_comb_att_lnb' + suff)],
-                                     tparams[pp(prefix, 'W_comb_att_lns' + suff)])
-        pctxs__.append(pctx_ + pstates_[i][None, :, :])
-        # pctx__ += xc_
-        pctxs__[i] = tensor.tanh(pctxs__[i])
+            pstates_ = layer_norm(pstates_, W_comb_att_lnb, W_comb_att_lns)
+        pctx__ = tensor.tanh(pctx_ + pstates_[:, None, :, :])
 
         # multiply by weight vector
-        alphas.append(tensor.dot(pctxs__[i] * ctx_dropout[1], wn(pp(prefix, 'U_att' + suff))) +
-                      tparams[pp(prefix, 'c_tt' + suff)])
-
-        alphas[i] = alphas[i].reshape([alphas[i].shape[0], alphas[i].shape[1]])
-
-        # normalise
-        alphas[i] = tensor.exp(alphas[i] - alphas[i].max(0, keepdims=True))
-        if context_mask:
-            alphas[i] = alphas[i] * context_mask
-        alphas[i] = alphas[i] / alphas[i].sum(0, keepdims=True)
-        ctxs_.append((cc_ * alphas[i][:, :, None]).sum(0))  # current context
-
-        # AUXILIARY ONE
-
-        # only calculate if using attention on multiple input
-        suff = str(1)
-        i = 1
-        # calculate e_ij (here pctx__)
-        pstates_.append(tensor.dot(h1 * rec_dropout[2 + i], wn(pp(prefix, 'W_comb_att' + suff))))
-        if options['layer_normalisation']:
-            pstates_[i] = layer_norm(pstates_[i], tparams[pp(prefix, 'W_comb_att_lnb' + suff)],
-                                     tparams[pp(prefix, 'W_comb_att_lns' + suff)])
-        pctxs__.append(extra_pctx_ + pstates_[i][None, :, :])
-        # pctx__ += xc_
-        pctxs__[i] = tensor.tanh(pctxs__[i])
-
-        # only calculate attention if doing real multi-source (not just initialisation)
-        if options['multisource_type'] in ['att-concat', 'att-hier', 'att-gate']:
-            # multiply by weight vector
-            alphas.append(tensor.dot(pctxs__[i] * extra_ctx_dropout[1], wn(pp(prefix, 'U_att' + suff))) +
-                          tparams[pp(prefix, 'c_tt' + suff)])
-
-            alphas[i] = alphas[i].reshape([alphas[i].shape[0], alphas[i].shape[1]])
-
-            # normalise
-            alphas[i] = tensor.exp(alphas[i] - alphas[i].max(0, keepdims=True))
-            if extra_context_mask:
-                alphas[i] = alphas[i] * extra_context_mask
-            alphas[i] = alphas[i] / alphas[i].sum(0, keepdims=True)
-            ctxs_.append((extra_cc_ * alphas[i][:, :, None]).sum(0))  # current context
-
-            ctxs_[0].tag.test_value = numpy.ones(shape=(10, 48)).astype(floatX)
-            ctxs_[1].tag.test_value = numpy.ones(shape=(10, 48)).astype(floatX)
-        #else:
-        #    # need to define anyway (dummy variable)
-        #    alphas.append(tensor.constant(numpy.zeros((1,1)).astype(floatX)))
+        pctx__ = pctx__ * _input_dropout(ctx_dropout, 1, 4)
+        alpha = tensor.batched_dot(pctx__.reshape([num_inputs, -1, pctx__.shape[3]]), U_att)
+        alpha = alpha.reshape([num_inputs, pctx__.shape[1], pctx__.shape[2]]) + c_tt[:, None, None]
 
+        # normalise over the annotations of each input (padding is left out)
+        alpha = tensor.switch(in_range, alpha, numpy_floatX(-numpy.inf))
+        alpha = tensor.exp(alpha - alpha.max(1, keepdims=True))
+        alpha = alpha * masks
+        alpha = alpha / alpha.sum(1, keepdims=True)
+        ctxs_ = (cc_ * alpha[:, :, :, None]).sum(1)  # current context of each input
 
         # -------------- combine the resulting contexts --------------
         # concatenate the multiple context vectors and project to original dimensions
-        if options['multisource_type'] == "att-concat":
-            # put auxiliary context first
-
-            # concatenate the two contexts
-            # TODO: context dropout?
-            ctx_ = concatenate([ctxs_[1] * extra_ctx_dropout[4], ctxs_[0] * ctx_dropout[4]], axis=1)
+        if options['multisource_type'] == 'att-concat':
+            ctxs_ = ctxs_ * _input_dropout(ctx_dropout, 4, 3)
+            # auxiliary contexts first
+            ctx_ = concatenate([ctxs_[i] for i in xrange(1, num_inputs)] + [ctxs_[0]], axis=1)
             # linear projection to return to original context dimensions
             ctx_ = tensor.dot(ctx_, wn(pp(prefix, 'W_projcomb_att'))) + tparams[pp(prefix, 'b_projcomb')]
             if options['layer_normalisation']:
                 ctx_ = layer_norm(ctx_, tparams[pp(prefix, 'W_projcomb_att_lnb')],
                                   tparams[pp(prefix, 'W_projcomb_att_lns')])
-            # non-linearity as in Zoph and Knight
-            #ctx_ = tanh(ctx_)
 
         # apply a context gate between the two different contexts
-        elif options['multisource_type'] == "att-gate":
-
-            # linear combination of (i) y_i-1 (previous embedded target word),
-            # (ii) s_i-1 (previous decoder state), (iii) ctx_ (main context vector) and
-            # (iv) aux_ctx_ (auxiliary context vector)
-            #ym1_ = xxx_
-            #sm1_ = tensor.dot(h1 * rec_dropout[2], wn(pp(prefix, 'W_att-gate-sm1')))
-
-            main_pctx_ = tensor.dot(ctxs_[0] * ctx_dropout[4], wn(pp(prefix, 'W_att-gate-ctx1')))
-            main_pctx_.tag.test_value = numpy.ones(shape=(10, 48)).astype(floatX)
-            aux_pctx_ = tensor.dot(ctxs_[1] * extra_ctx_dropout[4], wn(pp(prefix, 'W_att-gate-ctx2')))
-            aux_pctx_.tag.test_value = numpy.ones(shape=(10, 48)).astype(floatX)
-
-            #g_ = sm1_ + ym1_ + main_pctx_ + aux_pctx_ + tparams[pp(prefix, 'b_att-gate')]
-            g_ = main_pctx_ + aux_pctx_ + tparams[pp(prefix, 'b_att-gate')]
-            g_.tag.test_value = numpy.ones(shape=(10, 48)).astype(floatX)
+        elif options['multisource_type'] == 'att-gate':
+            dropped_ctxs_ = ctxs_ * _input_dropout(ctx_dropout, 4, 3)
+            g_ = tensor.dot(dropped_ctxs_[0], wn(pp(prefix, 'W_att-gate-ctx1'))) + \
+                 tensor.dot(dropped_ctxs_[1], wn(pp(prefix, 'W_att-gate-ctx2'))) + \
+                 tparams[pp(prefix, 'b_att-gate')]
             g_ = tanh(g_)
-
-            #if options['layer_normalisation']:
-            #    g_ = layer_norm(g_, tparams[pp(prefix, 'W_att-gate_lnb')],
-            #                    tparams[pp(prefix, 'W_att-gate_lns')])
-
-            # normalise between 0 and 1
-            #g_ = tensor.exp(g_ - g_.max(0, keepdims=True))
-            #g_ = g_ / g_.sum(0, keepdims=True)
-
-            # apply to contexts TODO just testing
             ctx_ = g_ * ctxs_[1] + (1. - g_) * ctxs_[0]
 
-        elif options['multisource_type'] == "att-hier":
-
-            logging.info("Doing multi-source with hierarchical attention")
-
-            # stack the contexts ready for hierarchical attfention
-            stacked_ctx = tensor.stack(ctxs_)
-            # batch size 10, dimension 48, 2 contexts
-            stacked_ctx.tag.test_value = numpy.ones(shape=(2, 10, 48)).astype(floatX)
-            #stacked_dropout =
-
-            # TODO: add ctx dropout
-            hier_alpha = tensor.dot(stacked_ctx, wn(pp(prefix, 'U_att-hier'))) + tparams[pp(prefix, 'c_tt-hier')]
-            hier_alpha.tag.test_value = numpy.ones(shape=(2, 10, 1)).astype(floatX)
+        # attention over the context vectors of the inputs
+        elif options['multisource_type'] == 'att-hier':
+            hier_alpha = tensor.dot(ctxs_, wn(pp(prefix, 'U_att-hier'))) + tparams[pp(prefix, 'c_tt-hier')]
             hier_alpha = hier_alpha.reshape([hier_alpha.shape[0], hier_alpha.shape[1]])
-            hier_alpha= tensor.exp(hier_alpha - hier_alpha.max(0, keepdims=True))
+            hier_alpha = tensor.exp(hier_alpha - hier_alpha.max(0, keepdims=True))
 
             # normalise
             hier_alpha = hier_alpha / hier_alpha.sum(0, keepdims=True)
             # apply alpha
-            ctx_ = (ctxs_ * hier_alpha[:, :, None]).sum(0) # current context
+            ctx_ = (ctxs_ * hier_alpha[:, :, None]).sum(0)  # current context
 
         else:
             ctx_ = ctxs_[0]
@@ -1020,380 +988,14 @@ def bi_gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
             suffix = '' if i == 0 else ('_drt_%s' % i)
 
             # compute of r_j and z_j (reset and update activations)
-            preact2 = tensor.dot(h2_prev * rec_dropout[4 + 2 * i], wn(pp(prefix, 'U_nl' + suffix))) + tparams[
-                pp(prefix, 'b_nl' + suffix)]
+            preact2 = tensor.dot(h2_prev * rec_dropout[2 + num_inputs + 2 * i], wn(pp(prefix, 'U_nl' + suffix))) + \
+                      tparams[pp(prefix, 'b_nl' + suffix)]
             if options['layer_normalisation']:
                 preact2 = layer_norm(preact2, tparams[pp(prefix, 'U_nl%s_lnb' % suffix)],
                                      tparams[pp(prefix, 'U_nl%s_lns' % suffix)])
             if i == 0:
-                if options['multisource_type'] == 'att-concat':
-
-                    # TODO: put dropout back somewhere
-                    ctx1_ = tensor.dot(ctx_ * ctx_dropout[2],
-                                       wn(pp(prefix, 'Wc' + suffix)))  # dropout mask is shared over mini-steps
-                else:
-                    ctx1_ = tensor.dot(ctx_ * ctx_dropout[2],
-                                       wn(pp(prefix, 'Wc' + suffix)))  # dropout mask is shared over mini-steps
-                if options['layer_normalisation']:
-                    ctx1_ = layer_norm(ctx1_, tparams[pp(prefix, 'Wc%s_lnb' % suffix)],
-                                       tparams[pp(prefix, 'Wc%s_lns' % suffix)])
-                preact2 += ctx1_
-            preact2 = tensor.nnet.sigmoid(preact2)
-
-            # reset and update gates
-            r2 = _slice(preact2, 0, dim)
-            u2 = _slice(preact2, 1, dim)
-
-            # proposed hidden state of the cGRU ^s_j
-            preactx2 = tensor.dot(h2_prev * rec_dropout[4 + 2 * i], wn(pp(prefix, 'Ux_nl' + suffix))) + \
-                       tparams[pp(prefix, 'bx_nl' + suffix)]
-            if options['layer_normalisation']:
-                preactx2 = layer_norm(preactx2, tparams[pp(prefix, 'Ux_nl%s_lnb' % suffix)],
-                                      tparams[pp(prefix, 'Ux_nl%s_lns' % suffix)])
-            preactx2 *= r2
-
-            # they use the context vector from the attention mechanism
-            if i == 0:
-                # TODO: put dropout back somewhere
-                if options['multisource_type'] == 'att-concat':
-                    #print(ctx_dropout[2].shape)
-                    ctx2_ = tensor.dot(ctx_ * ctx_dropout[3],
-                                       wn(pp(prefix, 'Wcx' + suffix)))  # dropout mask is shared over mini-steps
-
-                else:
-                    ctx2_ = tensor.dot(ctx_ * ctx_dropout[3],
-                                       wn(pp(prefix, 'Wcx' + suffix)))  # dropout mask is shared over mini-steps
-                if options['layer_normalisation']:
-                    ctx2_ = layer_norm(ctx2_, tparams[pp(prefix, 'Wcx%s_lnb' % suffix)],
-                                       tparams[pp(prefix, 'Wcx%s_lns' % suffix)])
-                preactx2 += ctx2_
-
-            # apply update gate to produce s_j (here h2 = hidden state of cGRU)
-            h2 = tensor.tanh(preactx2)
-
-            h2 = u2 * h2_prev + (1. - u2) * h2
-            h2 = m_[:, None] * h2 + (1. - m_)[:, None] * h2_prev
-            h2_prev = h2
-
-        return h2, ctx_, alphas[0].T, alphas[1].T  # pstate_, preact, preactx, r, u
-
-    seqs = [mask, state_below_, state_belowx]
-    # seqs = [mask, state_below_, state_belowx, state_belowc]
-    _step = _step_slice
-
-    shared_vars = []
-
-    if one_step:
-        rval = _step(*(
-            seqs + [init_state, None, None, None, pctx_, extra_pctx_, context, extra_context, rec_dropout, ctx_dropout,
-                                                   extra_ctx_dropout] +
-            shared_vars))
-    else:
-        rval, updates = theano.scan(_step,
-                                    sequences=seqs,
-                                    outputs_info=[init_state,
-                                                  tensor.zeros((n_samples, context.shape[2])),
-                                                  tensor.zeros((n_samples, context.shape[0])),
-                                                  tensor.zeros((n_samples, extra_context.shape[0]))
-                                                  ],
-                                    non_sequences=[pctx_, extra_pctx_, context, extra_context, rec_dropout, ctx_dropout,
-                                                   extra_ctx_dropout] + shared_vars,
-                                    name=pp(prefix, '_layers'),
-                                    n_steps=nsteps,
-                                    truncate_gradient=truncate_gradient,
-                                    profile=profile,
-                                    strict=False)
-    return rval
-
-
-#-----------------------------------------------------------------------------------------------------------------------
-# 3 inputs
-
-# Conditional GRU layer for multi-source inputs
-def tri_gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
-                         mask=None, context=None, one_step=False,
-                         init_memory=None, init_state=None,
-                         context_mask=None,
-                         dropout_probability_below=0,
-                         dropout_probability_ctx=0,
-                         dropout_probability_rec=0,
-                         pctx_=None,
-                         recurrence_transition_depth=2,
-                         truncate_gradient=-1,
-                         profile=False,
-                         extra_context1=None, extra_context2=None,
-                         extra_context_mask1=None, extra_context_mask2=None,
-                         extra_pctx1_=None, extra_pctx2_=None):
-    # check inputs for multi-source inputs
-    #assert all([x for x in context]), 'At least three contexts must be provided'
-    assert context and extra_context1 and extra_context2, 'At least three contexts must be provided'
-
-
-    if one_step:
-        assert init_state, 'Previous state must be provided'
-
-    nsteps = state_below.shape[0]
-    if state_below.ndim == 3:
-        n_samples = state_below.shape[1]
-        dim_below = state_below.shape[2]
-    else:
-        n_samples = 1
-        dim_below = state_below.shape[1]
-
-    # mask
-    if mask is None:
-        mask = tensor.ones((state_below.shape[0], 1))
-
-    dim = tparams[pp(prefix, 'Wcx')].shape[1]
-
-    rec_dropout = dropout((n_samples, dim), dropout_probability_rec, num=2 + 2 * recurrence_transition_depth)
-
-    # utility function to look up parameters and apply weight normalization if enabled
-    def wn(param_name):
-        param = tparams[param_name]
-        if options['weight_normalisation']:
-            return weight_norm(param, tparams[param_name + '_wns'])
-        else:
-            return param
-
-    below_dropout = dropout((n_samples, dim_below), dropout_probability_below, num=2)
-
-    # initial/previous state
-    if init_state is None:
-        init_state = tensor.zeros((n_samples, dim))
-
-    # initialise ctx_dropout and pctx_ for each input
-
-    #for i in range(3):
-    assert context.ndim == 3, 'Context 1 must be 3-d: #annotation x #sample x dim'
-    assert extra_context1.ndim == 3, 'Context 1 must be 3-d: #annotation x #sample x dim'
-    assert extra_context2.ndim == 3, 'Context 1 must be 3-d: #annotation x #sample x dim'
-
-    # first context
-    ctx_dropout = []
-    ctx_dropout.append(dropout((n_samples, 2 * options['dim']), dropout_probability_ctx, num=5))
-    if pctx_ is None:
-        pctx_ = tensor.dot(context * ctx_dropout[0][0], wn(pp(prefix, 'Wc_att0'))) + \
-                    tparams[pp(prefix, 'b_att0')]
-    if options['layer_normalisation']:
-        pctx_ = layer_norm(pctx_, tparams[pp(prefix, 'Wc_att_lnb0')],
-                               tparams[pp(prefix, 'Wc_att_lns0')])
-
-    # 2nd context
-    ctx_dropout.append(dropout((n_samples, 2 * options['dim']), dropout_probability_ctx, num=5))
-    if extra_pctx1_ is None:
-
-        extra_pctx1_ = tensor.dot(extra_context1 * ctx_dropout[1][0], wn(pp(prefix, 'Wc_att' + str(1)))) + \
-                tparams[pp(prefix, 'b_att' + str(1))]
-    if options['layer_normalisation']:
-        extra_pctx1_ = layer_norm(extra_pctx1_, tparams[pp(prefix, 'Wc_att_lnb' + str(1))],
-                           tparams[pp(prefix, 'Wc_att_lns' + str(1))])
-
-
-    # 3rd context
-    ctx_dropout.append(dropout((n_samples, 2 * options['dim']), dropout_probability_ctx, num=5))
-    if extra_pctx2_ is None:
-        extra_pctx2_ = tensor.dot(extra_context2 * ctx_dropout[2][0], wn(pp(prefix, 'Wc_att' + str(2)))) + \
-                tparams[pp(prefix, 'b_att' + str(2))]
-    if options['layer_normalisation']:
-        extra_pctx2_ = layer_norm(extra_pctx2_, tparams[pp(prefix, 'Wc_att_lnb' + str(2))],
-                           tparams[pp(prefix, 'Wc_att_lns' + str(2))])
-
-    # auxiliary slice function
-    def _slice(_x, n, dim):
-        if _x.ndim == 3:
-            return _x[:, :, n * dim:(n + 1) * dim]
-        return _x[:, n * dim:(n + 1) * dim]
-
-    # state_below is the previous output word embedding
-    state_belowx = tensor.dot(state_below * below_dropout[0], wn(pp(prefix, 'Wx'))) + \
-                   tparams[pp(prefix, 'bx')]
-    state_below_ = tensor.dot(state_below * below_dropout[1], wn(pp(prefix, 'W'))) + \
-                   tparams[pp(prefix, 'b')]
-
-    # ----------- beginning of _step_slice -----------
-    # step function (to be used by scan)
-    # TODO: cannot pass a list here, so only 2 inputs are possible for now
-    def _step_slice(m_, x_, xx_, h_, ctx_, alpha_, extra_alphas1_, extra_alphas2_,
-                    pctx_, cc_, rec_dropout, ctx_dropout, extra_pctx1_, extra_pctx2_,
-                    extra_cc1_, extra_cc2_, extra_ctx_dropout1, extra_ctx_dropout2):
-
-        # put in a list for ease of manipulation (cannot pass them to slice function as list)
-        #pctx_ = [pctx_, extra_pctx1_, extra_pctx2_]
-        #cc_ = [cc_, extra_cc1_, extra_cc2_]
-        #ctx_dropout = [ctx_dropout, extra_ctx_dropout1, extra_ctx_dropout2]
-
-        if options['layer_normalisation']:
-            x_ = layer_norm(x_, tparams[pp(prefix, 'W_lnb')], tparams[pp(prefix, 'W_lns')])
-            xx_ = layer_norm(xx_, tparams[pp(prefix, 'Wx_lnb')], tparams[pp(prefix, 'Wx_lns')])
-
-        # ------------------------ GRU 1 ------------------------
-        # compute of r'_j and z'_j (reset and update activations)
-        preact1 = tensor.dot(h_ * rec_dropout[0], wn(pp(prefix, 'U')))
-        if options['layer_normalisation']:
-            preact1 = layer_norm(preact1, tparams[pp(prefix, 'U_lnb')], tparams[pp(prefix, 'U_lns')])
-        preact1 += x_
-        preact1 = tensor.nnet.sigmoid(preact1)
-
-        # reset and update gates
-        r1 = _slice(preact1, 0, dim)
-        u1 = _slice(preact1, 1, dim)
-
-        # proposed intermediate representation ^s'_j
-        # gate r'_j applied to (U' * s_{j-1})
-        preactx1 = tensor.dot(h_ * rec_dropout[1], wn(pp(prefix, 'Ux')))
-        if options['layer_normalisation']:
-            preactx1 = layer_norm(preactx1, tparams[pp(prefix, 'Ux_lnb')], tparams[pp(prefix, 'Ux_lns')])
-        preactx1 *= r1
-        preactx1 += xx_
-        h1 = tensor.tanh(preactx1)
-
-        # intermediate representation s'_j (here = h1) (using the update gate)
-        h1 = u1 * h_ + (1. - u1) * h1
-        h1 = m_[:, None] * h1 + (1. - m_)[:, None] * h_
-
-        pstates_, pctxs__, alphas, ctxs_ = [], [], [], []
-        # -------------- attention mechanism(s) --------------
-
-        # for each possible context
-        #for i in range(len(context)):
-        i = 0
-        # suffix for parameters
-        suff = str(i)
-
-        # calculate e_ij (here pctx__)
-        pstates_.append(tensor.dot(h1 * rec_dropout[2+i], wn(pp(prefix, 'W_comb_att' + suff))))
-        if options['layer_normalisation']:
-            pstates_[i] = layer_norm(pstates_[i], tparams[pp(prefix, 'W_comb_att_lnb' + suff)],
-                                     tparams[pp(prefix, 'W_comb_att_lns' + suff)])
-        pctxs__.append(pctx_ + pstates_[i][None, :, :])
-        # pctx__ += xc_
-        pctxs__[i] = tensor.tanh(pctxs__[i])
-
-        # multiply by weight vector
-        alphas.append(tensor.dot(pctxs__[i] * ctx_dropout[0][1], wn(pp(prefix, 'U_att' + suff))) +
-                      tparams[pp(prefix, 'c_tt' + suff)])
-
-        alphas[i] = alphas[i].reshape([alphas[i].shape[0], alphas[i].shape[1]])
-
-        # normalise
-        alphas[i] = tensor.exp(alphas[i] - alphas[i].max(0, keepdims=True))
-        if context_mask:
-            alphas[i] = alphas[i] * context_mask
-        alphas[i] = alphas[i] / alphas[i].sum(0, keepdims=True)
-        ctxs_.append((cc_ * alphas[i][:, :, None]).sum(0))  # current context
-        ctxs_[i].tag.test_value = numpy.ones(shape=(10, 48)).astype(floatX)
-
-
-        # 2
-        i = 1
-        # suffix for parameters
-        suff = str(i)
-
-        # calculate e_ij (here pctx__)
-        pstates_.append(tensor.dot(h1 * rec_dropout[2 + i], wn(pp(prefix, 'W_comb_att' + suff))))
-        if options['layer_normalisation']:
-            pstates_[i] = layer_norm(pstates_[i], tparams[pp(prefix, 'W_comb_att_lnb' + suff)],
-                                     tparams[pp(prefix, 'W_comb_att_lns' + suff)])
-        pctxs__.append(extra_pctx1_ + pstates_[i][None, :, :])
-        # pctx__ += xc_
-        pctxs__[i] = tensor.tanh(pctxs__[i])
-        #pctxs__[i] = theano.printing.Print('Cc_')(pctxs__[i])
-
-        # multiply by weight vector
-        alphas.append(tensor.dot(pctxs__[i] * ctx_dropout[i][1], wn(pp(prefix, 'U_att' + suff))) +
-                      tparams[pp(prefix, 'c_tt' + suff)])
-
-        alphas[i] = alphas[i].reshape([alphas[i].shape[0], alphas[i].shape[1]])
-
-        # normalise
-        alphas[i] = tensor.exp(alphas[i] - alphas[i].max(0, keepdims=True))
-        if extra_context_mask1:
-            alphas[i] = alphas[i] * extra_context_mask1
-        alphas[i] = alphas[i] / alphas[i].sum(0, keepdims=True)
-        ctxs_.append((extra_cc1_ * alphas[i][:, :, None]).sum(0))  # current context
-        # ctxs_[i] = theano.printing.Print('Ctx')(ctxs_[i])
-        ctxs_[i].tag.test_value = numpy.ones(shape=(10, 48)).astype(floatX)
-
-        # 3
-        i = 2
-        # suffix for parameters
-        suff = str(i)
-
-        # calculate e_ij (here pctx__)
-        pstates_.append(tensor.dot(h1 * rec_dropout[2 + i], wn(pp(prefix, 'W_comb_att' + suff))))
-        if options['layer_normalisation']:
-            pstates_[i] = layer_norm(pstates_[i], tparams[pp(prefix, 'W_comb_att_lnb' + suff)],
-                                     tparams[pp(prefix, 'W_comb_att_lns' + suff)])
-        pctxs__.append(extra_pctx2_ + pstates_[i][None, :, :])
-        # pctx__ += xc_
-        pctxs__[i] = tensor.tanh(pctxs__[i])
-        #pctxs__[i] = theano.printing.Print('Cc_')(pctxs__[i])
-
-        # multiply by weight vector
-        alphas.append(tensor.dot(pctxs__[i] * ctx_dropout[i][1], wn(pp(prefix, 'U_att' + suff))) +
-                      tparams[pp(prefix, 'c_tt' + suff)])
-
-        alphas[i] = alphas[i].reshape([alphas[i].shape[0], alphas[i].shape[1]])
-
-        # normalise
-        alphas[i] = tensor.exp(alphas[i] - alphas[i].max(0, keepdims=True))
-        if extra_context_mask2:
-            alphas[i] = alphas[i] * extra_context_mask2
-        alphas[i] = alphas[i] / alphas[i].sum(0, keepdims=True)
-        ctxs_.append((extra_cc2_ * alphas[i][:, :, None]).sum(0))  # current context
-        # ctxs_[i] = theano.printing.Print('Ctx')(ctxs_[i])
-        ctxs_[i].tag.test_value = numpy.ones(shape=(10, 48)).astype(floatX)
-        # print ctxs_[i].tag.test_value.shape
-
-        # -------------- combine the resulting contexts --------------
-
-        if options['multisource_type'] == "att-hier":
-
-            logging.info("Doing multi-source with hierarchical attention")
-
-            # stack the contexts ready for hierarchical attention
-            stacked_ctx = tensor.stack(ctxs_)
-            # batch size 10, dimension 48, 3 contexts
-            #stacked_ctx.tag.test_value = numpy.ones(shape=(len(context), 10, 48)).astype(floatX)
-
-            # TODO: add ctx dropout
-            hier_alpha = tensor.dot(stacked_ctx, wn(pp(prefix, 'U_att-hier'))) + tparams[pp(prefix, 'c_tt-hier')]
-            hier_alpha.tag.test_value = numpy.ones(shape=(3, 10, 1)).astype(floatX)
-            hier_alpha = hier_alpha.reshape([hier_alpha.shape[0], hier_alpha.shape[1]])
-            hier_alpha= tensor.exp(hier_alpha - hier_alpha.max(0, keepdims=True))
-
-            #print(hier_alpha.tag.test_value.shape)
-
-            # normalise
-            hier_alpha = hier_alpha / hier_alpha.sum(0, keepdims=True)
-            # apply alpha
-            ctx_ = (ctxs_ * hier_alpha[:, :, None]).sum(0) # current context
-
-        else:
-            exit('Attention combination type not compatible with three sources: '+options['multisource_type']+'\n')
-            ctx_ = ctxs_[0]
-
-        # ------------------------ GRU 2 ------------------------
-        h2_prev = h1
-        for i in xrange(recurrence_transition_depth - 1):
-            suffix = '' if i == 0 else ('_drt_%s' % i)
-
-            # compute of r_j and z_j (reset and update activations)
-            preact2 = tensor.dot(h2_prev * rec_dropout[4 + 2 * i], wn(pp(prefix, 'U_nl' + suffix))) + tparams[
-                pp(prefix, 'b_nl' + suffix)]
-            if options['layer_normalisation']:
-                preact2 = layer_norm(preact2, tparams[pp(prefix, 'U_nl%s_lnb' % suffix)],
-                                     tparams[pp(prefix, 'U_nl%s_lns' % suffix)])
-            if i == 0:
-                if options['multisource_type'] == 'att-concat':
-
-                    # TODO: put dropout back somewhere
-                    ctx1_ = tensor.dot(ctx_ * ctx_dropout[0][2],
-                                       wn(pp(prefix, 'Wc' + suffix)))  # dropout mask is shared over mini-steps
-                else:
-                    ctx1_ = tensor.dot(ctx_ * ctx_dropout[0][2],
-                                       wn(pp(prefix, 'Wc' + suffix)))  # dropout mask is shared over mini-steps
+                ctx1_ = tensor.dot(ctx_ * ctx_dropout[0, 2],
+                                   wn(pp(prefix, 'Wc' + suffix)))  # dropout mask is shared over mini-steps
                 if options['layer_normalisation']:
                     ctx1_ = layer_norm(ctx1_, tparams[pp(prefix, 'Wc%s_lnb' % suffix)],
                                        tparams[pp(prefix, 'Wc%s_lns' % suffix)])
@@ -1405,7 +1007,7 @@ def tri_gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
             u2 = _slice(preact2, 1, dim)
 
             # proposed hidden state of the cGRU ^s_j
-            preactx2 = tensor.dot(h2_prev * rec_dropout[4 + 2 * i], wn(pp(prefix, 'Ux_nl' + suffix))) + \
+            preactx2 = tensor.dot(h2_prev * rec_dropout[2 + num_inputs + 2 * i], wn(pp(prefix, 'Ux_nl' + suffix))) + \
                        tparams[pp(prefix, 'bx_nl' + suffix)]
             if options['layer_normalisation']:
                 preactx2 = layer_norm(preactx2, tparams[pp(prefix, 'Ux_nl%s_lnb' % suffix)],
@@ -1414,15 +1016,8 @@ def tri_gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
 
             # they use the context vector from the attention mechanism
             if i == 0:
-                # TODO: put dropout back somewhere
-                if options['multisource_type'] == 'att-concat':
-                    #print(ctx_dropout[2].shape)
-                    ctx2_ = tensor.dot(ctx_ * ctx_dropout[0][3],
-                                       wn(pp(prefix, 'Wcx' + suffix)))  # dropout mask is shared over mini-steps
-
-                else:
-                    ctx2_ = tensor.dot(ctx_ * ctx_dropout[0][3],
-                                       wn(pp(prefix, 'Wcx' + suffix)))  # dropout mask is shared over mini-steps
+                ctx2_ = tensor.dot(ctx_ * ctx_dropout[0, 3],
+                                   wn(pp(prefix, 'Wcx' + suffix)))  # dropout mask is shared over mini-steps
                 if options['layer_normalisation']:
                     ctx2_ = layer_norm(ctx2_, tparams[pp(prefix, 'Wcx%s_lnb' % suffix)],
                                        tparams[pp(prefix, 'Wcx%s_lns' % suffix)])
@@ -1435,34 +1030,27 @@ def tri_gru_cond_layer(tparams, state_below, options, dropout, prefix='gru',
             h2 = m_[:, None] * h2 + (1. - m_)[:, None] * h2_prev
             h2_prev = h2
 
-        return h2, ctx_, alphas[0].T, alphas[1].T, alphas[2].T  # pstate_, preact, preactx, r, u
+        return h2, ctx_, alpha.dimshuffle(0, 2, 1)  # attention weights: #input x #sample x #annotation
 
     seqs = [mask, state_below_, state_belowx]
-    # seqs = [mask, state_below_, state_belowx, state_belowc]
     _step = _step_slice
 
-    shared_vars = []
+    non_sequences = [pctx, cc, masks, in_range, rec_dropout, ctx_dropout]
 
     if one_step:
-        rval = _step(*(
-            seqs + [init_state, None, None, None, None, pctx_, context, rec_dropout, ctx_dropout,
-                    extra_pctx1_, extra_pctx2_, extra_context1, extra_context2, ctx_dropout[1], ctx_dropout[2]] +
-            shared_vars))
+        rval = _step(*(seqs + [init_state, None, None] + non_sequences))
+        alphas = [rval[2][i, :, :contexts[i].shape[0]] for i in xrange(num_inputs)]
     else:
         rval, updates = theano.scan(_step,
                                     sequences=seqs,
                                     outputs_info=[init_state,
-                                                  tensor.zeros((n_samples, context.shape[2])),
-                                                  tensor.zeros((n_samples, context.shape[0])),
-                                                  tensor.zeros((n_samples, extra_context1.shape[0])),
-                                                  tensor.zeros((n_samples, extra_context2.shape[0]))
-                                                  ],
-                                    non_sequences=[pctx_, context, rec_dropout, ctx_dropout,
-                                                   extra_pctx1_, extra_pctx2_, extra_context1, extra_context2,
-                                                   ctx_dropout[1], ctx_dropout[2]] + shared_vars,
+                                                  tensor.zeros((n_samples, contexts[0].shape[2])),
+                                                  tensor.zeros((num_inputs, n_samples, max_len))],
+                                    non_sequences=non_sequences,
                                     name=pp(prefix, '_layers'),
                                     n_steps=nsteps,
                                     truncate_gradient=truncate_gradient,
                                     profile=profile,
                                     strict=False)
-    return rval
+        alphas = [rval[2][:, i, :, :contexts[i].shape[0]] for i in xrange(num_inputs)]
+    return [rval[0], rval[1]] + alphas
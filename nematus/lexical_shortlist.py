@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Vocabulary selection for decoding: restricts the output layer to a small set
+of candidate target words per batch, namely the most frequent target words
+plus the most likely translations of the source words according to a lexical
+table.
+
+The lexical table is built from a word-aligned training corpus (alignments in
+the 'i-j' format of fast_align or Moses) and the model's dictionaries; it is a
+JSON file mapping every source word to its translations, most likely first.
+"""
+
+import sys
+import json
+import argparse
+import logging
+
+from collections import defaultdict
+
+import numpy
+
+from util import load_dict
+
+
+def build_lexical_table(source, target, alignment, source_dict, target_dict,
+                        n_words_src=-1, n_words=-1, max_translations=100):
+    """
+    Counts aligned word pairs in the (tokenized, segmented) parallel corpus and
+    returns a dict from each source word to its @param max_translations most
+    likely target words according to p(target|source). Words outside of the
+    model vocabulary (as limited by @param n_words_src and @param n_words) are
+    ignored.
+    """
+    def in_vocab(word, dictionary, n_words):
+        return word in dictionary and (n_words < 0 or dictionary[word] < n_words)
+
+    counts = defaultdict(lambda: defaultdict(int))
+    for source_line, target_line, alignment_line in zip(source, target, alignment):
+        source_words = source_line.split()
+        target_words = target_line.split()
+        for link in alignment_line.split():
+            i, j = link.split('-')
+            # only the surface form (first factor) is used
+            source_word = source_words[int(i)].split('|')[0]
+            target_word = target_words[int(j)]
+            if in_vocab(source_word, source_dict, n_words_src) and in_vocab(target_word, target_dict, n_words):
+                counts[source_word][target_word] += 1
+
+    table = {}
+    for source_word, target_counts in counts.iteritems():
+        translations = sorted(target_counts, key=lambda w: (-target_counts[w], target_dict[w]))
+        table[source_word] = translations[:max_translations]
+    return table
+
+
+class LexicalShortlist(object):
+    """
+    Candidate target vocabularies for decoding, built from a lexical table.
+    """
+
+    def __init__(self, table_filename, source_dict, target_dict, n_words=-1,
+                 n_frequent=100, n_translations=100):
+        """
+        Loads the lexical table and maps it to ids with the model's source and
+        target dictionaries. Target ids are ordered by frequency (see
+        `data/build_dictionary.py`), so the @param n_frequent most frequent
+        words (including EOS and UNK) are the ids below @param n_frequent.
+        """
+        if n_words < 0:
+            n_words = max(target_dict.values()) + 1
+        self.n_words = n_words
+        self.frequent = numpy.arange(min(max(n_frequent, 2), n_words), dtype='int64')
+
+        with open(table_filename, 'rb') as f:
+            table = json.load(f)
+
+        self.translations = {}
+        for source_word, target_words in table.iteritems():
+            source_id = source_dict.get(source_word.encode('utf-8'))
+            if source_id is None:
+                continue
+            target_ids = [target_dict.get(w.encode('utf-8')) for w in target_words[:n_translations]]
+            target_ids = [i for i in target_ids if i is not None and i < n_words]
+            self.translations[source_id] = numpy.array(target_ids, dtype='int64')
+
+        logging.info('Loaded lexical shortlist for {0} source words'.format(len(self.translations)))
+
+    def get(self, seqs):
+        """
+        Returns the sorted candidate target ids for a batch of source
+        sequences, given as lists of (factored) word ids. The candidates are
+        shared by all sentences in a batch.
+        """
+        candidates = [self.frequent]
+        for seq in seqs:
+            for word in seq:
+                if word[0] in self.translations:
+                    candidates.append(self.translations[word[0]])
+        return numpy.unique(numpy.concatenate(candidates))
+
+
+def main(source, target, alignment, source_dict, target_dict, output,
+         n_words_src=-1, n_words=-1, max_translations=100):
+    source_dict = load_dict(source_dict)
+    target_dict = load_dict(target_dict)
+    table = build_lexical_table(source, target, alignment, source_dict, target_dict,
+                                n_words_src=n_words_src, n_words=n_words,
+                                max_translations=max_translations)
+    json.dump(table, output, indent=2, ensure_ascii=False)
+    logging.info('Wrote translations for {0} source words'.format(len(table)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a lexical table for vocabulary selection at decoding time")
+    parser.add_argument('--source', '-s', type=argparse.FileType('r'), required=True, metavar='PATH',
+                        help="Source side of the (preprocessed) training corpus")
+    parser.add_argument('--target', '-t', type=argparse.FileType('r'), required=True, metavar='PATH',
+                        help="Target side of the (preprocessed) training corpus")
+    parser.add_argument('--alignment', '-a', type=argparse.FileType('r'), required=True, metavar='PATH',
+                        help="Word alignment of the corpus, one line of 'i-j' links per sentence pair")
+    parser.add_argument('--dictionaries', type=str, nargs=2, required=True, metavar='PATH',
+                        help="Source and target dictionaries of the model")
+    parser.add_argument('--n_words_src', type=int, default=-1, metavar='INT',
+                        help="Source vocabulary size of the model (default: whole dictionary)")
+    parser.add_argument('--n_words', type=int, default=-1, metavar='INT',
+                        help="Target vocabulary size of the model (default: whole dictionary)")
+    parser.add_argument('--max-translations', type=int, default=100, metavar='INT',
+                        help="Number of translations to keep per source word (default: %(default)s)")
+    parser.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, metavar='PATH',
+                        help="Output file (default: standard output)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    main(args.source, args.target, args.alignment, args.dictionaries[0], args.dictionaries[1], args.output,
+         n_words_src=args.n_words_src, n_words=args.n_words, max_translations=args.max_translations)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Memory-mappable model format: a directory with one uncompressed `.npy` file
+per parameter and a JSON manifest. Unlike an `.npz` archive, parameters can
+be memory-mapped, so loading a model costs no copies (if the stored dtype is
+floatX) and processes that load the same model share its pages in the page
+cache. Only the parameters that are asked for are ever read; the optimizer
+state (`adam_*`) is not stored unless requested.
+
+Converts between `.npz` archives and model directories (the direction is
+given by the input); the model config `<model>.json` is copied along.
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import logging
+
+import numpy
+
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+
+# int8 parameters (see quantize.py) are stored with per-row scales under this suffix
+QSCALE_SUFFIX = '.qscale'
+
+
+def is_model_dir(path):
+    """
+    Returns whether @param path is a model directory.
+    """
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+class ModelDir(object):
+    """
+    Read access to a model directory, with the interface of `numpy.load`'s
+    `NpzFile` (`files`, `in`, `[name]`). Arrays are memory-mapped read-only.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST), 'rb') as f:
+            manifest = json.load(f)
+        if manifest.get('version', 0) > FORMAT_VERSION:
+            raise IOError('{0}: unsupported model directory version {1}'.format(path, manifest['version']))
+        self._files = dict((str(name), str(entry['file'])) for name, entry in manifest['params'].iteritems())
+        self.files = sorted(self._files)
+
+    def __contains__(self, name):
+        return name in self._files
+
+    def __getitem__(self, name):
+        return numpy.load(os.path.join(self.path, self._files[name]), mmap_mode='r')
+
+
+class Dequantized(object):
+    """
+    Read access to parameters that were stored as int8 with per-row scales:
+    they are returned as float32 arrays, and the scales are hidden.
+    """
+
+    def __init__(self, params):
+        self._params = params
+        self.files = [name for name in params.files if not name.endswith(QSCALE_SUFFIX)]
+        self._scaled = set(name[:-len(QSCALE_SUFFIX)] for name in params.files if name.endswith(QSCALE_SUFFIX))
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __getitem__(self, name):
+        value = self._params[name]
+        if name in self._scaled:
+            scale = self._params[name + QSCALE_SUFFIX]
+            value = value.astype('float32') * scale[:, None]
+        return value
+
+
+def open_params(path, dequantize=True):
+    """
+    Opens the parameters at @param path: a model directory or an `.npz`
+    archive (with or without the `.npz` suffix). Quantized parameters are
+    converted to float32 on access, unless @param dequantize is False.
+    """
+    if is_model_dir(path):
+        params = ModelDir(path)
+    else:
+        try:
+            params = numpy.load(path)
+        except IOError:
+            params = numpy.load(path + '.npz')
+    if dequantize and any(name.endswith(QSCALE_SUFFIX) for name in params.files):
+        params = Dequantized(params)
+    return params
+
+
+def save_model_dir(path, params):
+    """
+    Writes the arrays of dict @param params to the model directory @param
+    path.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    manifest = {'version': FORMAT_VERSION, 'params': {}}
+    for name in sorted(params):
+        value = numpy.asarray(params[name])
+        filename = name + '.npy'
+        numpy.save(os.path.join(path, filename), value)
+        manifest['params'][name] = {'file': filename, 'dtype': str(value.dtype), 'shape': list(value.shape)}
+    # the manifest marks the directory as complete, so write it last
+    with open(os.path.join(path, MANIFEST), 'wb') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def convert(source, target, keep_optimizer=False):
+    """
+    Converts the model @param source (archive or directory) to @param target
+    (the other format) and copies its config. Quantized parameters are kept
+    as they are.
+    """
+    params = open_params(source, dequantize=False)
+    names = [name for name in params.files
+             if name != 'zipped_params' and (keep_optimizer or not name.startswith('adam_'))]
+
+    if is_model_dir(source):
+        numpy.savez(target, **dict((name, params[name]) for name in names))
+    else:
+        save_model_dir(target, dict((name, params[name]) for name in names))
+    logging.info('Wrote {0} parameters to {1}'.format(len(names), target))
+
+    config = source + '.json'
+    if os.path.exists(config):
+        shutil.copyfile(config, target + '.json')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a model between an .npz archive and a memory-mappable model directory")
+    parser.add_argument('source', metavar='SOURCE',
+                        help="Model to convert (.npz archive or model directory)")
+    parser.add_argument('target', metavar='TARGET',
+                        help="Output path (model directory for an archive, and vice versa)")
+    parser.add_argument('--keep-optimizer', action="store_true",
+                        help="Also convert the optimizer state (adam_*), e.g. to continue training")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    if not is_model_dir(args.source) and not os.path.exists(args.source):
+        sys.stderr.write('Error: model {0} not found\n'.format(args.source))
+        sys.exit(1)
+    convert(args.source, args.target, keep_optimizer=args.keep_optimizer)
@@ -145,6 +145,23 @@ def prepare_multi_data(seqs_xs, seqs_y, maxlen=None, n_words_src=[30000], n_word
     return xs, x_masks, y, y_mask
 
 
+# batch preparation for decoding
+# source sequences are lists of factored words and already end in EOS
+def prepare_sample_data(seqs_x, n_factors=1):
+    lengths_x = [len(s) for s in seqs_x]
+
+    n_samples = len(seqs_x)
+    maxlen_x = numpy.max(lengths_x)
+
+    x = numpy.zeros((n_factors, maxlen_x, n_samples)).astype('int64')
+    x_mask = numpy.zeros((maxlen_x, n_samples)).astype(floatX)
+    for idx, s_x in enumerate(seqs_x):
+        x[:, :lengths_x[idx], idx] = zip(*s_x)
+        x_mask[:lengths_x[idx], idx] = 1.
+
+    return x, x_mask
+
+
 # initialize all parameters
 def init_params(options):
     params = OrderedDict()
@@ -212,26 +229,14 @@ def init_params(options):
 
     # --------------- DECODER ---------------
     # use a multi-cGRU if multi-source is used
-    if options['multisource_type'] is not None and len(options['extra_sources']) == 1:
-        params = get_layer_param('bi_gru_cond')(options,
-                                                params,
-                                                prefix='decoder',
-                                                nin=options['dim_word'],
-                                                dim=options['dim'],
-                                                dimctx=ctxdims,
-                                                recurrence_transition_depth=options['dec_base_recurrence_transition_depth'])
-    elif len(options['extra_sources']) == 2:
-        assert options['multisource_type'] == 'att-hier'
-
-        logging.info("Building a model with 3 inputs")
-        params = get_layer_param('tri_gru_cond')(options,
-                                                params,
-                                                prefix='decoder',
-                                                nin=options['dim_word'],
-                                                dim=options['dim'],
-                                                dimctx=ctxdims,
-                                                recurrence_transition_depth=options['dec_base_recurrence_transition_depth'])
-
+    if options['multisource_type'] is not None and len(options['extra_sources']) > 0:
+        params = get_layer_param('multi_gru_cond')(options,
+                                                   params,
+                                                   prefix='decoder',
+                                                   nin=options['dim_word'],
+                                                   dim=options['dim'],
+                                                   dimctx=ctxdims,
+                                                   recurrence_transition_depth=options['dec_base_recurrence_transition_depth'])
     else:
         params = get_layer_param(options['decoder'])(options, params,
                                                      prefix='decoder',
@@ -382,7 +387,8 @@ def build_encoder(tparams, options, dropout, x_mask=None, sampling=False, suffix
 
 # RNN decoder (including embedding and feedforward layer before output)
 def build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=None, y_mask=None,
-                  sampling=False, pctx_=None, shared_vars=None, extra_x_masks=[], extra_ctxs=[], extra_pctxs_=[]):
+                  sampling=False, pctx_=None, shared_vars=None, extra_x_masks=[], extra_ctxs=[], extra_pctxs_=[],
+                  shortlist=None):
     opt_ret = dict()
 
     # multi-source: number of total encoders
@@ -428,13 +434,29 @@ def build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=None, y_
         emb_shifted = tensor.set_subtensor(emb_shifted[1:], emb[:-1])
         emb = emb_shifted
 
+    # inference models prepared with projection tables (see prepare_model.py) look up the
+    # projections of the previous word by the decoder's input matrices instead of computing them
+    # (an inference-only option, so training configs do not have it)
+    if options.get('decoder_projection_tables', False):
+        if sampling:
+            y_prev = y
+        else:
+            y_prev = tensor.concatenate([-tensor.ones_like(y[:1]), y[:-1]])
+        first = tensor.shape_padright(y_prev) < 0
+        projected_below = []
+        for table, bias in [('W_emb_table', 'b'), ('Wx_emb_table', 'bx')]:
+            proj = tparams[pp('decoder', table)][tensor.maximum(y_prev, 0)]
+            projected_below.append(tensor.switch(first, tparams[pp('decoder', bias)], proj))
+    else:
+        projected_below = None
+
     # decoder - pass through the decoder conditional gru with attention
-    if options['multisource_type'] not in (None, 'init-decoder') and num_encoders == 2:
-        proj = get_layer_constr('bi_gru_cond')(tparams, emb, options, dropout,
+    if options['multisource_type'] not in (None, 'init-decoder') and num_encoders > 1:
+        proj = get_layer_constr('multi_gru_cond')(tparams, emb, options, dropout,
                                                   prefix='decoder',
-                                                  mask=y_mask, context=ctx,
-                                                  context_mask=x_mask,
-                                                  pctx_=pctx_,
+                                                  mask=y_mask, contexts=[ctx] + extra_ctxs,
+                                                  context_masks=[x_mask] + extra_x_masks,
+                                                  pctxs_=[pctx_] + extra_pctxs_,
                                                   one_step=one_step,
                                                   init_state=init_state[0],
                                                   recurrence_transition_depth=options['dec_base_recurrence_transition_depth'],
@@ -443,28 +465,7 @@ def build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=None, y_
                                                   dropout_probability_rec=options['dropout_hidden'],
                                                   truncate_gradient=options['decoder_truncate_gradient'],
                                                   profile=profile,
-                                                  extra_context=extra_ctxs[0],
-                                                  extra_context_mask=extra_x_masks[0],
-                                                  extra_pctx_=extra_pctxs_[0])
-
-    elif num_encoders == 3:
-        assert options['multisource_type'] == 'att-hier', 'The attention combination is not compatible with 3 inputs'
-        proj = get_layer_constr('tri_gru_cond')(tparams, emb, options, dropout,
-                                               prefix='decoder',
-                                               mask=y_mask, context=ctx,
-                                               context_mask=x_mask,
-                                               pctx_=pctx_,
-                                               one_step=one_step,
-                                               init_state=init_state[0],
-                                               recurrence_transition_depth=options['dec_base_recurrence_transition_depth'],
-                                               dropout_probability_below=options['dropout_embedding'],
-                                               dropout_probability_ctx=options['dropout_hidden'],
-                                               dropout_probability_rec=options['dropout_hidden'],
-                                               truncate_gradient=options['decoder_truncate_gradient'],
-                                               profile=profile,
-                                               extra_context1=extra_ctxs[0], extra_context2=extra_ctxs[1],
-                                               extra_context_mask1=extra_x_masks[0], extra_context_mask2=extra_x_masks[1],
-                                               extra_pctx1_=extra_pctxs_[0], extra_pctx2_=extra_pctxs_[1])
+                                                  projected_below=projected_below)
 
     else:
 
@@ -482,7 +483,8 @@ def build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=None, y_
                                                     dropout_probability_ctx=options['dropout_hidden'],
                                                     dropout_probability_rec=options['dropout_hidden'],
                                                     truncate_gradient=options['decoder_truncate_gradient'],
-                                                    profile=profile)
+                                                    profile=profile,
+                                                    projected_below=projected_below)
     # hidden states of the decoder gru
     next_state = proj[0]
 
@@ -518,12 +520,12 @@ def build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=None, y_
                 input_ = next_state
 
             if options['multisource_type'] not in (None, 'init-decoder'):
-                out_state = get_layer_constr('bi_gru_cond')(tparams, input_, options, dropout,
+                out_state = get_layer_constr('multi_gru_cond')(tparams, input_, options, dropout,
                                                                prefix=pp('decoder', level),
                                                                mask=y_mask,
-                                                               context=ctx,
-                                                               context_mask=x_mask,
-                                                               pctx_=None,
+                                                               contexts=[ctx] + extra_ctxs,
+                                                               context_masks=[x_mask] + extra_x_masks,
+                                                               pctxs_=None,
                                                                # TODO: we can speed up sampler by precomputing this
                                                                one_step=one_step,
                                                                init_state=init_state[level - 1],
@@ -532,10 +534,7 @@ def build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=None, y_
                                                                recurrence_transition_depth=options[
                                                                    'dec_high_recurrence_transition_depth'],
                                                                truncate_gradient=options['decoder_truncate_gradient'],
-                                                               profile=profile,
-                                                               aux_context=extra_ctxs,
-                                                               aux_context_mask=extra_x_masks,
-                                                               extra_pctxs_=extra_pctxs_)[0]
+                                                               profile=profile)[0]
             else:
                 out_state = get_layer_constr(options['decoder_deep'])(tparams, input_, options, dropout,
                                                                       prefix=pp('decoder', level),
@@ -582,9 +581,17 @@ def build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=None, y_
 
     # last layer
     logit_W = tparams['Wemb' + decoder_embedding_suffix].T if options['tie_decoder_embeddings'] else None
+    logit_b = None
+    # vocabulary selection: only compute logits for the target ids in the shortlist
+    if shortlist is not None:
+        if options['tie_decoder_embeddings']:
+            logit_W = tparams['Wemb' + decoder_embedding_suffix][shortlist].T
+        else:
+            logit_W = tparams[pp('ff_logit', 'W')][:, shortlist]
+        logit_b = tparams[pp('ff_logit', 'b')][shortlist]
     logit = get_layer_constr('ff')(tparams, logit, options, dropout,
                                    dropout_probability=options['dropout_hidden'],
-                                   prefix='ff_logit', activ='linear', W=logit_W, followed_by_softmax=True)
+                                   prefix='ff_logit', activ='linear', W=logit_W, b=logit_b, followed_by_softmax=True)
 
     return logit, opt_ret, ret_state
 
@@ -742,30 +749,38 @@ def build_multisource_model(tparams, options):
     return trng, use_noise, xs, x_masks, y, y_mask, opt_ret, cost
 
 
-# build a multi-sampler
-def build_multi_sampler(tparams, options, use_noise, trng, return_alignment=False):
-    # potentially multiple inputs, stored in 'encoders'
+# project the encoder context(s) for the attention of the first decoder layer.
+# This is what the conditional GRU layers compute when no pctx_ is given
+# (layer normalisation, if any, is still applied inside the layer), so
+# samplers can do it once per sentence instead of once per decoding step.
+def build_pctxs(tparams, options, dropout, ctxs):
 
-    num_encoders = len(options['extra_sources']) + 1
+    # utility function to look up parameters and apply weight normalization if enabled
+    def wn(param_name):
+        param = tparams[param_name]
+        if options['weight_normalisation']:
+            return weight_norm(param, tparams[param_name + '_wns'])
+        else:
+            return param
 
-    dropout = dropout_constr(options, use_noise, trng, sampling=True)
+    # multi-source attention layers number their parameters by input
+    if options['multisource_type'] not in (None, 'init-decoder'):
+        suffixes = [str(i) for i in range(len(ctxs))]
+    else:
+        suffixes = ['']
 
-    xs = [[]] * num_encoders
-    ctxs = [[]] * num_encoders
-    ctx_means = [[]] * num_encoders
+    pctxs = []
+    for ctx, suff in zip(ctxs, suffixes):
+        pctxs.append(tensor.dot(ctx * dropout(dropout_probability=options['dropout_hidden']),
+                                wn(pp('decoder', 'Wc_att' + suff))) + tparams[pp('decoder', 'b_att' + suff)])
+    return pctxs
 
-    # build each of the encoders (first is main one and following ones are auxiliary ones)
-    for i in range(num_encoders):
-        if num_encoders==1:
-            suff=''
-        else:
-            suff = str(i)
 
-        xs[i], ctxs[i] = build_encoder(tparams, options, dropout, x_mask=None, sampling=True, suffix=suff)
-        n_samples = xs[i].shape[2]
-        # get the input for decoder rnn initializer mlp
-        ctx_means[i] = ctxs[i].mean(0)
-        # ctx_mean = concatenate([proj[0][-1],projr[0][-1]], axis=proj[0].ndim-2)
+# initial decoder state (layers x sentences x dim) of a multi-source sampler,
+# computed from the contexts (and masks) of all inputs
+def build_multi_init_state(tparams, options, dropout, ctxs, x_masks):
+    # get the input for decoder rnn initializer mlp
+    ctx_means = [(ctx * x_mask[:, :, None]).sum(0) / x_mask.sum(0)[:, None] for ctx, x_mask in zip(ctxs, x_masks)]
 
     # combine the contexts for initialisation by mean of context
     if options['multisource_type'] == 'init-decoder':
@@ -782,11 +797,88 @@ def build_multi_sampler(tparams, options, use_noise, trng, return_alignment=Fals
     init_state = init_state.reshape([1, init_state.shape[0], init_state.shape[1]])
     if options['dec_depth'] > 1:
         init_state = tensor.tile(init_state, (options['dec_depth'], 1, 1))
+    return init_state
+
+
+# build one function per encoder of a multi-source model, which returns the
+# context of its input (f_encode(x, x_mask)), and one function that returns
+# the initial state and the projected contexts given the contexts of all
+# inputs (f_init_state(ctx_1, x_mask_1, ctx_2, ...)). Together, they return
+# what f_init of build_multi_sampler returns, but every input can be encoded
+# on its own, e.g. to reuse the context of a sentence encoded before.
+def build_multi_encoders(tparams, options, use_noise, trng):
+    num_encoders = len(options['extra_sources']) + 1
+
+    dropout = dropout_constr(options, use_noise, trng, sampling=True)
+
+    fs_encode = []
+    ctxs = []
+    x_masks = []
+    for i in range(num_encoders):
+        suff = '' if num_encoders == 1 else str(i)
+        x_mask = tensor.matrix('x_mask' + suff, dtype=floatX)
+        x, ctx = build_encoder(tparams, options, dropout, x_mask=x_mask, sampling=True, suffix=suff)
+        logging.info('Building f_encode{0}...'.format(suff))
+        fs_encode.append(theano.function([x, x_mask], ctx, name='f_encode' + suff, profile=profile))
+        logging.info('Done')
+
+        ctxs.append(tensor.tensor3('ctx' + suff, dtype=floatX))
+        x_masks.append(tensor.matrix('x_mask' + suff, dtype=floatX))
+
+    init_state = build_multi_init_state(tparams, options, dropout, ctxs, x_masks)
+    pctxs = build_pctxs(tparams, options, dropout, ctxs)
+
+    init_inps = []
+    for ctx, x_mask in zip(ctxs, x_masks):
+        init_inps.extend([ctx, x_mask])
+    logging.info('Building f_init_state...')
+    f_init_state = theano.function(init_inps, [init_state] + pctxs, name='f_init_state', profile=profile,
+                                   on_unused_input='ignore')
+    logging.info('Done')
+
+    return fs_encode, f_init_state
+
+
+# build a multi-sampler
+# (with symbolic, the inputs and outputs of f_init and f_next are returned
+# instead, together with the f_next inputs that do not depend on the model;
+# see build_ensemble_sampler)
+def build_multi_sampler(tparams, options, use_noise, trng, return_alignment=False, shortlist=False,
+                        log_probs=False, symbolic=False):
+    # potentially multiple inputs, stored in 'encoders'
+
+    num_encoders = len(options['extra_sources']) + 1
+
+    dropout = dropout_constr(options, use_noise, trng, sampling=True)
+
+    xs = [[]] * num_encoders
+    x_masks = [[]] * num_encoders
+    ctxs = [[]] * num_encoders
+
+    # build each of the encoders (first is main one and following ones are auxiliary ones)
+    for i in range(num_encoders):
+        if num_encoders==1:
+            suff=''
+        else:
+            suff = str(i)
+
+        x_masks[i] = tensor.matrix('x_mask' + suff, dtype=floatX)
+        x_masks[i].tag.test_value = numpy.ones(shape=(5, 10)).astype(floatX)
+
+        xs[i], ctxs[i] = build_encoder(tparams, options, dropout, x_mask=x_masks[i], sampling=True, suffix=suff)
+
+    init_state = build_multi_init_state(tparams, options, dropout, ctxs, x_masks)
 
     logging.info('Building f_init...')
-    inps = xs
-    outs = [init_state] + ctxs
-    f_init = theano.function(inps, outs, name='f_init', profile=profile)
+    # projected contexts (only the main one for init-decoder)
+    pctxs = build_pctxs(tparams, options, dropout, ctxs)
+
+    init_inps = []
+    for x, x_mask in zip(xs, x_masks):
+        init_inps.extend([x, x_mask])
+    init_outs = [init_state] + ctxs + pctxs
+    if not symbolic:
+        f_init = theano.function(init_inps, init_outs, name='f_init', profile=profile)
     logging.info('Done')
 
     # x: 1 x 1
@@ -797,9 +889,22 @@ def build_multi_sampler(tparams, options, use_noise, trng, return_alignment=Fals
     if theano.config.compute_test_value != 'off':
         init_state.tag.test_value = numpy.random.rand(*init_state_old.tag.test_value.shape).astype(floatX)
 
-    logit, opt_ret, ret_state = build_decoder(tparams, options, y, ctxs[0], init_state, dropout,
-                                              x_mask=None, y_mask=None, sampling=True,
-                                              extra_x_masks=[], extra_ctxs=ctxs[1:])
+    # f_next gets one context per sentence; each hypothesis picks the one of its sentence
+    sentence_idx = tensor.vector('sentence_idx', dtype='int64')
+    sentence_idx.tag.test_value = numpy.zeros((10,)).astype('int64')
+    hyp_ctxs = [ctx[:, sentence_idx] for ctx in ctxs]
+    hyp_pctxs = [pctx[:, sentence_idx] for pctx in pctxs]
+    hyp_x_masks = [x_mask[:, sentence_idx] for x_mask in x_masks]
+    hyp_pctxs += [None] * (num_encoders - len(hyp_pctxs))
+
+    # optional candidate target ids; next_probs are then over the shortlist only
+    shortlist_ids = tensor.vector('shortlist', dtype='int64') if shortlist else None
+
+    logit, opt_ret, ret_state = build_decoder(tparams, options, y, hyp_ctxs[0], init_state, dropout,
+                                              x_mask=hyp_x_masks[0], y_mask=None, sampling=True,
+                                              pctx_=hyp_pctxs[0],
+                                              extra_x_masks=hyp_x_masks[1:], extra_ctxs=hyp_ctxs[1:],
+                                              extra_pctxs_=hyp_pctxs[1:], shortlist=shortlist_ids)
 
     # compute the softmax probability
     next_probs = tensor.nnet.softmax(logit)
@@ -807,15 +912,21 @@ def build_multi_sampler(tparams, options, use_noise, trng, return_alignment=Fals
     # sample from softmax distribution to get the sample
     next_sample = trng.multinomial(pvals=next_probs).argmax(1)
 
+    # optionally return log-probabilities (Theano rewrites this into a stable log-softmax)
+    if log_probs:
+        next_probs = tensor.log(next_probs)
+
     # compile a function to do the whole thing above, next word probability,
     # sampled word for the next target, next hidden state to be used
 
     logging.info('Building f_next...')
 
     if options['multisource_type'] == 'init-decoder':
-        inps = [y, ctxs[0], init_state]
+        inps = [y, ctxs[0], pctxs[0], x_masks[0], sentence_idx, init_state]
     else:
-        inps = [y] + ctxs + [init_state]
+        inps = [y] + ctxs + pctxs + x_masks + [sentence_idx, init_state]
+    if shortlist:
+        inps.append(shortlist_ids)
     outs = [next_probs, next_sample, ret_state]
 
     if return_alignment:
@@ -823,21 +934,28 @@ def build_multi_sampler(tparams, options, use_noise, trng, return_alignment=Fals
             if 'dec_alphas' + str(i) in opt_ret:
                 outs.append(opt_ret['dec_alphas' + str(i)])
 
+    if symbolic:
+        return init_inps, init_outs, inps, outs, [y, sentence_idx] + ([shortlist_ids] if shortlist else [])
+
     f_next = theano.function(inps, outs, name='f_next', profile=profile, on_unused_input='warn')
     logging.info('Done')
 
     return f_init, f_next
 
 
-# build a sampler
-def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
+# build a sampler (see build_multi_sampler for symbolic)
+def build_sampler(tparams, options, use_noise, trng, return_alignment=False, shortlist=False,
+                  log_probs=False, symbolic=False):
     dropout = dropout_constr(options, use_noise, trng, sampling=True)
 
-    x, ctx = build_encoder(tparams, options, dropout, x_mask=None, sampling=True)
+    x_mask = tensor.matrix('x_mask', dtype=floatX)
+    x_mask.tag.test_value = numpy.ones(shape=(5, 10)).astype(floatX)
+
+    x, ctx = build_encoder(tparams, options, dropout, x_mask=x_mask, sampling=True)
     n_samples = x.shape[2]
 
     # get the input for decoder rnn initializer mlp
-    ctx_mean = ctx.mean(0)
+    ctx_mean = (ctx * x_mask[:, :, None]).sum(0) / x_mask.sum(0)[:, None]
     # ctx_mean = concatenate([proj[0][-1],projr[0][-1]], axis=proj[0].ndim-2)
 
     init_state = get_layer_constr('ff')(tparams, ctx_mean, options, dropout,
@@ -849,9 +967,14 @@ def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
     if options['dec_depth'] > 1:
         init_state = tensor.tile(init_state, (options['dec_depth'], 1, 1))
 
+    # projected context
+    pctx = build_pctxs(tparams, options, dropout, [ctx])[0]
+
     logging.info('Building f_init...')
-    outs = [init_state, ctx]
-    f_init = theano.function([x], outs, name='f_init', profile=profile)
+    init_inps = [x, x_mask]
+    init_outs = [init_state, ctx, pctx]
+    if not symbolic:
+        f_init = theano.function(init_inps, init_outs, name='f_init', profile=profile)
     logging.info('Done')
 
     # x: 1 x 1
@@ -862,8 +985,16 @@ def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
     if theano.config.compute_test_value != 'off':
         init_state.tag.test_value = numpy.random.rand(*init_state_old.tag.test_value.shape).astype(floatX)
 
-    logit, opt_ret, ret_state = build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=None, y_mask=None,
-                                              sampling=True)
+    # f_next gets one context per sentence; each hypothesis picks the one of its sentence
+    sentence_idx = tensor.vector('sentence_idx', dtype='int64')
+    sentence_idx.tag.test_value = numpy.zeros((10,)).astype('int64')
+
+    # optional candidate target ids; next_probs are then over the shortlist only
+    shortlist_ids = tensor.vector('shortlist', dtype='int64') if shortlist else None
+
+    logit, opt_ret, ret_state = build_decoder(tparams, options, y, ctx[:, sentence_idx], init_state, dropout,
+                                              x_mask=x_mask[:, sentence_idx], y_mask=None, sampling=True,
+                                              pctx_=pctx[:, sentence_idx], shortlist=shortlist_ids)
 
     # compute the softmax probability
     next_probs = tensor.nnet.softmax(logit)
@@ -871,22 +1002,83 @@ def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
     # sample from softmax distribution to get the sample
     next_sample = trng.multinomial(pvals=next_probs).argmax(1)
 
+    # optionally return log-probabilities (Theano rewrites this into a stable log-softmax)
+    if log_probs:
+        next_probs = tensor.log(next_probs)
+
     # compile a function to do the whole thing above, next word probability,
     # sampled word for the next target, next hidden state to be used
     logging.info('Building f_next..')
-    inps = [y, ctx, init_state]
+    inps = [y, ctx, pctx, x_mask, sentence_idx, init_state]
+    if shortlist:
+        inps.append(shortlist_ids)
     outs = [next_probs, next_sample, ret_state]
 
     if return_alignment:
         for i in range(len(options['extra_sources'])+1):
             outs.append(opt_ret['dec_alphas'+str(i)])
 
+    if symbolic:
+        return init_inps, init_outs, inps, outs, [y, sentence_idx] + ([shortlist_ids] if shortlist else [])
+
     f_next = theano.function(inps, outs, name='f_next', profile=profile)
     logging.info('Done')
 
     return f_init, f_next
 
 
+# build one f_init and one f_next for an ensemble of models (with one
+# dictionary of parameters and options per model). The models share the
+# source inputs, the previous words, sentence_idx and the shortlist; each has
+# its own context, projected context and state inputs, in that order, after
+# the shared ones: f_next(y, x_masks, sentence_idx, [shortlist,]
+# ctxs_1, pctxs_1, init_state_1, ctxs_2, ...). init-decoder models only take
+# their main mask and context. f_init returns the outputs of each model's
+# f_init, one model after the other; f_next returns the sum of the models'
+# log-probabilities, their next states and (with return_alignment) the
+# attention weights averaged over the models.
+def build_ensemble_sampler(tparams_list, options_list, use_noise, trng, return_alignment=False, shortlist=False):
+
+    graphs = []
+    for tparams, options in zip(tparams_list, options_list):
+        builder = build_multi_sampler if options['multisource_type'] is not None else build_sampler
+        graphs.append(builder(tparams, options, use_noise, trng, return_alignment=return_alignment,
+                              shortlist=shortlist, log_probs=True, symbolic=True))
+
+    # make all models read the inputs of the first one
+    init_inps, _, _, _, shared_inps = graphs[0]
+    init_outs = []
+    next_outs = []
+    private_inps = []
+    for g_init_inps, g_init_outs, g_next_inps, g_next_outs, g_shared_inps in graphs:
+        shared_ids = set(id(v) for v in g_init_inps + g_shared_inps)
+        g_private_inps = [v for v in g_next_inps if id(v) not in shared_ids]
+        replace = zip(g_init_inps + g_shared_inps, init_inps + shared_inps)
+        init_outs.extend(theano.clone(g_init_outs, replace=replace))
+        # the contexts are computed by f_init, but are inputs of f_next
+        next_outs.append(theano.clone(g_next_outs, replace=replace + [(v, v) for v in g_private_inps]))
+        private_inps.extend(g_private_inps)
+
+    # next_probs, next_sample, next_state, attention weights
+    log_probs = sum(outs[0] for outs in next_outs)
+    states = [outs[2] for outs in next_outs]
+    alphas = [sum(alpha) / len(next_outs) for alpha in zip(*[outs[3:] for outs in next_outs])]
+
+    # masks of the inputs the models attend to (only the main input for init-decoder)
+    next_shared_ids = set(id(v) for v in graphs[0][2])
+    masks = [v for v in init_inps[1::2] if id(v) in next_shared_ids]
+
+    logging.info('Building ensemble f_init...')
+    f_init = theano.function(init_inps, init_outs, name='f_init', profile=profile)
+    logging.info('Building ensemble f_next...')
+    inps = shared_inps[:1] + masks + shared_inps[1:] + private_inps
+    f_next = theano.function(inps, [log_probs] + states + alphas, name='f_next', profile=profile,
+                             on_unused_input='warn')
+    logging.info('Done')
+
+    return f_init, f_next
+
+
 # minimum risk cost
 # assumes cost is the negative sentence-level log probability
 # and each sentence in the minibatch is a sample of the same source sentence
@@ -965,8 +1157,7 @@ def build_full_sampler(tparams, options, use_noise, trng, greedy=False):
 
     # projected context
     assert ctx.ndim == 3, 'Context must be 3-d: #annotation x #sample x dim'
-    pctx_ = tensor.dot(ctx * dropout(dropout_probability=options['dropout_hidden']), tparams[pp('decoder', 'Wc_att')]) + \
-            tparams[pp('decoder', 'b_att')]
+    pctx_ = build_pctxs(tparams, options, dropout, [ctx])[0]
 
     def decoder_step(y, init_state, ctx, pctx_, *shared_vars):
 
@@ -998,16 +1189,10 @@ def build_full_sampler(tparams, options, use_noise, trng, greedy=False):
 
     shared_vars = []
     for prefix in decoder_prefixes:
-        shared_vars.extend([tparams[pp(prefix, 'U')],
-                            tparams[pp(prefix, 'Wc')],
-                            tparams[pp(prefix, 'U_att')],
-                            tparams[pp(prefix, 'c_tt')],
-                            tparams[pp(prefix, 'Ux')],
-                            tparams[pp(prefix, 'Wcx')],
-                            tparams[pp(prefix, 'U_nl')],
-                            tparams[pp(prefix, 'Ux_nl')],
-                            tparams[pp(prefix, 'b_nl')],
-                            tparams[pp(prefix, 'bx_nl')]])
+        # deeper decoder layers are plain GRUs without attention parameters
+        shared_vars.extend([tparams[pp(prefix, name)] for name in ['U', 'Wc', 'U_att', 'c_tt', 'Ux', 'Wcx',
+                                                                   'U_nl', 'Ux_nl', 'b_nl', 'bx_nl']
+                            if pp(prefix, name) in tparams])
 
         if options['multisource_type'] == 'att-gate' or options['multisource_type'] == 'att-gate2':
             shared_vars.append(tparams[pp(prefix, 'W_comb_att')])
@@ -1047,39 +1232,34 @@ def gen_sample(f_init, f_next, x, trng=None, k=1, maxlen=30,
             'Beam search does not support stochastic sampling with argmax'
 
     # collapse inputs to one list for ease of looping
-    if len(extra_xs) == 0:
-        xs = [x]
-    else:
-        xs = [x] + extra_xs
+    xs = [x] + extra_xs
+
+    # a single sentence needs no padding
+    x_masks = [numpy.ones(x_.shape[1:]).astype(floatX) for x_ in xs]
 
-    assert len(xs) <= 3, 'Only accepting up to 2 extra sources for now'
+    # beam search is a batch of size one
+    if not stochastic:
+        return gen_sample_batch(f_init, f_next, xs, x_masks, trng=trng, k=k, maxlen=maxlen,
+                                return_alignment=return_alignment, suppress_unk=suppress_unk,
+                                return_hyp_graph=return_hyp_graph, init_decoder=init_decoder)[0]
 
     sample = []
     sample_score = []
     sample_word_probs = []
     alignments = [[] for _ in xs] # list for multi-source
     hyp_graph = None
-    if stochastic:
-        if argmax:
-            sample_score = 0
-        live_k = k
-    else:
-        live_k = 1
+    if argmax:
+        sample_score = 0
+    live_k = k
 
     if return_hyp_graph:
         from hypgraph import HypGraph
         hyp_graph = HypGraph()
 
-    dead_k = 0
-
     hyp_samples = [[] for i in xrange(live_k)]
     word_probs = [[] for i in xrange(live_k)]
     hyp_scores = numpy.zeros(live_k).astype(floatX)
     hyp_states = []
-    if return_alignment:
-        hyp_alignment = [] # list for multi-source
-        for _ in xs:
-            hyp_alignment.append([[] for _ in xrange(live_k)])
 
     # for ensemble decoding, we keep track of states and probability distribution
     # for each model in the ensemble
@@ -1087,20 +1267,15 @@ def gen_sample(f_init, f_next, x, trng=None, k=1, maxlen=30,
     next_state = [None] * num_models
     next_p = [None] * num_models
 
-    # multi-source (at least 2 attention mechanisms)
-    ctx = [] # list for multi-source
-    dec_alphas = [] # list for multi-source
-    for _ in xs:
-        ctx.append([None] * num_models)
-        if not init_decoder:
-            dec_alphas.append([None] * num_models)
-
-    if init_decoder:
-        dec_alphas = [[[None] * num_models]]
+    # encoder context and projected context of each model, per input
+    ctx = [None] * num_models
+    pctx = [None] * num_models
 
     # get initial state of decoder rnn and encoder context
     for i in xrange(num_models):
-        inps = xs
+        inps = []
+        for x_, x_mask in zip(xs, x_masks):
+            inps.extend([x_, x_mask])
 
         ret = f_init[i](*inps)
 
@@ -1109,179 +1284,78 @@ def gen_sample(f_init, f_next, x, trng=None, k=1, maxlen=30,
 
         next_state[i] = numpy.tile(ret[0], (live_k, 1, 1))
 
-        # assign each output to ctx
-        for inputnum in range(len(xs)):
-            ctx[inputnum][i] = ret[inputnum+1]
+        ctx[i] = ret[1:len(xs)+1]
+        pctx[i] = ret[len(xs)+1:]
 
     next_w = -1 * numpy.ones((live_k,)).astype('int64')  # bos indicator
 
     # x is a sequence of word ids followed by 0, eos id
     for ii in xrange(maxlen):
+        # all samples share the context of the single source sentence
+        sentence_idx = numpy.zeros((live_k,)).astype('int64')
         for i in xrange(num_models):
-            ctxs = []
-            for inputnum in range(len(xs)):
-                ctxs.append(numpy.tile(ctx[inputnum][i], [live_k, 1]))
-
             # for theano function, go from (batch_size, layers, dim) to (layers, batch_size, dim)
             next_state[i] = numpy.transpose(next_state[i], (1, 0, 2))
 
             if init_decoder:
-                inps = [next_w, ctxs[0], next_state[i]]
+                inps = [next_w, ctx[i][0], pctx[i][0], x_masks[0], sentence_idx, next_state[i]]
             else:
-                inps = [next_w] + ctxs + [next_state[i]]
+                inps = [next_w] + ctx[i] + pctx[i] + x_masks + [sentence_idx, next_state[i]]
 
             ret = f_next[i](*inps)
 
-            # TODO: do multi-souce from here!
-            # dimension of dec_alpha (k-beam-size, number-of-input-hidden-units)
             next_p[i], next_w_tmp, next_state[i] = ret[0], ret[1], ret[2]
-            if return_alignment:
-                for inputnum in range(len(xs)):
-                    dec_alphas[inputnum][i] = ret[3 + inputnum]
 
             # to more easily manipulate batch size, go from (layers, batch_size, dim) to (batch_size, layers, dim)
             next_state[i] = numpy.transpose(next_state[i], (1, 0, 2))
 
             if suppress_unk:
                 next_p[i][:, 1] = -numpy.inf
-        if stochastic:
-            # batches are not supported with argmax: output data structure is different
-            if argmax:
-                nw = sum(next_p)[0].argmax()
-                sample.append(nw)
-                sample_score += numpy.log(next_p[0][0, nw])
-                if nw == 0:
-                    break
-            else:
-                # FIXME: sampling is currently performed according to the last model only
-                nws = next_w_tmp
-                cand_scores = numpy.array(hyp_scores)[:, None] - numpy.log(next_p[-1])
-                probs = next_p[-1]
-
-                for idx, nw in enumerate(nws):
-                    hyp_samples[idx].append(nw)
-
-                hyp_states = []
-                for ti in xrange(live_k):
-                    hyp_states.append([copy.copy(next_state[i][ti]) for i in xrange(num_models)])
-                    hyp_scores[ti] = cand_scores[ti][nws[ti]]
-                    word_probs[ti].append(probs[ti][nws[ti]])
-
-                new_hyp_states = []
-                new_hyp_samples = []
-                new_hyp_scores = []
-                new_word_probs = []
-                for hyp_sample, hyp_state, hyp_score, hyp_word_prob in zip(hyp_samples, hyp_states, hyp_scores,
-                                                                           word_probs):
-                    if hyp_sample[-1] > 0:
-                        new_hyp_samples.append(copy.copy(hyp_sample))
-                        new_hyp_states.append(copy.copy(hyp_state))
-                        new_hyp_scores.append(hyp_score)
-                        new_word_probs.append(hyp_word_prob)
-                    else:
-                        sample.append(copy.copy(hyp_sample))
-                        sample_score.append(hyp_score)
-                        sample_word_probs.append(hyp_word_prob)
-
-                hyp_samples = new_hyp_samples
-                hyp_states = new_hyp_states
-                hyp_scores = new_hyp_scores
-                word_probs = new_word_probs
-
-                live_k = len(hyp_samples)
-                if live_k < 1:
-                    break
-
-                next_w = numpy.array([w[-1] for w in hyp_samples])
-                next_state = [numpy.array(state) for state in zip(*hyp_states)]
+        # batches are not supported with argmax: output data structure is different
+        if argmax:
+            nw = sum(next_p)[0].argmax()
+            sample.append(nw)
+            sample_score += numpy.log(next_p[0][0, nw])
+            if nw == 0:
+                break
         else:
-            cand_scores = hyp_scores[:, None] - sum(numpy.log(next_p))
-            probs = sum(next_p) / num_models
-            cand_flat = cand_scores.flatten()
-            probs_flat = probs.flatten()
-            ranks_flat = cand_flat.argpartition(k - dead_k - 1)[:(k - dead_k)]
+            # FIXME: sampling is currently performed according to the last model only
+            nws = next_w_tmp
+            cand_scores = numpy.array(hyp_scores)[:, None] - numpy.log(next_p[-1])
+            probs = next_p[-1]
 
-            # averaging the attention weights accross models
-            if return_alignment:
-                mean_alignment = []
-                for inputnum in range(len(xs)):
-                    mean_alignment.append(sum(dec_alphas[inputnum]) / num_models)
+            for idx, nw in enumerate(nws):
+                hyp_samples[idx].append(nw)
 
-            voc_size = next_p[0].shape[1]
-            # index of each k-best hypothesis
-            trans_indices = ranks_flat / voc_size
-            word_indices = ranks_flat % voc_size
-            costs = cand_flat[ranks_flat]
+            hyp_states = []
+            for ti in xrange(live_k):
+                hyp_states.append([copy.copy(next_state[i][ti]) for i in xrange(num_models)])
+                hyp_scores[ti] = cand_scores[ti][nws[ti]]
+                word_probs[ti].append(probs[ti][nws[ti]])
 
+            new_hyp_states = []
             new_hyp_samples = []
-            new_hyp_scores = numpy.zeros(k - dead_k).astype(floatX)
+            new_hyp_scores = []
             new_word_probs = []
-            new_hyp_states = []
-
-            # TODO: do this for multi-source too!
-            if return_alignment:
-                # holds the history of attention weights for each time step for each of the surviving hypothesis
-                # dimensions (live_k * target_words * source_hidden_units]
-                # at each time step we append the attention weights corresponding to the current target word
-                new_hyp_alignment = []
-                for _ in xs:
-                    new_hyp_alignment.append([[] for _ in xrange(k - dead_k)])
-
-            # ti -> index of k-best hypothesis
-            for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
-                new_hyp_samples.append(hyp_samples[ti] + [wi])
-                new_word_probs.append(word_probs[ti] + [probs_flat[ranks_flat[idx]].tolist()])
-                new_hyp_scores[idx] = copy.copy(costs[idx])
-                new_hyp_states.append([copy.copy(next_state[i][ti]) for i in xrange(num_models)])
-                if return_alignment:
-                    # get history of attention weights for the current hypothesis
-
-                    for inputnum in range(len(xs)):
-                        new_hyp_alignment[inputnum][idx] = copy.copy(hyp_alignment[inputnum][ti])
-                        # extend the history with current attention weights
-                        new_hyp_alignment[inputnum][idx].append(mean_alignment[inputnum][ti])
-
-            # check the finished samples
-            new_live_k = 0
-            hyp_samples = []
-            hyp_scores = []
-            hyp_states = []
-            word_probs = []
-            if return_alignment:
-                hyp_alignment = [[] for _ in xs]
-
-            # sample and sample_score hold the k-best translations and their scores
-            for idx in xrange(len(new_hyp_samples)):
-                if return_hyp_graph:
-                    word, history = new_hyp_samples[idx][-1], new_hyp_samples[idx][:-1]
-                    score = new_hyp_scores[idx]
-                    word_prob = new_word_probs[idx][-1]
-                    hyp_graph.add(word, history, word_prob=word_prob, cost=score)
-                if new_hyp_samples[idx][-1] == 0:
-                    sample.append(copy.copy(new_hyp_samples[idx]))
-                    sample_score.append(new_hyp_scores[idx])
-                    sample_word_probs.append(new_word_probs[idx])
-                    if return_alignment:
-                        for inputnum in range(len(xs)):
-                            alignments[inputnum].append(new_hyp_alignment[inputnum][idx])
-                    dead_k += 1
+            for hyp_sample, hyp_state, hyp_score, hyp_word_prob in zip(hyp_samples, hyp_states, hyp_scores,
+                                                                       word_probs):
+                if hyp_sample[-1] > 0:
+                    new_hyp_samples.append(copy.copy(hyp_sample))
+                    new_hyp_states.append(copy.copy(hyp_state))
+                    new_hyp_scores.append(hyp_score)
+                    new_word_probs.append(hyp_word_prob)
                 else:
-                    new_live_k += 1
-                    hyp_samples.append(copy.copy(new_hyp_samples[idx]))
-                    hyp_scores.append(new_hyp_scores[idx])
-                    hyp_states.append(copy.copy(new_hyp_states[idx]))
-                    word_probs.append(new_word_probs[idx])
-                    if return_alignment:
-                        for inputnum in range(len(xs)):
-                            hyp_alignment[inputnum].append(new_hyp_alignment[inputnum][idx])
+                    sample.append(copy.copy(hyp_sample))
+                    sample_score.append(hyp_score)
+                    sample_word_probs.append(hyp_word_prob)
 
-            hyp_scores = numpy.array(hyp_scores)
+            hyp_samples = new_hyp_samples
+            hyp_states = new_hyp_states
+            hyp_scores = new_hyp_scores
+            word_probs = new_word_probs
 
-            live_k = new_live_k
-
-            if new_live_k < 1:
-                break
-            if dead_k >= k:
+            live_k = len(hyp_samples)
+            if live_k < 1:
                 break
 
             next_w = numpy.array([w[-1] for w in hyp_samples])
@@ -1293,9 +1367,6 @@ def gen_sample(f_init, f_next, x, trng=None, k=1, maxlen=30,
             sample.append(hyp_samples[idx])
             sample_score.append(hyp_scores[idx])
             sample_word_probs.append(word_probs[idx])
-            if return_alignment:
-                for inputnum in range(len(xs)):
-                    alignments[inputnum].append(hyp_alignment[inputnum][idx])
 
     if not return_alignment:
         alignments = []
@@ -1305,6 +1376,357 @@ def gen_sample(f_init, f_next, x, trng=None, k=1, maxlen=30,
     return sample, sample_score, sample_word_probs, alignments, hyp_graph
 
 
+# beam search over a batch of source sentences. The hypotheses of all
+# sentences form one flat beam (ordered by sentence), so every time step
+# needs a single f_next call per model, whatever the batch size.
+# xs and x_masks hold one padded array per input, as built by
+# prepare_sample_data. Returns one (sample, sample_score, sample_word_probs,
+# alignments, hyp_graph) tuple per sentence, as gen_sample does.
+# If given, shortlist holds the sorted candidate target ids for the batch
+# (see lexical_shortlist.py); the samplers must then be built with shortlist=True.
+# With log_probs, f_next returns log-probabilities (samplers built with log_probs=True).
+# With maxlen_ratio, the output of each sentence is limited to that multiple
+# of its source length (and to maxlen). With early_stopping, the search for a
+# sentence ends once no live hypothesis can beat its best finished one under
+# length normalisation with normalization_alpha; only the best translation is
+# then guaranteed to be the one of the full search.
+# The beam of a sentence can be pruned further: prune_relative drops the
+# candidates whose probability is below that fraction of the best
+# candidate's, prune_absolute those whose cost exceeds the best cost by more
+# than that, and max_per_parent limits the candidates extending one hypothesis.
+# With fused_models, f_init and f_next each hold the one function built by
+# build_ensemble_sampler for that many models; word probabilities are then
+# the geometric mean of the models' probabilities.
+# If given, the counters of the dict search_stats are increased by the
+# number of sentences, the steps searched (summed over the sentences) and the
+# hypotheses scored, and for early stopping by the sentences whose search it
+# ended and the live hypotheses it dropped, with an upper bound of the steps
+# and hypothesis scorings this saved (all dropped hypotheses going on until
+# the length limit of their sentence).
+def gen_sample_batch(f_init, f_next, xs, x_masks, trng=None, k=1, maxlen=30,
+                     return_alignment=False, suppress_unk=False,
+                     return_hyp_graph=False, init_decoder=False, shortlist=None,
+                     log_probs=False, maxlen_ratio=None, early_stopping=False,
+                     normalization_alpha=0.0, prune_relative=None, prune_absolute=None,
+                     max_per_parent=None, fused_models=None, search_stats=None):
+
+    n_sent = xs[0].shape[2]
+
+    # init-decoder models only attend to the main input
+    num_attentions = 1 if init_decoder else len(xs)
+
+    # true source lengths, to strip padding off the attention weights
+    src_lengths = [x_mask.sum(0).astype('int64') for x_mask in x_masks]
+
+    # maximum output length of each sentence
+    max_lengths = numpy.ones(n_sent, dtype='int64') * maxlen
+    if maxlen_ratio is not None:
+        max_lengths = numpy.minimum(max_lengths, numpy.ceil(maxlen_ratio * src_lengths[0]).astype('int64'))
+        maxlen = max_lengths.max()
+
+    # hypothesis store: every hypothesis selected at time step t occupies one
+    # slot of row t, and points back to the slot of its parent in row t-1.
+    # Full hypotheses are only rebuilt for the finished ones.
+    n_slots = n_sent * k
+    words = numpy.zeros((maxlen, n_slots), dtype='int64')
+    backpointers = numpy.zeros((maxlen, n_slots), dtype='int64')
+    scores = numpy.zeros((maxlen, n_slots), dtype=floatX)
+    word_probs = numpy.zeros((maxlen, n_slots), dtype=floatX)
+    if return_alignment:
+        attention = [numpy.zeros((maxlen, n_slots, x_mask.shape[0]), dtype=floatX)
+                     for x_mask in x_masks[:num_attentions]]
+
+    def backtrack(t, slot):
+        # slots of the hypothesis ending in (t, slot), one per time step
+        path = numpy.zeros(t + 1, dtype='int64')
+        for tt in xrange(t, -1, -1):
+            path[tt] = slot
+            slot = backpointers[tt, slot]
+        return path
+
+    # (time step, slot) of the finished hypotheses, per sentence
+    finished = [[] for _ in xrange(n_sent)]
+    dead_k = [0] * n_sent
+    # best length-normalised score of the finished hypotheses, per sentence
+    best_finished = numpy.ones(n_sent) * numpy.inf
+
+    hyp_graphs = [None] * n_sent
+    if return_hyp_graph:
+        from hypgraph import HypGraph
+        hyp_graphs = [HypGraph() for _ in xrange(n_sent)]
+        # node of each slot of the store in the search graph of its sentence
+        graph_nodes = numpy.zeros((maxlen, n_slots), dtype='int64')
+
+    # live hypotheses: their sentence, their slot in the last row of the store and their score
+    hyp_sents = numpy.arange(n_sent)
+    hyp_slots = numpy.zeros(n_sent, dtype='int64')
+    hyp_scores = numpy.zeros(n_sent).astype(floatX)
+
+    # for ensemble decoding, we keep track of states and probability distribution
+    # for each model in the ensemble
+    num_models = fused_models or len(f_init)
+    next_state = [None] * num_models
+    next_p = [None] * num_models
+    ctx = [None] * num_models
+    pctx = [None] * num_models
+    dec_alphas = [[None] * num_models for _ in xrange(num_attentions)]
+
+    # get initial state of decoder rnn (layers x sentences x dim), encoder
+    # context and projected context; these stay one per sentence and are
+    # broadcast to the hypotheses inside f_next
+    inps = []
+    for x, x_mask in zip(xs, x_masks):
+        inps.extend([x, x_mask])
+    if fused_models:
+        # the fused f_init returns the outputs of all models, one after the other
+        fused_ret = f_init[0](*inps)
+        n_outs = len(fused_ret) // num_models
+        rets = [fused_ret[i * n_outs:(i + 1) * n_outs] for i in xrange(num_models)]
+    else:
+        rets = [f_init[i](*inps) for i in xrange(num_models)]
+    for i, ret in enumerate(rets):
+        next_state[i] = ret[0]
+        ctx[i] = ret[1:len(xs)+1]
+        pctx[i] = ret[len(xs)+1:]
+
+    next_w = -1 * numpy.ones((n_sent,)).astype('int64')  # bos indicator
+
+    # column of UNK in the output distribution
+    if shortlist is None:
+        unk_column = 1
+    else:
+        unk_column = numpy.flatnonzero(shortlist == 1)
+
+    # maximum cost difference to the best candidate of a sentence
+    prune_margin = numpy.inf
+    if prune_relative is not None:
+        prune_margin = -numpy.log(prune_relative)
+    if prune_absolute is not None:
+        prune_margin = min(prune_margin, prune_absolute)
+
+    # number of hypotheses scored by f_next (live_k), per step
+    live_ks = []
+    # steps searched per sentence, and what early stopping saved
+    sentence_steps = numpy.zeros(n_sent, dtype='int64')
+    stopped = 0
+    dropped = 0
+    steps_saved = 0
+    hyps_saved = 0
+
+    for ii in xrange(maxlen):
+        live_ks.append(len(next_w))
+        if fused_models:
+            # one call for all models, returning the sum of their log-probabilities
+            if init_decoder:
+                inps = [next_w, x_masks[0], hyp_sents]
+            else:
+                inps = [next_w] + x_masks + [hyp_sents]
+            if shortlist is not None:
+                inps.append(shortlist)
+            for i in xrange(num_models):
+                if init_decoder:
+                    inps.extend([ctx[i][0], pctx[i][0], next_state[i]])
+                else:
+                    inps.extend(ctx[i] + pctx[i] + [next_state[i]])
+
+            ret = f_next[0](*inps)
+
+            next_p = ret[:1]
+            next_state = ret[1:num_models + 1]
+            if suppress_unk:
+                next_p[0][:, unk_column] = -numpy.inf
+        else:
+            for i in xrange(num_models):
+                # each hypothesis attends over the context of its own sentence
+                if init_decoder:
+                    inps = [next_w, ctx[i][0], pctx[i][0], x_masks[0], hyp_sents, next_state[i]]
+                else:
+                    inps = [next_w] + ctx[i] + pctx[i] + x_masks + [hyp_sents, next_state[i]]
+                if shortlist is not None:
+                    inps.append(shortlist)
+
+                ret = f_next[i](*inps)
+
+                next_p[i], next_state[i] = ret[0], ret[2]
+                if return_alignment:
+                    for inputnum in range(num_attentions):
+                        dec_alphas[inputnum][i] = ret[3 + inputnum]
+
+                if suppress_unk:
+                    next_p[i][:, unk_column] = -numpy.inf
+
+        if log_probs or fused_models:
+            cand_scores = hyp_scores[:, None] - next_p[0]
+            for p in next_p[1:]:
+                cand_scores -= p
+        else:
+            cand_scores = hyp_scores[:, None] - sum(numpy.log(next_p))
+        voc_size = next_p[0].shape[1]
+
+        # k best words of every hypothesis; the beam of each sentence is then
+        # selected from these (at most k x k) candidates
+        n_best = min(k, voc_size, max_per_parent or k)
+        if n_best < voc_size:
+            best_columns = cand_scores.argpartition(n_best - 1, axis=1)[:, :n_best]
+        else:
+            best_columns = numpy.tile(numpy.arange(voc_size), (len(cand_scores), 1))
+        best_scores = cand_scores[numpy.arange(len(cand_scores))[:, None], best_columns]
+
+        # averaging the attention weights accross models
+        if return_alignment and fused_models:
+            mean_alignment = ret[num_models + 1:]
+        elif return_alignment:
+            mean_alignment = [sum(dec_alphas[inputnum]) / num_models for inputnum in range(num_attentions)]
+
+        parents = []
+        new_hyp_sents = []
+        new_hyp_slots = []
+        slot = 0
+        for s in xrange(n_sent):
+            # the beam of sentence s is a contiguous block of rows
+            rows = numpy.flatnonzero(hyp_sents == s)
+            if len(rows) == 0:
+                continue
+
+            cand_flat = best_scores[rows].flatten()
+            n_cands = min(k - dead_k[s], len(cand_flat))
+            ranks_flat = cand_flat.argpartition(n_cands - 1)[:n_cands]
+            if prune_margin < numpy.inf:
+                ranks_flat = ranks_flat[cand_flat[ranks_flat] - cand_flat[ranks_flat].min() <= prune_margin]
+
+            # index of each k-best hypothesis
+            trans_indices = rows[ranks_flat // n_best]
+            word_columns = best_columns[trans_indices, ranks_flat % n_best]
+            # map shortlist positions back to target ids
+            word_indices = word_columns if shortlist is None else shortlist[word_columns]
+            new_slots = numpy.arange(slot, slot + len(ranks_flat))
+            slot += len(ranks_flat)
+
+            words[ii, new_slots] = word_indices
+            backpointers[ii, new_slots] = hyp_slots[trans_indices]
+            scores[ii, new_slots] = cand_flat[ranks_flat]
+            # probabilities averaged over the models, for the selected words only
+            selected_p = [p[trans_indices, word_columns] for p in next_p]
+            if fused_models:
+                word_probs[ii, new_slots] = numpy.exp(selected_p[0] / num_models)
+            else:
+                if log_probs:
+                    selected_p = numpy.exp(selected_p)
+                word_probs[ii, new_slots] = sum(selected_p) / num_models
+            if return_alignment:
+                for inputnum in range(num_attentions):
+                    attention[inputnum][ii, new_slots] = mean_alignment[inputnum][trans_indices]
+
+            if return_hyp_graph:
+                if ii > 0:
+                    parent_nodes = graph_nodes[ii - 1, backpointers[ii, new_slots]]
+                else:
+                    parent_nodes = numpy.repeat(HypGraph.ROOT, len(new_slots))
+                graph_nodes[ii, new_slots] = hyp_graphs[s].add(words[ii, new_slots], parent_nodes,
+                                                               word_probs[ii, new_slots], scores[ii, new_slots])
+
+            # hypotheses reaching the maximum length of their sentence end without EOS
+            is_final = (word_indices == 0) | (ii + 1 >= max_lengths[s])
+            for new_slot in new_slots[is_final]:
+                finished[s].append((ii, new_slot))
+            dead_k[s] += is_final.sum()
+
+            live = ~is_final
+            if is_final.any():
+                best_finished[s] = min(best_finished[s],
+                                       scores[ii, new_slots[is_final]].min() / (ii + 1) ** normalization_alpha)
+            # costs only grow, so the normalised cost of a live hypothesis is at least
+            # its current cost divided by the largest length normalisation it can reach
+            sentence_steps[s] = ii + 1
+            if early_stopping and live.any() and \
+                    scores[ii, new_slots[live]].min() / max_lengths[s] ** normalization_alpha >= best_finished[s]:
+                # the live hypotheses could go on until the length limit, with no more of them per step
+                stopped += 1
+                dropped += live.sum()
+                steps_saved += max_lengths[s] - (ii + 1)
+                hyps_saved += live.sum() * (max_lengths[s] - (ii + 1))
+                live[:] = False
+
+            parents.extend(trans_indices[live])
+            new_hyp_slots.extend(new_slots[live])
+            new_hyp_sents.extend([s] * live.sum())
+
+        hyp_sents = numpy.array(new_hyp_sents, dtype='int64')
+        hyp_slots = numpy.array(new_hyp_slots, dtype='int64')
+        hyp_scores = scores[ii, hyp_slots]
+
+        if len(parents) < 1:
+            break
+
+        next_w = words[ii, hyp_slots]
+        next_state = [state[:, parents] for state in next_state]
+
+    # dump every remaining one
+    for s, hyp_slot in zip(hyp_sents, hyp_slots):
+        finished[s].append((ii, hyp_slot))
+
+    logging.debug('Beam search over {0} sentences: {1} steps, {2} hypotheses scored, '
+                  'live_k mean {3:.1f}, max {4}, last {5}'.format(n_sent, len(live_ks), sum(live_ks),
+                                                                  numpy.mean(live_ks), max(live_ks), live_ks[-1]))
+    if early_stopping:
+        logging.debug('Early stopping ended {0} of {1} searches, dropping {2} live hypotheses: '
+                      'at most {3} steps and {4} hypothesis scorings saved'.format(stopped, n_sent, dropped,
+                                                                                   steps_saved, hyps_saved))
+    if search_stats is not None:
+        search_stats['sentences'] += n_sent
+        search_stats['steps'] += int(sentence_steps.sum())
+        search_stats['hyps_scored'] += sum(live_ks)
+        search_stats['early_stopped'] += stopped
+        search_stats['hyps_dropped'] += int(dropped)
+        search_stats['steps_saved'] += int(steps_saved)
+        search_stats['hyps_saved'] += int(hyps_saved)
+
+    # rebuild the finished hypotheses from the store
+    results = []
+    for s in xrange(n_sent):
+        sample = []
+        sample_score = []
+        sample_word_probs = []
+        alignments = [[] for _ in xrange(num_attentions if return_alignment else len(xs))]
+        for t, slot in finished[s]:
+            steps = numpy.arange(t + 1)
+            path = backtrack(t, slot)
+            sample.append(words[steps, path].tolist())
+            sample_score.append(scores[t, slot])
+            sample_word_probs.append(word_probs[steps, path].tolist())
+            for inputnum in range(len(alignments)):
+                if return_alignment:
+                    alignments[inputnum].append(list(attention[inputnum][steps, path, :src_lengths[inputnum][s]]))
+                else:
+                    alignments[inputnum].append(None)
+        results.append((sample, sample_score, sample_word_probs, alignments, hyp_graphs[s]))
+
+    return results
+
+
+# greedy decoding of a batch of source sentences with the sampler built by
+# build_full_sampler(greedy=True): a single call runs the whole decoding loop
+# in the Theano scan. x and x_mask are built by prepare_sample_data. Returns
+# one (sample, sample_score, sample_word_probs, alignments, hyp_graph) tuple
+# per sentence, as gen_sample_batch does with k=1, but without alignments or
+# search graph.
+def gen_greedy_batch(f_sample, x, x_mask, maxlen=30):
+
+    samples, probs = f_sample(x, x_mask, maxlen)
+
+    results = []
+    for s in xrange(x.shape[2]):
+        # cut after the first EOS (the scan only stops once all sentences are done)
+        eos = numpy.where(samples[:, s] == 0)[0]
+        length = eos[0] + 1 if len(eos) else samples.shape[0]
+        sample = samples[:length, s].tolist()
+        sample_word_probs = probs[:length, s].tolist()
+        sample_score = -numpy.log(probs[:length, s]).sum()
+        results.append(([sample], [sample_score], [sample_word_probs], [[None]], None))
+
+    return results
+
+
 # calculate the log probablities on a given corpus using translation model
 def pred_probs(f_log_probs, prepare_data, options, iterator, verbose=True, normalization_alpha=0.0, alignweights=False):
     probs = []
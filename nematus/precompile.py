@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Compiles the samplers (and optionally scorers) of a set of models into a
+function cache directory, so that translate.py, server.py and score.py can
+start without building the graphs (see `function_cache.py`).
+
+Run this with the same THEANO_FLAGS (device, floatX) as the processes that use
+the cache; the flags are part of the cache key.
+"""
+
+import argparse
+import logging
+
+from util import load_config
+from compat import fill_options, dummy_options
+
+
+def main(models, function_cache, shortlist=False, greedy=False, scorer=False, alignweights=False,
+         fused_ensemble=False, document_context=False):
+    from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+    from theano import shared
+
+    from theano_util import numpy_floatX
+    from translate import load_sampler, load_ensemble_sampler, load_encoders, sampler_settings
+    from score import load_scorer
+
+    trng = RandomStreams(1234)
+    use_noise = shared(numpy_floatX(0.))
+
+    # options are part of the cache key, so prepare them as translate.py and score.py do
+    options = []
+    for model in models:
+        options.append(load_config(model))
+        fill_options(options[-1])
+        dummy_options(options[-1])
+    # only compile what Translator uses
+    greedy, fused_ensemble, document_context = sampler_settings(options, greedy, fused_ensemble, document_context,
+                                                                shortlist=shortlist)
+
+    if fused_ensemble:
+        logging.info('Compiling fused sampler for {0}'.format(' '.join(models)))
+        load_ensemble_sampler(models, options, trng, use_noise, shortlist=shortlist,
+                              function_cache=function_cache)
+
+    for model, option in zip(models, options):
+        if not fused_ensemble:
+            logging.info('Compiling sampler for {0}'.format(model))
+            load_sampler(model, option, trng, use_noise, shortlist=shortlist, greedy=greedy,
+                         function_cache=function_cache)
+
+        if document_context:
+            logging.info('Compiling encoders for {0}'.format(model))
+            load_encoders(model, option, trng, use_noise, function_cache=function_cache)
+
+        if scorer:
+            option = load_config(model)
+            fill_options(option)
+
+            logging.info('Compiling scorer for {0}'.format(model))
+            load_scorer(model, option, alignweights=alignweights, function_cache=function_cache)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill a function cache directory ahead of deployment")
+    parser.add_argument('--models', '-m', type=str, nargs='+', required=True, metavar="MODEL",
+                        help="Models to compile")
+    parser.add_argument('--function-cache', type=str, required=True, metavar='DIR',
+                        help="Function cache directory (as given to translate.py, server.py or score.py)")
+    parser.add_argument('--shortlist', action="store_true",
+                        help="Compile samplers for vocabulary selection (translate.py --shortlist)")
+    parser.add_argument('--greedy', action="store_true",
+                        help="Also compile the greedy batch sampler of single (single-source) models (translate.py --greedy)")
+    parser.add_argument('--fused-ensemble', action="store_true",
+                        help="Compile the fused sampler of the models as one ensemble, instead of one sampler per model (translate.py --fused-ensemble)")
+    parser.add_argument('--document-context', action="store_true",
+                        help="Also compile the separate encoders of multi-source models (translate.py --document-context)")
+    parser.add_argument('--scorer', action="store_true",
+                        help="Also compile the scorer of score.py")
+    parser.add_argument('--walign', '-w', action="store_true",
+                        help="Compile the scorer with alignment weights (score.py --walign)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    main(args.models, args.function_cache, shortlist=args.shortlist, greedy=args.greedy,
+         scorer=args.scorer, alignweights=args.walign, fused_ensemble=args.fused_ensemble,
+         document_context=args.document_context)
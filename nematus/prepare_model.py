@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Prepares a model for inference: computations that only depend on parameters
+are done once, instead of in every decoding step. Weight-normalised matrices
+(`weight_normalisation`) are replaced by their normalised values, so the
+model config can switch weight normalisation off and the graphs skip the
+`weight_norm` path; the optimizer state is dropped.
+
+Optionally, the projections of all target embeddings by the input matrices of
+the decoder's conditional GRU (`Wemb_dec . W + b` and `Wemb_dec . Wx + bx`)
+are stored as lookup tables, so each decoder step gathers rows instead of
+multiplying the previous words' embeddings (`decoder_projection_tables`).
+
+The outputs of the original and the prepared model are compared on a random
+batch; the prepared model is removed again if they do not match.
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import logging
+
+import numpy
+
+from util import load_config
+from model_dir import open_params, save_model_dir
+
+WNS_SUFFIX = '_wns'
+
+# same epsilon as layers.weight_norm
+WN_EPS = 1e-5
+
+
+def fold_weight_norm(params):
+    """
+    Returns the parameters of @param params (without optimizer state), with
+    every matrix `W` that has a weight normalisation scale `W_wns` replaced
+    by `W / (||W|| * W_wns)` (column norms), and without the scales.
+    """
+    folded = {}
+    for name in params.files:
+        if name.startswith('adam_') or name == 'zipped_params' or name.endswith(WNS_SUFFIX):
+            continue
+        value = numpy.asarray(params[name])
+        if name + WNS_SUFFIX in params:
+            scale = numpy.asarray(params[name + WNS_SUFFIX])
+            norms = numpy.sqrt((value * value).sum(axis=0, keepdims=True) + numpy.asarray(WN_EPS, dtype=value.dtype))
+            value = value / (norms * scale)
+        folded[name] = value
+    return folded
+
+
+def add_projection_tables(params, options):
+    """
+    Replaces the decoder's input matrices `decoder_W` and `decoder_Wx` in
+    dict @param params (without weight normalisation) by the tables
+    `decoder_W_emb_table` and `decoder_Wx_emb_table`, which hold the
+    projections of all target embeddings, biases included.
+    """
+    embedding = params['Wemb' if options['tie_encoder_decoder_embeddings'] else 'Wemb_dec']
+    # models trained with old dropout rescale the embeddings at test time (see layers.dropout_constr)
+    if options['use_dropout'] and options['model_version'] < 0.1:
+        embedding = embedding * (1 - options['dropout_target']) * (1 - options['dropout_embedding'])
+    for name, bias in [('W', 'b'), ('Wx', 'bx')]:
+        W = params.pop('decoder_' + name)
+        params['decoder_' + name + '_emb_table'] = (numpy.dot(embedding, W) + params['decoder_' + bias]).astype(W.dtype)
+
+
+def projection_table_report(params, options, beam_size=12):
+    """
+    Returns a description of the memory cost of the projection tables in
+    @param params and of the work they save per decoder step.
+    """
+    mb = 1024. * 1024.
+    tables = sum(params['decoder_' + name + '_emb_table'].nbytes for name in ['W', 'Wx'])
+    matrices = options['dim_word'] * 3 * options['dim'] * params['decoder_W_emb_table'].itemsize
+    # multiply-adds per hypothesis: embedding projections and output layer (for comparison)
+    saved = options['dim_word'] * 3 * options['dim']
+    readout = options['dim_word'] * options['n_words']
+    return ('projection tables: {0:.1f}MB ({1:.1f}MB more than the matrices they replace); '
+            'they save {2} multiply-adds per hypothesis and decoder step ({3:.2f}M with beam size {4}), '
+            '{5:.1%} of those of the output layer').format(
+        tables / mb, (tables - matrices) / mb, saved, saved * beam_size / 1e6, beam_size, float(saved) / readout)
+
+
+def compare_outputs(model, options, prepared_model, prepared_options, batch_size=10, length=12, seed=1234):
+    """
+    Scores a random batch with both models and returns the maximum absolute
+    difference of the sentence costs, and the mean cost of @param model.
+    """
+    from score import load_scorer
+    from theano_util import floatX
+
+    rng = numpy.random.RandomState(seed)
+    num_encoders = len(options['extra_sources']) + 1
+    # ids that exist in any vocabulary; masks with varying sentence lengths
+    inputs = []
+    for i in range(num_encoders + 1):
+        if i < num_encoders:
+            x = rng.randint(2, 30, size=(options['factors'], length, batch_size)).astype('int64')
+        else:
+            x = rng.randint(2, 30, size=(length, batch_size)).astype('int64')
+        mask = numpy.zeros((length, batch_size)).astype(floatX)
+        for j, n in enumerate(rng.randint(1, length + 1, size=batch_size)):
+            mask[:n, j] = 1.
+        inputs += [x, mask]
+
+    costs = []
+    for m, o in [(model, options), (prepared_model, prepared_options)]:
+        f_log_probs = load_scorer(m, o)
+        costs.append(numpy.asarray(f_log_probs(*inputs)[0]))
+    return numpy.abs(costs[0] - costs[1]).max(), costs[0].mean()
+
+
+def main(model, output, model_dir=False, projection_tables=False, check=True, tolerance=1e-4):
+    from compat import fill_options
+
+    config = load_config(model)
+    options = load_config(model)
+    fill_options(options)
+    if 'extra_sources' not in options:
+        options['extra_sources'] = []
+    if 'multisource_type' not in options:
+        options['multisource_type'] = None
+
+    params = open_params(model)
+    if options['weight_normalisation']:
+        prepared = fold_weight_norm(params)
+        logging.info('Folded {0} weight normalisation scales into their matrices'.format(
+            len([name for name in params.files if name.endswith(WNS_SUFFIX)])))
+    else:
+        logging.info('{0} does not use weight normalisation'.format(model))
+        prepared = dict((name, params[name]) for name in params.files
+                        if not name.startswith('adam_') and name != 'zipped_params')
+
+    config['weight_normalisation'] = False
+    if projection_tables:
+        add_projection_tables(prepared, options)
+        config['decoder_projection_tables'] = True
+        sys.stdout.write(projection_table_report(prepared, options) + '\n')
+
+    prepared_options = dict(options)
+    prepared_options.update(config)
+
+    if model_dir:
+        save_model_dir(output, prepared)
+    else:
+        numpy.savez(output, **prepared)
+        if not output.endswith('.npz'):
+            output += '.npz'
+    with open(output + '.json', 'wb') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+
+    if check:
+        difference, mean_cost = compare_outputs(model, options, output, prepared_options)
+        sys.stdout.write('maximum cost difference on a random batch: {0:.3g} (mean cost {1:.4f})\n'.format(
+            difference, mean_cost))
+        if difference > tolerance * max(1., abs(mean_cost)):
+            logging.error('Outputs of the prepared model differ from {0}; removing {1}'.format(model, output))
+            remove_model(output)
+            sys.exit(1)
+
+
+def remove_model(path):
+    """
+    Removes the model @param path (archive or directory) and its config.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    if os.path.exists(path + '.json'):
+        os.remove(path + '.json')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prepare a model for inference by precomputing parameter-only expressions")
+    parser.add_argument('model', metavar='MODEL',
+                        help="Model to prepare (.npz archive or model directory)")
+    parser.add_argument('output', metavar='OUTPUT',
+                        help="Output model")
+    parser.add_argument('--model-dir', action="store_true",
+                        help="Write a model directory (see model_dir.py) instead of an .npz archive")
+    parser.add_argument('--projection-tables', action="store_true",
+                        help="Store the projections of all target embeddings by the decoder's input matrices as lookup tables")
+    parser.add_argument('--no-check', action="store_false", dest="check",
+                        help="Do not compare the outputs of the two models")
+    parser.add_argument('--tolerance', type=float, default=1e-4, metavar='FLOAT',
+                        help="Maximum relative difference of the costs on the check batch (default: %(default)s)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    main(args.model, args.output, model_dir=args.model_dir, projection_tables=args.projection_tables,
+         check=args.check, tolerance=args.tolerance)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Exports an inference-only model with reduced-precision weights: the optimizer
+state is stripped, and every 2-D parameter matrix with at least `--min-size`
+elements is stored as float16, or as int8 with one float32 scale per row.
+With the default size, this is every weight matrix of a real model
+(embeddings, GRU and attention matrices, feed-forward and output layers),
+but not the biases and normalisation parameters, which stay float32. All
+tools dequantize such models to floatX when loading them (see
+`model_dir.open_params` and `util.load_shared_params`), so the smaller
+storage type saves disk space and loading time, not memory.
+
+Reports the size on disk and in memory of the two models and, given a
+held-out parallel corpus, the drift of the `score.py` scores.
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import logging
+import tempfile
+
+import numpy
+
+from model_dir import open_params, is_model_dir, save_model_dir, QSCALE_SUFFIX
+from util import config_floatX
+
+
+def quantize_params(params, dtype, min_size=4096):
+    """
+    Returns the parameters of @param params (without optimizer state) with
+    every matrix of at least @param min_size elements converted to @param
+    dtype ('float16' or 'int8').
+    """
+    quantized = {}
+    for name in params.files:
+        if name.startswith('adam_') or name == 'zipped_params':
+            continue
+        value = numpy.asarray(params[name])
+        if value.ndim != 2 or value.size < min_size:
+            quantized[name] = value
+        elif dtype == 'float16':
+            quantized[name] = value.astype('float16')
+        else:
+            scale = numpy.abs(value).max(axis=1) / 127.
+            scale[scale == 0] = 1.
+            quantized[name] = numpy.round(value / scale[:, None]).clip(-127, 127).astype('int8')
+            quantized[name + QSCALE_SUFFIX] = scale.astype('float32')
+    return quantized
+
+
+def disk_size(path):
+    """
+    Returns the size in bytes of a model archive or directory.
+    """
+    if is_model_dir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    if not os.path.exists(path):
+        path += '.npz'
+    return os.path.getsize(path)
+
+
+def memory_size(params, loaded_dtype='float32'):
+    """
+    Returns the size in bytes of the parameters @param params as stored and
+    after loading them with floatX @param loaded_dtype.
+    """
+    stored = 0
+    loaded = 0
+    for name in params.files:
+        if name.startswith('adam_') or name == 'zipped_params':
+            continue
+        value = params[name]
+        stored += value.nbytes
+        if not name.endswith(QSCALE_SUFFIX):
+            loaded += value.size * numpy.dtype(loaded_dtype).itemsize
+    return stored, loaded
+
+
+def score_drift(model, quantized_model, source, target, extra_sources=[], b=80):
+    """
+    Scores the held-out corpus @param source / @param target with both
+    models (with `score.py`) and returns the mean and maximum absolute
+    difference of the sentence scores, and the mean score of @param model.
+    """
+    import score
+
+    scores = []
+    for m in [model, quantized_model]:
+        for f in [source, target] + list(extra_sources):
+            f.seek(0)
+        with tempfile.NamedTemporaryFile(prefix='quantize.scores.') as output:
+            score.main([m], source, target, output, b=b, extra_sources=extra_sources)
+            output.flush()
+            with open(output.name) as f:
+                scores.append(numpy.array([float(line) for line in f]))
+    difference = numpy.abs(scores[0] - scores[1])
+    return difference.mean(), difference.max(), scores[0].mean()
+
+
+def main(model, output, dtype, min_size=4096, model_dir=False, source=None, target=None, extra_sources=[]):
+    params = open_params(model, dequantize=False)
+    quantized = quantize_params(params, dtype, min_size=min_size)
+
+    if model_dir:
+        save_model_dir(output, quantized)
+    else:
+        numpy.savez(output, **quantized)
+        if not output.endswith('.npz'):
+            output += '.npz'
+    if os.path.exists(model + '.json'):
+        shutil.copyfile(model + '.json', output + '.json')
+
+    n_quantized = len([name for name, value in quantized.iteritems() if value.dtype.name == dtype])
+    logging.info('Stored {0} of {1} parameters as {2}'.format(
+        n_quantized, len(quantized) - len([name for name in quantized if name.endswith(QSCALE_SUFFIX)]), dtype))
+
+    mb = 1024. * 1024.
+    floatX = config_floatX()
+    original_stored, original_loaded = memory_size(params, loaded_dtype=floatX)
+    quantized_stored, quantized_loaded = memory_size(open_params(output, dequantize=False), loaded_dtype=floatX)
+    sys.stdout.write('{0:<20} {1:>12} {2:>12}\n'.format('', 'original', dtype))
+    sys.stdout.write('{0:<20} {1:>10.1f}MB {2:>10.1f}MB\n'.format('on disk', disk_size(model) / mb, disk_size(output) / mb))
+    sys.stdout.write('{0:<20} {1:>10.1f}MB {2:>10.1f}MB\n'.format('parameters', original_stored / mb, quantized_stored / mb))
+    sys.stdout.write('{0:<20} {1:>10.1f}MB {2:>10.1f}MB\n'.format('loaded ({0})'.format(floatX), original_loaded / mb,
+                                                                quantized_loaded / mb))
+    sys.stdout.write('(parameters are converted to floatX when loaded: {0} storage saves disk space, not memory)\n'.format(
+        dtype))
+
+    if source is not None and target is not None:
+        mean_drift, max_drift, mean_score = score_drift(model, output, source, target, extra_sources=extra_sources)
+        sys.stdout.write('score drift on {0}: mean {1:.4f}, max {2:.4f} (mean score {3:.4f})\n'.format(
+            target.name, mean_drift, max_drift, mean_score))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export an inference-only model with float16 or int8 weights")
+    parser.add_argument('model', metavar='MODEL',
+                        help="Model to export (.npz archive or model directory)")
+    parser.add_argument('output', metavar='OUTPUT',
+                        help="Output model")
+    parser.add_argument('--dtype', choices=['float16', 'int8'], default='float16',
+                        help="Storage type of the parameter matrices of at least --min-size elements; they are converted to floatX when loaded (default: %(default)s)")
+    parser.add_argument('--min-size', type=int, default=4096, metavar='INT',
+                        help="Every 2-D parameter with at least this many elements is converted; smaller ones and 1-D parameters (biases, normalisation) stay float32 (default: %(default)s)")
+    parser.add_argument('--model-dir', action="store_true",
+                        help="Write a model directory (see model_dir.py) instead of an .npz archive")
+    parser.add_argument('--source', '-s', type=argparse.FileType('r'), metavar='PATH',
+                        help="Source side of a held-out corpus, to report the score drift")
+    parser.add_argument('--target', '-t', type=argparse.FileType('r'), metavar='PATH',
+                        help="Target side of a held-out corpus, to report the score drift")
+    parser.add_argument('--extra_sources', nargs='+', type=argparse.FileType('r'), default=[], metavar='PATH',
+                        help="Auxiliary inputs of the held-out corpus (multi-source models)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    main(args.model, args.output, args.dtype, min_size=args.min_size, model_dir=args.model_dir,
+         source=args.source, target=args.target, extra_sources=args.extra_sources)
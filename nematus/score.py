@@ -15,8 +15,9 @@ from util import load_config
 from alignment_util import combine_source_target_text_1to1
 from compat import fill_options
 
-from theano_util import (floatX, numpy_floatX, load_params, init_theano_params)
+from theano_util import (floatX, numpy_floatX, load_model_params, init_theano_params)
 from nmt import (pred_probs, multi_pred_probs, build_model, build_multisource_model, prepare_data, prepare_multi_data)
+from function_cache import compile_cached
 
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 import theano
@@ -25,12 +26,9 @@ import theano
 
 
 # TODO: make generic for multi-source
-def load_scorer(model, option, alignweights=None):
-    # load model parameters and set theano shared variables
-    param_list = numpy.load(model).files
-    param_list = dict.fromkeys([key for key in param_list if not key.startswith('adam_')], 0)
-    params = load_params(model, param_list)
-    tparams = init_theano_params(params)
+def load_scorer(model, option, alignweights=None, function_cache=None):
+    # load model parameters
+    params = load_model_params(model)
 
     # compatibility with multi-source
     if 'extra_sources' not in option:
@@ -38,44 +36,52 @@ def load_scorer(model, option, alignweights=None):
     if 'multisource_type' not in option:
         option['multisource_type'] = None
 
-    #if 'multisource_type' not in option or option['multisource_type'] is None:
-     #   print("building single source model")
-       # trng, use_noise, x, x_mask, y, y_mask, opt_ret, cost = build_model(tparams, option)
-      #  inps = [x, x_mask, y, y_mask]
-    #else:
-    trng, use_noise, xs, x_masks, y, y_mask, opt_ret, cost = build_multisource_model(tparams, option)
-    #inps = [xs[0], x_masks[0], xs[1], x_masks[1], y, y_mask]
+    def build():
+        # set theano shared variables
+        tparams = init_theano_params(params)
 
-    inps = [z for (x, x_mask) in zip(xs, x_masks) for z in (x, x_mask)] + [y, y_mask]  # list of inputs
+        #if 'multisource_type' not in option or option['multisource_type'] is None:
+         #   print("building single source model")
+           # trng, use_noise, x, x_mask, y, y_mask, opt_ret, cost = build_model(tparams, option)
+          #  inps = [x, x_mask, y, y_mask]
+        #else:
+        trng, use_noise, xs, x_masks, y, y_mask, opt_ret, cost = build_multisource_model(tparams, option)
+        #inps = [xs[0], x_masks[0], xs[1], x_masks[1], y, y_mask]
 
-    use_noise.set_value(0.)
+        inps = [z for (x, x_mask) in zip(xs, x_masks) for z in (x, x_mask)] + [y, y_mask]  # list of inputs
 
-    if alignweights:
-        logging.debug("Save weight mode ON, alignment matrix will be saved.")
+        use_noise.set_value(0.)
 
-        outputs = [cost]
-        if option['multisource_type'] == 'init-decoder':
-            extra_encoders = 0
-        else:
-            extra_encoders = len(option['extra_sources'])
-        for i in range(extra_encoders + 1):
-            outputs.append(opt_ret['dec_alphas' + str(i)])
-        outputs.append(opt_ret['cost_per_word'])
+        if alignweights:
+            logging.debug("Save weight mode ON, alignment matrix will be saved.")
 
-        #if 'multisource_type' not in option or option['multisource_type'] is None:
-        #    outputs = [cost, opt_ret['dec_alphas0'], opt_ret['cost_per_word']]
-        #else:
-        #    outputs = [cost, opt_ret['dec_alphas0'], opt_ret['dec_alphas1'], opt_ret['cost_per_word']]
+            outputs = [cost]
+            if option['multisource_type'] == 'init-decoder':
+                extra_encoders = 0
+            else:
+                extra_encoders = len(option['extra_sources'])
+            for i in range(extra_encoders + 1):
+                outputs.append(opt_ret['dec_alphas' + str(i)])
+            outputs.append(opt_ret['cost_per_word'])
 
-        f_log_probs = theano.function(inps, outputs)
-    else:
-        f_log_probs = theano.function(inps, [cost, opt_ret['cost_per_word']])
+            #if 'multisource_type' not in option or option['multisource_type'] is None:
+            #    outputs = [cost, opt_ret['dec_alphas0'], opt_ret['cost_per_word']]
+            #else:
+            #    outputs = [cost, opt_ret['dec_alphas0'], opt_ret['dec_alphas1'], opt_ret['cost_per_word']]
+
+            f_log_probs = theano.function(inps, outputs)
+        else:
+            f_log_probs = theano.function(inps, [cost, opt_ret['cost_per_word']])
+        return [f_log_probs]
 
+    # reuse compiled functions across runs (see function_cache.py)
+    f_log_probs, = compile_cached(function_cache, 'scorer', option, params, build,
+                                  alignweights=bool(alignweights))
     return f_log_probs
 
 
 def rescore_model(source_file, target_file, saveto, models, options, b, normalization_alpha, verbose, alignweights,
-                  per_word=False):
+                  per_word=False, function_cache=None):
     trng = RandomStreams(1234)
 
     # changed for multi-source: sources are a lsit
@@ -85,7 +91,7 @@ def rescore_model(source_file, target_file, saveto, models, options, b, normaliz
         sent_alignments = []
         costs_per_word = []
         for i, model in enumerate(models):
-            f_log_probs = load_scorer(model, options[i], alignweights=alignweights)
+            f_log_probs = load_scorer(model, options[i], alignweights=alignweights, function_cache=function_cache)
 
             # TODO: make multi ?
             score, alignments, cost_per_word = pred_probs(f_log_probs, prepare_data, options[i], pairs,
@@ -136,7 +142,7 @@ def rescore_model(source_file, target_file, saveto, models, options, b, normaliz
 # Multi-source version of rescore model (just 2 inputs for now)
 # source_files, savetos are lists
 def multi_rescore_model(source_file, target_file, savetos, models, options, b,
-                        normalization_alpha, verbose, alignweights, extra_sources=[], per_word=False):
+                        normalization_alpha, verbose, alignweights, extra_sources=[], per_word=False, function_cache=None):
 
     trng = RandomStreams(1234)
 
@@ -147,7 +153,7 @@ def multi_rescore_model(source_file, target_file, savetos, models, options, b,
         #aux_alignments = []
         costs_per_word = []
         for i, model in enumerate(models):
-            f_log_probs = load_scorer(model, options[i], alignweights=alignweights)
+            f_log_probs = load_scorer(model, options[i], alignweights=alignweights, function_cache=function_cache)
             score, all_alignments, cost_per_word = multi_pred_probs(f_log_probs, prepare_multi_data, options[i],
                                                          pairs, normalization_alpha=normalization_alpha,
                                                          alignweights=alignweights)
@@ -224,7 +230,7 @@ def multi_rescore_model(source_file, target_file, savetos, models, options, b,
 
 
 def main(models, source_file, target_file, saveto, b=80, normalization_alpha=0.0, verbose=False, alignweights=False,
-        extra_sources=[], per_word=False):
+        extra_sources=[], per_word=False, function_cache=None):
     # load model model_options
     options = []
     for model in models:
@@ -236,12 +242,12 @@ def main(models, source_file, target_file, saveto, b=80, normalization_alpha=0.0
     if len(extra_sources) == 0:
         savetos = [saveto] + [file(saveto.name, 'w') for _ in extra_sources]
         multi_rescore_model(source_file, target_file, savetos, models, options, b, normalization_alpha, verbose, alignweights,
-                      per_word=per_word)
+                      per_word=per_word, function_cache=function_cache)
     else:
         savetos = [saveto] + [file(saveto.name, 'w') for _ in extra_sources]
         #source_files = source_files + extra_sources
         multi_rescore_model(source_file, target_file, savetos, models, options, b, normalization_alpha, verbose, alignweights,
-                            per_word=per_word, extra_sources=extra_sources)
+                            per_word=per_word, extra_sources=extra_sources, function_cache=function_cache)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -264,6 +270,8 @@ if __name__ == "__main__":
     parser.add_argument('--extra_sources', nargs='+', type=argparse.FileType('r'), default=[], metavar='PATH', help="Auxiliary input file")
     # costs per word
     parser.add_argument("--per_word", default=False, action="store_true", help="Output costs per word instead of per sentence")
+    parser.add_argument('--function-cache', type=str, default=None, metavar='DIR',
+                        help="Directory in which compiled functions are cached across runs, see precompile.py (default: no cache)")
     args = parser.parse_args()
 
     # set up logging
@@ -271,4 +279,5 @@ if __name__ == "__main__":
     logging.basicConfig(level=level, format='%(levelname)s: %(message)s')
 
     main(args.models, args.source, args.target, args.output, b=args.b, normalization_alpha=args.n, verbose=args.v,
-         alignweights=args.walign, extra_sources=args.extra_sources, per_word=args.per_word)
+         alignweights=args.walign, extra_sources=args.extra_sources, per_word=args.per_word,
+         function_cache=args.function_cache)
@@ -36,6 +36,8 @@ class NematusServer(object):
         self._style = server_settings.style
         self._host = server_settings.host
         self._port = server_settings.port
+        self._batch_size = server_settings.batch_size
+        self._max_tokens = server_settings.max_tokens
         self._debug = decoder_settings.verbose
         self._models = decoder_settings.models
         self._num_processes = decoder_settings.num_processes
@@ -63,6 +65,13 @@ class NematusServer(object):
             #'version': pkg_resources.require("Nematus")[0].version,
             'service': 'Nematus',
         }
+        # resident memory of the workers; model parameters are counted as shared memory (shmem)
+        response_data['workers'] = self._translator.get_worker_memory()
+        # batches and sentences decoded by each worker, and the time spent decoding them
+        response_data['worker_load'] = self._translator.get_worker_stats()
+        cache_stats = self._translator.get_cache_stats()
+        if cache_stats is not None:
+            response_data['cache'] = cache_stats
         response.content_type = "application/json"
 
         return json.dumps(response_data)
@@ -73,6 +82,9 @@ class NematusServer(object):
         """
         translation_request = request_provider(self._style, request)
         logging.debug("REQUEST - " + repr(translation_request))
+        # the segments of a request are decoded in batches
+        translation_request.settings.batch_size = self._batch_size
+        translation_request.settings.max_tokens = self._max_tokens
 
         translations = self._translator.translate(
             translation_request.segments,
@@ -25,6 +25,18 @@ class TranslationRequestNematus(TranslationRequest):
             self.settings.char_level = request['character_level']
         if 'suppress_unk' in request:
             self.settings.suppress_unk = request['suppress_unk']
+        if 'max_length' in request:
+            self.settings.max_length = request['max_length']
+        if 'max_length_ratio' in request:
+            self.settings.max_length_ratio = request['max_length_ratio']
+        if 'early_stopping' in request:
+            self.settings.early_stopping = request['early_stopping']
+        if 'prune_relative' in request:
+            self.settings.prune_relative = request['prune_relative']
+        if 'prune_absolute' in request:
+            self.settings.prune_absolute = request['prune_absolute']
+        if 'max_candidates_per_parent' in request:
+            self.settings.max_candidates_per_parent = request['max_candidates_per_parent']
         if 'return_word_alignment' in request:
             self.settings.get_alignment = request['return_word_alignment']
         if 'return_word_probabilities' in request:
@@ -50,6 +50,12 @@ class TranslationRequest(object):
         * self.character_level
         * self.n_best
         * self.suppress_unk
+        * self.max_length
+        * self.max_length_ratio
+        * self.early_stopping
+        * self.prune_relative
+        * self.prune_absolute
+        * self.max_candidates_per_parent
         * self.return_word_alignment
         * self.return_word_probabilities
         """
@@ -22,6 +22,18 @@ class DecoderSettings(object):
         self.num_attentions = 1
         self.num_encoders = 1
         self.multisource = None
+        self.shortlist = None
+        self.shortlist_frequent = 100
+        self.shortlist_translations = 100
+        self.cache_size = 0
+        self.cache_file = None
+        self.greedy = False
+        self.function_cache = None
+        self.shared_params = True
+        self.fused_ensemble = False
+        self.document_context = False
+        self.longest_first = False
+        self.max_retries = 2
         if parsed_console_arguments:
             self.update_from(parsed_console_arguments)
 
@@ -35,6 +47,18 @@ class DecoderSettings(object):
         self.num_processes = args.p
         self.device_list = args.device_list
         self.verbose = args.v
+        self.shortlist = args.shortlist
+        self.shortlist_frequent = args.shortlist_frequent
+        self.shortlist_translations = args.shortlist_translations
+        self.cache_size = args.cache_size
+        self.cache_file = args.cache_file
+        self.greedy = args.greedy
+        self.function_cache = args.function_cache
+        self.shared_params = args.shared_params
+        self.fused_ensemble = args.fused_ensemble
+        self.document_context = args.document_context
+        self.longest_first = args.longest_first
+        self.max_retries = args.max_retries
 
         # multisource
         if not hasattr(args, 'aux_input'):
@@ -46,6 +70,9 @@ class DecoderSettings(object):
         else:
             self.multisource = False
             self.num_inputs = 1
+        # the previous translation is an auxiliary input
+        if getattr(args, 'predicted_trg', False):
+            self.multisource = True
 
 
 class TranslationSettings(object):
@@ -65,6 +92,12 @@ class TranslationSettings(object):
         self.char_level = False
         self.n_best = 1
         self.suppress_unk = False
+        self.max_length = 200
+        self.max_length_ratio = None
+        self.early_stopping = False
+        self.prune_relative = None
+        self.prune_absolute = None
+        self.max_candidates_per_parent = None
         self.get_word_probs = False
         self.get_alignment = False
         self.alignment_type = None
@@ -74,6 +107,9 @@ class TranslationSettings(object):
         self.search_graph_filename = None
         self.multisource = False
         self.predicted_trg = False
+        self.batch_size = 1
+        self.max_tokens = None
+        self.chunk_size = 1000
         if parsed_console_arguments:
             self.update_from(parsed_console_arguments)
 
@@ -88,6 +124,12 @@ class TranslationSettings(object):
         self.char_level = args.c
         self.n_best = args.n_best
         self.suppress_unk = args.suppress_unk
+        self.max_length = args.max_length
+        self.max_length_ratio = args.max_length_ratio
+        self.early_stopping = args.early_stopping
+        self.prune_relative = args.prune_relative
+        self.prune_absolute = args.prune_absolute
+        self.max_candidates_per_parent = args.max_candidates_per_parent
         self.get_word_probs = args.print_word_probabilities
 
         if args.output_alignment:
@@ -116,6 +158,9 @@ class TranslationSettings(object):
             self.multisource = False
 
         self.predicted_trg = args.predicted_trg
+        self.batch_size = args.batch_size
+        self.max_tokens = args.max_tokens
+        self.chunk_size = args.chunk_size
 
 
 class ServerSettings(object):
@@ -129,6 +174,8 @@ class ServerSettings(object):
         self.style = "Nematus" #TODO: use constant
         self.host = "localhost"
         self.port = 8080
+        self.batch_size = 80
+        self.max_tokens = None
         if parsed_console_arguments:
             self.update_from(parsed_console_arguments)
 
@@ -141,3 +188,5 @@ class ServerSettings(object):
         self.style = args.style
         self.host = args.host
         self.port = args.port
+        self.batch_size = args.batch_size
+        self.max_tokens = args.max_tokens
@@ -13,6 +13,8 @@ import theano
 import theano.tensor as tensor
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
+from model_dir import open_params
+
 floatX = theano.config.floatX
 numpy_floatX = numpy.typeDict[floatX]
 
@@ -52,22 +54,20 @@ def pp(pp, name):
     return '%s_%s' % (pp, name)
 
 # initialize Theano shared variables according to the initial parameters
-def init_theano_params(params):
+# (with borrow=True, the variables use the given arrays without copying them)
+def init_theano_params(params, borrow=False):
     tparams = OrderedDict()
 
     for kk, pp in params.iteritems():
         #print('tparams["'+str(kk)+'"] = theano.shared(params["'+str(kk)+'"], name="'+str(kk)+'")')
-        tparams[kk] = theano.shared(params[kk], name=kk)
+        tparams[kk] = theano.shared(params[kk], name=kk, borrow=borrow)
 
     return tparams
 
 
-# load parameters
+# load parameters (from an .npz archive or a model directory, see model_dir.py)
 def load_params(path, params, with_prefix=''):
-    try:
-        pp = numpy.load(path)
-    except IOError:
-        pp = numpy.load(path + '.npz')
+    pp = open_params(path)
     new_params = OrderedDict()
     for kk, vv in params.iteritems():
         if kk not in pp:
@@ -80,14 +80,23 @@ def load_params(path, params, with_prefix=''):
     params.update(new_params)
     return params
 
+# load all model parameters, but not the optimizer state, for decoding or
+# scoring. Arrays in a model directory are memory-mapped, and not copied if
+# their dtype is floatX.
+def load_model_params(path):
+    pp = open_params(path)
+    params = OrderedDict()
+    for kk in pp.files:
+        if kk.startswith('adam_') or kk == "zipped_params":
+            continue
+        params[kk] = pp[kk].astype(floatX, copy=False)
+    return params
+
 # load parameters of the optimizer
 def load_optimizer_params(path, optimizer_name):
     params = {}
-    try:
-        pp = numpy.load(path)
-    except IOError:
-        pp = numpy.load(path + '.npz')
-    for kk in pp:
+    pp = open_params(path)
+    for kk in pp.files:
         if kk.startswith(optimizer_name):
             params[kk] = pp[kk].astype(floatX, copy=False)
     return params
@@ -7,12 +7,14 @@ import numpy
 import json
 import os
 import logging
+import itertools
+import time
+import select
 
-from multiprocessing import Process, Queue
-from collections import defaultdict
-from Queue import Empty
+from multiprocessing import Process, Queue, Pipe, Array
+from collections import defaultdict, deque, OrderedDict
 
-from util import load_dict, load_config, seqs2words
+from util import load_dict, load_config, seqs2words, load_shared_params, process_memory, config_floatX
 from compat import fill_options, dummy_options
 from hypgraph import HypGraphRenderer
 from console import ConsoleInterfaceDefault
@@ -23,7 +25,8 @@ class Translation(object):
     Models a translated segment.
     """
     def __init__(self, source_words, target_words, sentence_id=None, score=0, alignment=None,
-                 target_probs=None, hyp_graph=None, hypothesis_id=None, aux_source_words=None, aux_alignment=None):
+                 target_probs=None, hyp_graph=None, hypothesis_id=None, aux_source_words=None, aux_alignment=None,
+                 failed=False):
         self.source_words = source_words
         self.target_words = target_words
         self.sentence_id = sentence_id
@@ -38,6 +41,9 @@ class Translation(object):
         self.aux_alignment = aux_alignment
         self.multisource = True
 
+        # decoding crashed the workers (empty translation)
+        self.failed = failed
+
     def get_alignment(self, aux_id=None):
         if aux_id is not None:
             return self.aux_alignment[aux_id]
@@ -120,9 +126,14 @@ class Translation(object):
 
     def save_hyp_graph(self, filename, word_idict_trg, detailed=True, highlight_best=True):
         """
-        Writes this translation's search graph to disk.
+        Writes this translation's search graph to disk, as a PNG image or, if
+        @param filename ends in `.json`, as the node lists of the graph (see
+        `HypGraph.to_dict`).
         """
-        if self.hyp_graph:
+        if self.hyp_graph and filename.endswith('.json'):
+            with open(filename, 'w') as f:
+                json.dump(self.hyp_graph.to_dict(word_idict_trg), f)
+        elif self.hyp_graph:
             renderer = HypGraphRenderer(self.hyp_graph)
             renderer.wordify(word_idict_trg)
             renderer.save_png(filename, detailed, highlight_best)
@@ -138,8 +149,150 @@ class QueueItem(object):
         self.__dict__.update(kwargs)
 
 
+def _load_params(model, params=None):
+    """
+    Returns the parameters of @param model (or @param params, if already
+    loaded into shared memory) and whether Theano may borrow them.
+    """
+    from theano_util import floatX, load_model_params
+
+    if params is None:
+        return load_model_params(model), False
+    return OrderedDict((name, value.astype(floatX, copy=False)) for name, value in params.iteritems()), True
+
+
+def load_sampler(model, option, trng, use_noise, shortlist=False, greedy=False, function_cache=None, params=None):
+    """
+    Loads the parameters of @param model and returns its f_init and f_next
+    functions (always with alignment, f_next returning log-probabilities for
+    `gen_sample_batch`) and, if @param greedy, the greedy batch
+    sampler (otherwise None). With a @param function_cache directory, compiled
+    functions are reused across processes (see `function_cache.py`).
+
+    Parameters already loaded into shared memory (see
+    `util.load_shared_params`) can be passed as @param params; they are used
+    without copying if their dtype is floatX.
+    """
+    from nmt import build_sampler, build_multi_sampler, build_full_sampler
+    from theano_util import init_theano_params
+    from function_cache import compile_cached
+
+    params, borrow = _load_params(model, params)
+
+    def build():
+        tparams = init_theano_params(params, borrow=borrow)
+        if option['multisource_type'] is not None:
+            functions = build_multi_sampler(tparams, option, use_noise, trng, return_alignment=True,
+                                            shortlist=shortlist, log_probs=True)
+        else:
+            functions = build_sampler(tparams, option, use_noise, trng, return_alignment=True,
+                                      shortlist=shortlist, log_probs=True)
+        functions = list(functions)
+        # decodes whole batches in one call (single models only)
+        if greedy:
+            functions.append(build_full_sampler(tparams, option, use_noise, trng, greedy=True))
+        return functions
+
+    functions = compile_cached(function_cache, 'sampler', option, params, build,
+                               shortlist=shortlist, greedy=greedy, log_probs=True)
+    f_init, f_next = functions[:2]
+    f_sample = functions[2] if greedy else None
+    return f_init, f_next, f_sample
+
+
+def load_ensemble_sampler(models, options, trng, use_noise, shortlist=False, function_cache=None, params=None):
+    """
+    Loads the parameters of all @param models and returns one f_init and one
+    f_next for the whole ensemble (see `nmt.build_ensemble_sampler`).
+    @param params optionally holds the shared parameters of each model, as
+    for `load_sampler`.
+    """
+    from nmt import build_ensemble_sampler
+    from theano_util import init_theano_params
+    from function_cache import compile_cached
+
+    params_list = []
+    for i, model in enumerate(models):
+        model_params, borrow = _load_params(model, params[i] if params is not None else None)
+        params_list.append(model_params)
+
+    # all models use the same parameter names; prefix them with the model
+    # number, so the function cache can tell the models apart
+    prefixed_params = OrderedDict(('model{0}/{1}'.format(i, name), value)
+                                  for i, model_params in enumerate(params_list)
+                                  for name, value in model_params.iteritems())
+
+    def build():
+        tparams_list = []
+        for i, model_params in enumerate(params_list):
+            tparams = init_theano_params(model_params, borrow=borrow)
+            for name, variable in tparams.iteritems():
+                variable.name = 'model{0}/{1}'.format(i, name)
+            tparams_list.append(tparams)
+        return list(build_ensemble_sampler(tparams_list, options, use_noise, trng, return_alignment=True,
+                                           shortlist=shortlist))
+
+    f_init, f_next = compile_cached(function_cache, 'ensemble_sampler', options, prefixed_params, build,
+                                    shortlist=shortlist)
+    return f_init, f_next
+
+
+def load_encoders(model, option, trng, use_noise, function_cache=None, params=None):
+    """
+    Loads the parameters of the multi-source @param model and returns a
+    `DocumentEncoder`, which replaces its f_init when decoding documents (see
+    `encoder_cache.py`). Other arguments are as for `load_sampler`.
+    """
+    from nmt import build_multi_encoders
+    from theano_util import init_theano_params
+    from function_cache import compile_cached
+    from encoder_cache import DocumentEncoder, encoder_groups
+
+    params, borrow = _load_params(model, params)
+
+    def build():
+        tparams = init_theano_params(params, borrow=borrow)
+        fs_encode, f_init_state = build_multi_encoders(tparams, option, use_noise, trng)
+        return fs_encode + [f_init_state]
+
+    functions = compile_cached(function_cache, 'encoders', option, params, build)
+    groups = encoder_groups(params, len(functions) - 1, factors=option['factors'])
+    if len(set(groups)) == len(groups):
+        logging.warning('The encoders of {0} do not share weights, so the context of the main input cannot be '
+                        'reused as auxiliary context'.format(model))
+    return DocumentEncoder(functions[:-1], functions[-1], groups)
+
+
+def sampler_settings(options, greedy, fused_ensemble, document_context, shortlist=False):
+    """
+    Returns which of the requested @param greedy sampler, @param
+    fused_ensemble and @param document_context encoders are compiled for
+    models with @param options (shared by `Translator` and `precompile.py`,
+    so that they compile the same functions).
+    """
+    if greedy and (len(options) > 1 or options[0]['multisource_type'] is not None):
+        logging.warning('Greedy batch decoding only supports single (single-source) models; using beam search')
+        greedy = False
+    # beam search with k=1 gives the same translations, restricted to the shortlist
+    if greedy and shortlist:
+        logging.warning('Greedy batch decoding does not support vocabulary selection; using beam search')
+        greedy = False
+    fused_ensemble = fused_ensemble and len(options) > 1
+
+    if document_context and options[0]['multisource_type'] in (None, 'init-decoder'):
+        logging.warning('Reusing document context needs multi-source models with attention on all inputs')
+        document_context = False
+    if document_context and fused_ensemble:
+        logging.warning('Reusing document context needs one f_init per model; not fusing the ensemble')
+        fused_ensemble = False
+    return greedy, fused_ensemble, document_context
+
+
 class Translator(object):
 
+    # number of batches on the input queue of a worker (the one it decodes and the next one)
+    MAX_WORKER_LOAD = 2
+
     def __init__(self, decoder_settings):
         """
         Loads translation models.
@@ -148,7 +301,30 @@ class Translator(object):
         self._num_processes = decoder_settings.num_processes
         self._device_list = decoder_settings.device_list
         self._verbose = decoder_settings.verbose
+        self._max_retries = decoder_settings.max_retries
+        self._longest_first = decoder_settings.longest_first
+        self._function_cache = decoder_settings.function_cache
+        self._share_params = decoder_settings.shared_params
         self._retrieved_translations = defaultdict(dict)
+        # cache keys of the segments being decoded, and repeated segments waiting for them
+        self._pending_keys = defaultdict(dict)
+        self._duplicates = defaultdict(dict)
+        # time spent decoding, and batches and sentences decoded, by each worker
+        self._busy_time = defaultdict(float)
+        self._batches_done = defaultdict(int)
+        self._sentences_done = defaultdict(int)
+        # beam search counters of all batches (see `nmt.gen_sample_batch`)
+        self._search_stats = defaultdict(int)
+        # batches sent to the workers and not yet done, those waiting for a worker, and those given to each
+        # worker
+        self._batch_ids = itertools.count()
+        self._sent_batches = {}
+        self._waiting_batches = deque()
+        self._worker_load = [[] for _ in xrange(self._num_processes)]
+        # how often each worker crashed since it last decoded a batch
+        self._worker_crashes = [0] * self._num_processes
+        # document of the last segment given to each worker (when reusing document context)
+        self._worker_documents = [None] * self._num_processes
 
         # load model options
         self._load_model_options()
@@ -158,8 +334,25 @@ class Translator(object):
         self.num_attentions = self._options[-1]['num_attentions']
         self.num_encoders = self._options[-1]['num_encoders']
 
+        # samplers to compile
+        self._greedy, self._fused_ensemble, self._document_context = sampler_settings(
+            self._options, decoder_settings.greedy, decoder_settings.fused_ensemble,
+            decoder_settings.document_context, shortlist=decoder_settings.shortlist is not None)
+
+        if self._document_context and self._longest_first:
+            logging.warning('Reusing document context needs batches in input order; not sending the longest first')
+            self._longest_first = False
+        # document of the last segment sent to the workers, and the segment itself
+        self._last_document = (-1, None)
+
         # load and invert dictionaries
         self._build_dictionaries()
+        # vocabulary selection
+        self._load_shortlist(decoder_settings)
+        # cache of decoding results
+        self._load_cache(decoder_settings)
+        # model parameters shared by all workers
+        self._load_shared_params()
         # set up queues
         self._init_queues()
         # init worker processes
@@ -231,14 +424,19 @@ class Translator(object):
         self._word_dicts = []
         self._word_idicts = []
 
-        for input_dictionary in [dictionaries_source] + aux_dictionaries_source:
+        for input_idx, input_dictionary in enumerate([dictionaries_source] + aux_dictionaries_source):
+            # multi-source models have one vocabulary size per input
+            if isinstance(all_n_words_src, list):
+                n_words_src = all_n_words_src[input_idx] if input_idx < len(all_n_words_src) else None
+            else:
+                n_words_src = all_n_words_src
             word_dicts = []
             word_idicts = []
             for dictionary in input_dictionary:
                 word_dict = load_dict(dictionary)
-                if all_n_words_src:
+                if n_words_src:
                     for key, idx in word_dict.items():
-                        if idx >= all_n_words_src:
+                        if idx >= n_words_src:
                             del word_dict[key]
                 word_idict = dict()
                 for kk, vv in word_dict.iteritems():
@@ -260,37 +458,154 @@ class Translator(object):
         word_idict_trg[0] = '<eos>'
         word_idict_trg[1] = 'UNK'
 
+        self._word_dict_trg = word_dict_trg
         self._word_idict_trg = word_idict_trg
 
+    def _load_shortlist(self, decoder_settings):
+        """
+        Loads the lexical table for vocabulary selection, if any. Candidates
+        are looked up with the words of the main input.
+        """
+        if decoder_settings.shortlist is None:
+            self._shortlist = None
+            return
+
+        from lexical_shortlist import LexicalShortlist
+        self._shortlist = LexicalShortlist(decoder_settings.shortlist,
+                                           source_dict=self._word_dicts[0][0],
+                                           target_dict=self._word_dict_trg,
+                                           n_words=self._options[0]['n_words'],
+                                           n_frequent=decoder_settings.shortlist_frequent,
+                                           n_translations=decoder_settings.shortlist_translations)
+
+    def _load_cache(self, decoder_settings):
+        """
+        Sets up the cache of decoding results, if any. Cache keys start with
+        the model set (paths and contents, see `model_fingerprint`) and the
+        vocabulary selection and ensemble settings, so that an on-disk cache
+        is not reused with different models.
+        """
+        if decoder_settings.cache_size <= 0:
+            self._cache = None
+            self._cache_prefix = None
+            return
+
+        from translation_cache import TranslationCache, model_fingerprint
+        self._cache_prefix = [self._models, [model_fingerprint(model) for model in self._models],
+                              decoder_settings.shortlist, decoder_settings.shortlist_frequent,
+                              decoder_settings.shortlist_translations, self._fused_ensemble]
+        self._cache = TranslationCache(decoder_settings.cache_size, filename=decoder_settings.cache_file)
+
+    def _load_shared_params(self):
+        """
+        Loads the parameters of all models once, into shared memory, before
+        the workers are forked; the workers then read them instead of
+        loading their own copies. They are stored as floatX, so that Theano
+        uses them without copying, whatever the type of the model file.
+        """
+        if not self._share_params:
+            self._params = None
+            return
+        dtype = config_floatX()
+        self._params = [load_shared_params(model, dtype=dtype) for model in self._models]
+
+    def get_worker_memory(self):
+        """
+        Returns the resident memory (in kB) of each worker process, see
+        `util.process_memory`.
+        """
+        memory = []
+        for process in self._processes:
+            stats = process_memory(process.pid)
+            stats['pid'] = process.pid
+            memory.append(stats)
+        return memory
+
+    def get_worker_stats(self):
+        """
+        Returns the number of batches and sentences each worker has decoded
+        so far, and the time (in seconds) it spent decoding them. Without
+        workers, the process id is 'main'.
+        """
+        stats = []
+        for process_id in sorted(self._busy_time):
+            stats.append({'process_id': process_id,
+                          'batches': self._batches_done[process_id],
+                          'sentences': self._sentences_done[process_id],
+                          'busy': self._busy_time[process_id]})
+        return stats
+
+    def get_search_stats(self):
+        """
+        Returns the beam search counters summed over all batches so far (see
+        `nmt.gen_sample_batch`; batches decoded greedily are not counted).
+        """
+        return dict(self._search_stats)
+
+    def get_cache_stats(self):
+        """
+        Returns the size and hit/miss counters of the translation cache, or
+        None if there is no cache.
+        """
+        if self._cache is None:
+            return None
+        return self._cache.stats()
 
     def _init_queues(self):
         """
-        Sets up shared queues for inter-process communication.
+        Sets up inter-process communication: each worker has its own input
+        queue and output pipe (see `_start_process`), so that a worker that
+        crashes cannot leave a message or lock behind for the others.
         """
-        self._input_queue = Queue()
-        self._output_queue = Queue()
+        self._input_queues = [None] * self._num_processes
+        self._output_pipes = [None] * self._num_processes
+        # the batch each worker is decoding (-1 if none, -2 while loading the models), written before it starts
+        # (unlike queue messages, even if it crashes)
+        self._worker_batches = Array('l', [-2] * max(1, self._num_processes), lock=False)
 
     def shutdown(self):
         """
         Executed from parent process to terminate workers,
         method: "poison pill".
         """
-        for process in self._processes:
-            self._input_queue.put(None)
+        for input_queue in self._input_queues:
+            input_queue.put(None)
+        if self._cache is not None:
+            self._cache.close()
 
     def _init_processes(self):
         """
-        Starts child (worker) processes.
+        Starts child (worker) processes. Without workers (`num_processes`
+        0), the models are loaded in the calling process instead, see
+        `translate_no_queue`.
         """
-        processes = [None] * self._num_processes
-        for process_id in xrange(self._num_processes):
+        self._local_models = None
+        if self._num_processes == 0:
             deviceid = ''
             if self._device_list is not None and len(self._device_list) != 0:
-                deviceid = self._device_list[process_id % len(self._device_list)].strip()
-            processes[process_id] = Process(target=self._start_worker, args=(process_id, deviceid))
-            processes[process_id].start()
+                deviceid = self._device_list[0].strip()
+            self._local_models = self._load_models('main', deviceid)
 
-        self._processes = processes
+        self._processes = [None] * self._num_processes
+        for process_id in xrange(self._num_processes):
+            self._start_process(process_id)
+
+    def _start_process(self, process_id):
+        """
+        Starts (or restarts) worker @param process_id, with a new input
+        queue and output pipe. Model parameters in shared memory are
+        inherited instead of loaded again.
+        """
+        deviceid = ''
+        if self._device_list is not None and len(self._device_list) != 0:
+            deviceid = self._device_list[process_id % len(self._device_list)].strip()
+        self._input_queues[process_id] = Queue()
+        self._output_pipes[process_id], output_pipe = Pipe(duplex=False)
+        self._worker_batches[process_id] = -2
+        self._processes[process_id] = Process(target=self._start_worker, args=(process_id, deviceid, output_pipe))
+        self._processes[process_id].start()
+        # only the worker writes to the pipe, so the parent sees its end (EOF) if it crashes
+        output_pipe.close()
 
     # MODEL LOADING AND TRANSLATION IN CHILD PROCESS ###
     def _load_theano(self):
@@ -301,16 +616,17 @@ class Translator(object):
         from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
         from theano import shared
 
-        from nmt import (build_sampler, build_multi_sampler, gen_sample)
-        from theano_util import (numpy_floatX, load_params, init_theano_params)
+        from nmt import gen_sample_batch
+        from theano_util import numpy_floatX
 
         trng = RandomStreams(1234)
         use_noise = shared(numpy_floatX(0.))
 
         fs_init = []
         fs_next = []
+        f_sample = None
 
-        for model, option in zip(self._models, self._options):
+        for i, (model, option) in enumerate(zip(self._models, self._options)):
 
             # check compatibility with multisource
             if option["multisource_type"] is not None and len(option['extra_sources']) == 0:
@@ -319,21 +635,32 @@ class Translator(object):
             elif option["multisource_type"] is None and len(option['extra_sources']) != 0:
                 logging.warn("You provided an auxiliary input but this model is not multi-source. Ignoring extra input.")
 
-            param_list = numpy.load(model).files
-            param_list = dict.fromkeys([key for key in param_list if not key.startswith('adam_')], 0)
-            params = load_params(model, param_list)
-            tparams = init_theano_params(params)
-
-            # always return alignment at this point
-            if option['multisource_type'] is not None:
-                f_init, f_next = build_multi_sampler(tparams, option, use_noise, trng, return_alignment=True)
-            else:
-                f_init, f_next = build_sampler(tparams, option, use_noise, trng, return_alignment=True)
+            if self._fused_ensemble:
+                continue
+
+            f_init, f_next, f_sample = load_sampler(model, option, trng, use_noise,
+                                                    shortlist=self._shortlist is not None,
+                                                    greedy=self._greedy,
+                                                    function_cache=self._function_cache,
+                                                    params=self._params[i] if self._params is not None else None)
+            # encode each input on its own, reusing the contexts of the previous sentences
+            if self._document_context:
+                f_init = load_encoders(model, option, trng, use_noise,
+                                       function_cache=self._function_cache,
+                                       params=self._params[i] if self._params is not None else None)
+            fs_init.append(f_init)
+            fs_next.append(f_next)
 
+        # one f_init and one f_next for all models
+        if self._fused_ensemble:
+            f_init, f_next = load_ensemble_sampler(self._models, self._options, trng, use_noise,
+                                                   shortlist=self._shortlist is not None,
+                                                   function_cache=self._function_cache,
+                                                   params=self._params)
             fs_init.append(f_init)
             fs_next.append(f_next)
 
-        return trng, fs_init, fs_next, gen_sample
+        return trng, fs_init, fs_next, gen_sample_batch, f_sample
 
     def _set_device(self, device_id):
         """
@@ -368,332 +695,848 @@ class Translator(object):
         # build and return models
         return self._load_theano()
 
-    def _start_worker(self, process_id, device_id):
+    def _start_worker(self, process_id, device_id, output_pipe):
         """
         Function executed by each worker once started. Do not execute in
-        the parent process.
+        the parent process. Output items are sent back on @param
+        output_pipe.
         """
         # load theano functionality
-        trng, fs_init, fs_next, gen_sample = self._load_models(process_id, device_id)
+        trng, fs_init, fs_next, gen_sample_batch, f_sample = self._load_models(process_id, device_id)
+        self._worker_batches[process_id] = -1
 
-        # listen to queue in while loop, translate items
+        # listen to queue in while loop, translate batches of items
+        input_queue = self._input_queues[process_id]
         while True:
-            input_item = self._input_queue.get()
-            if input_item is None:
+            message = input_queue.get()
+            if message is None:
                 break
-            idx = input_item.idx
-            request_id = input_item.request_id
-            output_item = self._translate(process_id, input_item, trng, fs_init, fs_next, gen_sample)
-            self._output_queue.put((request_id, idx, output_item))
+            batch_id, input_items = message
+            # tell the parent process which batch to count as crashing if this worker crashes
+            self._worker_batches[process_id] = batch_id
+            start = time.time()
+            search_stats = defaultdict(int)
+            output_items = self._translate_batch(process_id, input_items, trng, fs_init, fs_next, gen_sample_batch,
+                                                 f_sample=f_sample, search_stats=search_stats)
+            output_pipe.send((process_id, batch_id, output_items, time.time() - start, dict(search_stats)))
+            self._worker_batches[process_id] = -1
         return
 
-    def _translate(self, process_id, input_item, trng, fs_init, fs_next, gen_sample):
+    def _translate(self, process_id, input_item, trng, fs_init, fs_next, gen_sample_batch, f_sample=None):
         """
         Actual translation (model sampling).
         """
-        # unpack input item attributes
-        normalization_alpha = input_item.normalization_alpha
-        nbest = input_item.nbest
-        idx = input_item.idx
+        return self._translate_batch(process_id, [input_item], trng, fs_init, fs_next, gen_sample_batch,
+                                     f_sample=f_sample)[0]
 
+    def _translate_batch(self, process_id, input_items, trng, fs_init, fs_next, gen_sample_batch, f_sample=None,
+                         search_stats=None):
+        """
+        Translates several input items with one batched beam search. All
+        items must share the same translation settings. Returns one output
+        item per input item, in the same order. The beam search counters are
+        added to @param search_stats, if given.
+        """
         # logging
-        logging.debug('{0} - {1}\n'.format(process_id, idx))
-
-        # sample given an input sequence and obtain scores
-        if len(input_item.aux_seq) > 0:
-            sample, score, word_probs, alignments, hyp_graph = self._multi_sample(input_item, trng, fs_init, fs_next, gen_sample)
-        else:
-            sample, score, word_probs, alignments, hyp_graph = self._sample(input_item, trng, fs_init, fs_next, gen_sample)
+        logging.debug('{0} - {1}\n'.format(process_id, ' '.join([str(item.idx) for item in input_items])))
 
+        # sample given the input sequences and obtain scores
+        results = self._sample(input_items, trng, fs_init, fs_next, gen_sample_batch, f_sample=f_sample,
+                               search_stats=search_stats)
 
-        # normalize scores according to sequence lengths
-        if normalization_alpha:
-            adjusted_lengths = numpy.array([len(s) ** normalization_alpha for s in sample])
-            score = score / adjusted_lengths
-        if nbest is True:
-            output_item = sample, score, word_probs, alignments, hyp_graph
-        else:
-            # return translation with lowest score only
-            sidx = numpy.argmin(score)
+        output_items = []
+        for input_item, result in zip(input_items, results):
+            # unpack input item attributes
+            normalization_alpha = input_item.normalization_alpha
+            nbest = input_item.nbest
+
+            sample, score, word_probs, alignments, hyp_graph = result
+
+            # normalize scores according to sequence lengths
+            if normalization_alpha:
+                adjusted_lengths = numpy.array([len(s) ** normalization_alpha for s in sample])
+                score = score / adjusted_lengths
+            if nbest is True:
+                output_item = sample, score, word_probs, alignments, hyp_graph
+            else:
+                # return translation with lowest score only
+                sidx = numpy.argmin(score)
 
-            # modified for multi-source
-            output_item = sample[sidx], score[sidx], word_probs[sidx], [align[sidx] for align in alignments], hyp_graph
+                # modified for multi-source
+                output_item = sample[sidx], score[sidx], word_probs[sidx], [align[sidx] for align in alignments], hyp_graph
+            output_items.append(output_item)
 
-        return output_item
+        return output_items
 
-    def _multi_sample(self, input_item, trng, fs_init, fs_next, gen_sample):
+    def _sample(self, input_items, trng, fs_init, fs_next, gen_sample_batch, f_sample=None, search_stats=None):
         """
-        Sample from model.
+        Sample from model (batched beam search over all input items). With
+        beam size 1, the greedy sampler @param f_sample (if compiled) decodes
+        the batch in one call, unless alignments, a search graph or UNK
+        suppression are requested.
         """
-        # unpack input item attributes
+        from nmt import prepare_sample_data, gen_greedy_batch
+
+        # unpack input item attributes (shared by all items)
+        input_item = input_items[0]
         return_hyp_graph = input_item.return_hyp_graph
         return_alignment = input_item.return_alignment
-
         suppress_unk = input_item.suppress_unk
         k = input_item.k
-        seq = input_item.seq
-        aux_seqs = input_item.aux_seq
+        maxlen = input_item.max_length
+        maxlen_ratio = input_item.max_length_ratio
 
         if self._options[0]['multisource_type'] == 'init-decoder':
             init_decoder = True
         else:
             init_decoder = False
 
-        extra_xs=[numpy.array(aux).T.reshape([len(aux[0]), len(aux), 1]) for aux in aux_seqs]
+        # main input first, then auxiliary inputs, each padded to its longest sequence
+        xs = []
+        x_masks = []
+        for inputnum in range(1 + len(input_item.aux_seq)):
+            seqs = [item.seq if inputnum == 0 else item.aux_seq[inputnum - 1] for item in input_items]
+            x, x_mask = prepare_sample_data(seqs, n_factors=self._options[0]['factors'])
+            xs.append(x)
+            x_masks.append(x_mask)
+
+        if f_sample is not None and k == 1 and not (return_alignment or return_hyp_graph or suppress_unk):
+            # the greedy sampler has one length limit for the whole batch
+            if maxlen_ratio is not None:
+                maxlen = min(maxlen, int(numpy.ceil(maxlen_ratio * x_masks[0].sum(0).max())))
+            return gen_greedy_batch(f_sample, xs[0], x_masks[0], maxlen=maxlen)
+
+        # contexts of other documents are no longer needed
+        if self._document_context:
+            for f_init in fs_init:
+                f_init.set_documents([item.doc_id for item in input_items])
+            logging.debug('Encoder contexts so far: {0} reused, {1} computed; {2} kept'.format(
+                fs_init[0].hits, fs_init[0].misses, len(fs_init[0])))
+
+        # candidate target words for the whole batch
+        if self._shortlist is not None:
+            shortlist = self._shortlist.get([item.seq for item in input_items])
+        else:
+            shortlist = None
+
+        return gen_sample_batch(fs_init, fs_next, xs, x_masks,
+                                trng=trng, k=k, maxlen=maxlen,
+                                return_alignment=return_alignment,
+                                suppress_unk=suppress_unk,
+                                return_hyp_graph=return_hyp_graph,
+                                init_decoder=init_decoder,
+                                shortlist=shortlist,
+                                log_probs=True,
+                                maxlen_ratio=maxlen_ratio,
+                                early_stopping=input_item.early_stopping,
+                                normalization_alpha=input_item.normalization_alpha,
+                                prune_relative=input_item.prune_relative,
+                                prune_absolute=input_item.prune_absolute,
+                                max_per_parent=input_item.max_candidates_per_parent,
+                                fused_models=len(self._models) if self._fused_ensemble else None,
+                                search_stats=search_stats)
+
 
-        return gen_sample(fs_init, fs_next,
-                          numpy.array(seq).T.reshape([len(seq[0]), len(seq), 1]),
-                          trng=trng, k=k, maxlen=200,
-                          stochastic=False, argmax=False,
-                          return_alignment=return_alignment,
-                          suppress_unk=suppress_unk,
-                          return_hyp_graph=return_hyp_graph,
-                          extra_xs=extra_xs, #[numpy.array(aux_seq).T.reshape([len(aux_seq[0]), len(aux_seq), 1])],
-                          init_decoder=init_decoder)
+    ### WRITING TO AND READING FROM QUEUES ###
 
-    def _sample(self, input_item, trng, fs_init, fs_next, gen_sample):
+    # Multi-source version (with one auxiliary input)
+    def _send_jobs_multisource(self, input_, aux_input_, translation_settings, start=0):
         """
-        Sample from model.
+        Sends the segments to the workers, numbering them from @param start.
+        Returns the number of segments and their words for each input.
         """
-        # unpack input item attributes
-        return_hyp_graph = input_item.return_hyp_graph
-        return_alignment = input_item.return_alignment
-        suppress_unk = input_item.suppress_unk
-        k = input_item.k
-        seq = input_item.seq
-
-        return gen_sample(fs_init, fs_next,
-                          numpy.array(seq).T.reshape(
-                              [len(seq[0]), len(seq), 1]),
-                          trng=trng, k=k, maxlen=200,
-                          stochastic=False, argmax=False,
-                          return_alignment=return_alignment,
-                          suppress_unk=suppress_unk,
-                          return_hyp_graph=return_hyp_graph)
-
+        # prepare to store in lists of inputs
+        source_sentences = [[] for _ in range(len(aux_input_)+1)]
+        input_items = []
+        cache_keys = []
 
-    ### WRITING TO AND READING FROM QUEUES ###
+        # go through sentences (returns tuples w/ sentence for each input)
+        for sidx, line in enumerate(zip(input_, *aux_input_), start):
+            input_item, words_s = self._make_input_item(sidx, line, translation_settings,
+                                                        doc_id=self._next_document(line))
+            for iidx, words in enumerate(words_s):
+                source_sentences[iidx].append(words)
+            input_items.append(input_item)
+            cache_keys.append(self._cache_key(line, translation_settings))
+
+        self._put_batches(self._filter_cached(input_items, cache_keys, translation_settings.request_id),
+                          translation_settings)
+        return len(input_items), tuple(source_sentences) #(source_sentences, source_sentences2)
+
+    def _next_document(self, line):
+        """
+        Returns the document id of the segment with the main and auxiliary
+        input lines @param line, following the last segment sent: a
+        document goes on as long as the (first) auxiliary input is the
+        previous main input.
+        """
+        doc_id, previous_segment = self._last_document
+        if len(line) < 2 or line[1].strip() != previous_segment:
+            doc_id += 1
+        self._last_document = (doc_id, line[0].strip())
+        return doc_id
 
-    def _send_jobs(self, input_, translation_settings):
+    def _make_input_item(self, idx, line, translation_settings, doc_id=None):
         """
+        Returns the input item of sentence @param idx, whose main and
+        auxiliary inputs are the strings in @param line, and the words of
+        each input.
         """
-        source_sentences = []
-        for idx, line in enumerate(input_):
+        # stock the x forms of the words (convert from dictionaries)
+        xs = []
+        # stock the words of the input (for each of the inputs)
+        words_s = []
+
+        # stock words for each of the lines
+        for iidx, input in enumerate(line):
             if translation_settings.char_level:
-                words = list(line.decode('utf-8').strip())
+                words = list(input.decode('utf-8').strip())
             else:
-                words = line.strip().split()
+                words = input.strip().split()
 
+            # stock factors
             x = []
             for w in words:
-                w = [self._word_dicts[i][f] if f in self._word_dicts[i] else 1 for (i,f) in enumerate(w.split('|'))]
+                w = [self._word_dicts[iidx][j][f] if f in self._word_dicts[iidx][j] else 1 for (j, f) in enumerate(w.split('|'))]
                 if len(w) != self._options[0]['factors']:
-                    logging.warning('Expected {0} factors, but input word has {1}\n'.format(self._options[0]['factors'], len(w)))
+                    logging.warning(
+                        'Expected {0} factors, but input word has {1}\n'.format(self._options[0]['factors'], len(w)))
                     for midx in xrange(self._num_processes):
                         self._processes[midx].terminate()
                     sys.exit(1)
                 x.append(w)
 
-            x += [[0]*self._options[0]['factors']]
+            x += [[0] * self._options[0]['factors']]
+            xs.append(x)
+            words_s.append(words)
+
+        input_item = QueueItem(verbose=self._verbose,
+                               return_hyp_graph=translation_settings.get_search_graph,
+                               return_alignment=translation_settings.get_alignment,
+                               k=translation_settings.beam_width,
+                               suppress_unk=translation_settings.suppress_unk,
+                               max_length=translation_settings.max_length,
+                               max_length_ratio=translation_settings.max_length_ratio,
+                               early_stopping=translation_settings.early_stopping,
+                               prune_relative=translation_settings.prune_relative,
+                               prune_absolute=translation_settings.prune_absolute,
+                               max_candidates_per_parent=translation_settings.max_candidates_per_parent,
+                               normalization_alpha=translation_settings.normalization_alpha,
+                               nbest=translation_settings.n_best,
+                               seq=xs[0],
+                               aux_seq=xs[1:],
+                               idx=idx,
+                               doc_id=doc_id,
+                               request_id=translation_settings.request_id)
+        return input_item, words_s
+
+    def _cache_key(self, segments, translation_settings):
+        """
+        Returns the cache key of @param segments (the main and auxiliary
+        input lines) under the settings that affect the decoding result.
+        """
+        from translation_cache import TranslationCache
+        return TranslationCache.make_key(self._cache_prefix,
+                                         [segment.strip() for segment in segments],
+                                         translation_settings.char_level,
+                                         translation_settings.beam_width,
+                                         translation_settings.normalization_alpha,
+                                         translation_settings.suppress_unk,
+                                         translation_settings.max_length,
+                                         translation_settings.max_length_ratio,
+                                         translation_settings.early_stopping,
+                                         translation_settings.prune_relative,
+                                         translation_settings.prune_absolute,
+                                         translation_settings.max_candidates_per_parent,
+                                         translation_settings.n_best,
+                                         translation_settings.get_alignment,
+                                         translation_settings.get_word_probs,
+                                         translation_settings.get_search_graph)
+
+    def _filter_cached(self, input_items, cache_keys, request_id):
+        """
+        Returns the input items that need decoding. Results found in the cache
+        go straight to the retrieved translations of @param request_id, and
+        repeated segments wait for the result of their first occurrence.
+        """
+        first_idx = {}
+        to_decode = []
+        for input_item, key in zip(input_items, cache_keys):
+            if key in first_idx:
+                self._duplicates[request_id].setdefault(first_idx[key], []).append(input_item.idx)
+                continue
+            if self._cache is not None:
+                output_item = self._cache.get(key)
+                if output_item is not None:
+                    self._retrieved_translations[request_id][input_item.idx] = output_item
+                    continue
+                self._pending_keys[request_id][input_item.idx] = key
+            first_idx[key] = input_item.idx
+            to_decode.append(input_item)
+        return to_decode
+
+    def _store_output(self, request_id, idx, output_item):
+        """
+        Stores a decoding result received from a worker, adds it to the
+        cache and hands it on to repeated segments. Segments that could not
+        be decoded have None as output item.
+        """
+        self._retrieved_translations[request_id][idx] = output_item
+        key = self._pending_keys[request_id].pop(idx, None)
+        if key is not None and output_item is not None:
+            self._cache.put(key, output_item)
+        for duplicate_idx in self._duplicates[request_id].pop(idx, []):
+            self._retrieved_translations[request_id][duplicate_idx] = output_item
+
+    def _make_batches(self, input_items, translation_settings):
+        """
+        Groups input items of similar length into batches of at most
+        `translation_settings.batch_size` items and (if set)
+        `translation_settings.max_tokens` source tokens, counting padding.
+        When reusing document context, batches hold consecutive items
+        instead, so that a sentence and the next one are decoded together.
+        """
+        batch_size = max(1, translation_settings.batch_size)
+        max_tokens = translation_settings.max_tokens
+
+        def length(item):
+            return max([len(item.seq)] + [len(aux_seq) for aux_seq in item.aux_seq])
 
-            input_item = QueueItem(verbose=self._verbose,
-                                   return_hyp_graph=translation_settings.get_search_graph,
-                                   return_alignment=translation_settings.get_alignment,
-                                   k=translation_settings.beam_width,
-                                   suppress_unk=translation_settings.suppress_unk,
-                                   normalization_alpha=translation_settings.normalization_alpha,
-                                   nbest=translation_settings.n_best,
-                                   seq=x,
-                                   aux_seq=[],
-                                   idx=idx,
-                                   request_id=translation_settings.request_id)
+        if self._document_context:
+            input_items = sorted(input_items, key=lambda item: item.idx)
+        else:
+            input_items = sorted(input_items, key=length)
+
+        batches = []
+        batch = []
+        padded_length = 0
+        for item in input_items:
+            padded_length = max(padded_length, length(item))
+            if batch and (len(batch) == batch_size or
+                          (max_tokens and (len(batch) + 1) * padded_length > max_tokens)):
+                batches.append(batch)
+                batch = []
+                padded_length = length(item)
+            batch.append(item)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _batch_cost(self, batch):
+        """
+        Returns the estimated decoding cost of @param batch: its padded
+        source length, times its number of sentences, the beam size and the
+        number of models.
+        """
+        return max(len(item.seq) for item in batch) * len(batch) * batch[0].k * len(self._models)
 
-            self._input_queue.put(input_item)
-            source_sentences.append(words)
-        return idx + 1, source_sentences
+    def _put_batches(self, input_items, translation_settings):
+        """
+        Sends the input items to the workers, one queue message per batch.
+        With `longest_first`, the most expensive batches (see `_batch_cost`)
+        are sent first, so that they do not end up last on one worker while
+        the others are idle. Without workers, the batches are translated
+        right away.
+        """
+        batches = self._make_batches(input_items, translation_settings)
+        if self._longest_first:
+            batches.sort(key=self._batch_cost, reverse=True)
+        for batch in batches:
+            if self._num_processes == 0:
+                self._translate_locally(batch)
+            else:
+                self._send_batch(batch)
 
-    # Multi-source version (with one auxiliary input)
-    def _send_jobs_multisource(self, input_, aux_input_, translation_settings):
+    def _send_batch(self, input_items):
         """
+        Sends a batch of input items to the workers (see `_dispatch`), and
+        keeps it until a worker has decoded it.
         """
-        # prepare to store in lists of inputs
-        source_sentences = [[] for _ in range(len(aux_input_)+1)]
+        batch_id = next(self._batch_ids)
+        self._sent_batches[batch_id] = input_items
+        self._waiting_batches.append(batch_id)
+        self._dispatch()
 
-        # go through sentences (returns tuples w/ sentence for each input)
-        for sidx, line in enumerate(zip(input_, *aux_input_)):
+    def _dispatch(self):
+        """
+        Puts the waiting batches on the input queues of the least busy
+        workers, up to `MAX_WORKER_LOAD` batches per worker, so that the
+        others wait for the first worker to be free (and long batches sent
+        first are not queued behind each other). The batches on the queue
+        of a worker are known if it crashes.
+
+        When reusing document context, a batch that goes on with the
+        document a worker was given last goes to that worker (even if it is
+        busy), since the encoder contexts are kept by each worker.
+        """
+        waiting = deque()
+        # documents of batches that wait for their worker; the batches that go on with them wait too
+        waiting_documents = set()
+        while self._waiting_batches:
+            batch_id = self._waiting_batches.popleft()
+            input_items = self._sent_batches[batch_id]
+            if self._document_context and input_items[0].doc_id in waiting_documents:
+                process_id = None
+            elif self._document_context and input_items[0].doc_id in self._worker_documents:
+                process_id = self._worker_documents.index(input_items[0].doc_id)
+            else:
+                process_id = min(xrange(self._num_processes), key=lambda i: len(self._worker_load[i]))
+            if process_id is None or len(self._worker_load[process_id]) >= self.MAX_WORKER_LOAD:
+                if not self._document_context:
+                    self._waiting_batches.appendleft(batch_id)
+                    break
+                waiting.append(batch_id)
+                waiting_documents.add(input_items[-1].doc_id)
+                continue
+            self._worker_load[process_id].append(batch_id)
+            self._worker_documents[process_id] = input_items[-1].doc_id
+            self._input_queues[process_id].put((batch_id, input_items))
+        waiting.extend(self._waiting_batches)
+        self._waiting_batches = waiting
+
+    def _translate_locally(self, input_items):
+        """
+        Translates a batch of input items in the calling process and stores
+        the output items as if they came from a worker. The models are
+        loaded on first use.
+        """
+        if self._local_models is None:
+            self._local_models = self._load_theano()
+        trng, fs_init, fs_next, gen_sample_batch, f_sample = self._local_models
+        start = time.time()
+        search_stats = defaultdict(int)
+        output_items = self._translate_batch('main', input_items, trng, fs_init, fs_next, gen_sample_batch,
+                                             f_sample=f_sample, search_stats=search_stats)
+        self._count_batch('main', len(input_items), time.time() - start, search_stats)
+        for input_item, output_item in zip(input_items, output_items):
+            self._store_output(input_item.request_id, input_item.idx, output_item)
+
+    def _count_batch(self, process_id, n_sentences, busy_time, search_stats):
+        """
+        Adds a batch of @param n_sentences decoded by worker @param
+        process_id in @param busy_time seconds to the worker statistics, and
+        its beam search counters @param search_stats to the search
+        statistics.
+        """
+        self._busy_time[process_id] += busy_time
+        self._batches_done[process_id] += 1
+        self._sentences_done[process_id] += n_sentences
+        for name, value in search_stats.iteritems():
+            self._search_stats[name] += value
 
-            # stock the x forms of the words (convert from dictionaries)
-            xs = [[] for _ in range(len(aux_input_) + 1)]
-            # stock the words of the input (for each of the inputs)
-            words_s = [[] for _ in range(len(aux_input_) + 1)]
+    def _retrieve_jobs(self, num_samples, request_id, timeout=5, start=0):
+        """
+        Yields the output items of sentences @param start to @param start +
+        @param num_samples of request @param request_id in input order, as
+        soon as each one is available. Items that arrive out of order are kept
+        until it is their turn.
+        """
+        retrieved = self._retrieved_translations[request_id]
+        for idx in xrange(start, start + num_samples):
+            while idx not in retrieved:
+                self._receive_output(timeout)
+            yield retrieved.pop(idx)
+        self._forget_request(request_id)
+
+    def _receive_output(self, timeout=5):
+        """
+        Waits for the next batches of output items from the workers and
+        stores them (see `_store_output`). Crashed workers are restarted (see
+        `_check_workers`); this also returns once the segments they were
+        decoding have been given up on.
+        """
+        while True:
+            # a worker that crashes closes its pipe, so this does not wait for the timeout
+            ready, _, _ = select.select(self._output_pipes, [], [], timeout)
+            stored = False
+            for process_id, output_pipe in enumerate(self._output_pipes):
+                if output_pipe in ready:
+                    try:
+                        stored = self._read_output(process_id) or stored
+                    except EOFError:
+                        # the worker has crashed
+                        self._processes[process_id].join()
+            if self._check_workers() or stored:
+                return
+
+    def _read_output(self, process_id):
+        """
+        Reads a batch of output items from worker @param process_id and
+        stores them, and sends the worker its next batch. Returns whether
+        output items were stored: not if the batch was sent again after a
+        crash and another worker was faster. Raises EOFError if the worker
+        has crashed.
+        """
+        _, batch_id, output_items, busy_time, search_stats = self._output_pipes[process_id].recv()
+        if batch_id in self._worker_load[process_id]:
+            self._worker_load[process_id].remove(batch_id)
+        self._worker_crashes[process_id] = 0
+        self._dispatch()
+        input_items = self._sent_batches.pop(batch_id, None)
+        if input_items is None:
+            return False
+        self._count_batch(process_id, len(input_items), busy_time, search_stats)
+        for input_item, output_item in zip(input_items, output_items):
+            self._store_output(input_item.request_id, input_item.idx, output_item)
+        return True
+
+    def _check_workers(self):
+        """
+        Restarts the workers that have crashed and sends the batches on their
+        input queues again. The batch a worker crashed on is sent one segment
+        per batch, so that a segment that crashes a worker does not take the
+        others with it; a segment that crashes a worker on its own more than
+        `max_retries` times is given up on (its output item is None). Exits
+        if a worker crashes more than `max_retries` times in a row without
+        decoding anything (e.g. while loading the models). Returns whether
+        output items were stored: those the workers sent before crashing,
+        and those of the segments given up on.
+        """
+        stored = False
+        for process_id, process in enumerate(self._processes):
+            if process.is_alive() or process.exitcode == 0:
+                continue
+            # batches the worker decoded before it crashed
+            try:
+                while self._output_pipes[process_id].poll():
+                    stored = self._read_output(process_id) or stored
+            except EOFError:
+                pass
+            # the batch the worker was decoding, unless it crashed while loading the models or between batches
+            crashed_id = self._worker_batches[process_id]
+            if crashed_id not in self._sent_batches:
+                self._worker_crashes[process_id] += 1
+            if self._worker_crashes[process_id] > self._max_retries:
+                # kill all other processes and raise exception if one keeps dying
+                for pidx in xrange(self._num_processes):
+                    self._input_queues[pidx].cancel_join_thread()
+                    self._processes[pidx].terminate()
+                logging.error("Translate worker process {0} crashed with exitcode {1}".format(process.pid, process.exitcode))
+                sys.exit(1)
 
-            # stock words for each of the lines
-            for iidx, input in enumerate(line):
-                if translation_settings.char_level:
-                    words = list(input.decode('utf-8').strip())
-                else:
-                    words = input.strip().split()
-                words_s[iidx] = words
-
-                # stock factors
-                for w in words_s[iidx]:
-                    w = [self._word_dicts[iidx][j][f] if f in self._word_dicts[iidx][j] else 1 for (j, f) in enumerate(w.split('|'))]
-                    if len(w) != self._options[0]['factors']:
-                        logging.warning(
-                            'Expected {0} factors, but input word has {1}\n'.format(self._options[0]['factors'], len(w)))
-                        for midx in xrange(self._num_processes):
-                            self._processes[midx].terminate()
-                        sys.exit(1)
-                    xs[iidx].append(w)
-
-                xs[iidx] += [[0] * self._options[0]['factors']]
-                source_sentences[iidx].append(words_s[iidx])
-
-            input_item = QueueItem(verbose=self._verbose,
-                                   return_hyp_graph=translation_settings.get_search_graph,
-                                   return_alignment=translation_settings.get_alignment,
-                                   k=translation_settings.beam_width,
-                                   suppress_unk=translation_settings.suppress_unk,
-                                   normalization_alpha=translation_settings.normalization_alpha,
-                                   nbest=translation_settings.n_best,
-                                   seq=xs[0],
-                                   aux_seq=xs[1:],
-                                   idx=sidx,
-                                   request_id=translation_settings.request_id)
-            self._input_queue.put(input_item)
-
-        return sidx+1, tuple(source_sentences) #(source_sentences, source_sentences2)
-
-    def _retrieve_jobs(self, num_samples, request_id, timeout=5):
-        """
-        """
-        while len(self._retrieved_translations[request_id]) < num_samples:
-            resp = None
-            #print len(self._retrieved_translations[request_id]), num_samples
-            while resp is None:
+            logging.warning("Translate worker process {0} crashed with exitcode {1}; restarting it".format(
+                process.pid, process.exitcode))
+            self._input_queues[process_id].cancel_join_thread()
+            self._output_pipes[process_id].close()
+            batch_ids = self._worker_load[process_id]
+            self._worker_load[process_id] = []
+            self._start_process(process_id)
+
+            # batches not decoded yet go first
+            for batch_id in reversed(batch_ids):
+                if batch_id != crashed_id and batch_id in self._sent_batches:
+                    self._waiting_batches.appendleft(batch_id)
+            if crashed_id in self._sent_batches:
+                input_items = self._sent_batches.pop(crashed_id)
+                logging.warning("Segments {0} crashed the worker".format(' '.join(str(item.idx) for item in input_items)))
+                for input_item in input_items:
+                    if len(input_items) == 1:
+                        input_item.retries = getattr(input_item, 'retries', 0) + 1
+                    if getattr(input_item, 'retries', 0) > self._max_retries:
+                        logging.error("Segment {0} crashed a worker {1} times; giving up on it".format(
+                            input_item.idx, input_item.retries))
+                        self._store_output(input_item.request_id, input_item.idx, None)
+                        stored = True
+                    else:
+                        self._send_batch([input_item])
+        self._dispatch()
+        return stored
+
+    def _forget_request(self, request_id):
+        """
+        Removes the entries for @param request_id from the dictionaries,
+        unless more jobs are on their way.
+        """
+        if not (self._retrieved_translations[request_id] or self._pending_keys[request_id] or
+                self._duplicates[request_id]):
+            del self._retrieved_translations[request_id]
+            del self._pending_keys[request_id]
+            del self._duplicates[request_id]
+
+    def _translate_documents(self, lines, translation_settings, doc_ids=None):
+        """
+        Translates @param lines (tuples of the main and auxiliary input
+        lines) with the previous translation in the same document as first
+        auxiliary input (`translation_settings.predicted_trg`), and yields
+        the translations in input order.
+
+        Each document is a chain: a sentence is sent to the workers as soon
+        as the translation of the previous one is known. Documents do not
+        depend on each other, so the sentences of all documents up to
+        `translation_settings.chunk_size` lines ahead of the next translation
+        to yield are decoded in parallel. A document starts where the id in
+        @param doc_ids (one per line, if given) changes, or else where the
+        first auxiliary input line is empty or "<START>".
+        """
+        request_id = translation_settings.request_id
+        retrieved = self._retrieved_translations[request_id]
+        window = max(1, translation_settings.chunk_size)
+        lines = iter(lines)
+        doc_ids = iter(doc_ids) if doc_ids is not None else None
+
+        num_read = 0
+        exhausted = False
+        doc_id, previous_doc = self._last_document[0], None
+        # sentences whose previous translation is still being decoded, and previous translations whose next
+        # sentence has not been read yet
+        waiting = {}
+        targets = {}
+        # sentences that can be sent, sent and finished ones, and their words and document
+        ready = []
+        in_flight = set()
+        finished = set()
+        sources = {}
+        next_idx = 0
+        while True:
+            # read ahead
+            while not exhausted and num_read < next_idx + window:
                 try:
-                    resp = self._output_queue.get(True, timeout)
-                    #print resp
-                # if queue is empty after 5s, check if processes are still alive
-                except Empty:
-                    for midx in xrange(self._num_processes):
-                        #print 'exitcode =', self._processes[midx].exitcode
-                        #print 'alive =', self._processes[midx].is_alive()
-                        if not self._processes[midx].is_alive() and self._processes[midx].exitcode != 0:
-                            #print "not alive and not 0"
-                            # kill all other processes and raise exception if one dies
-                            self._input_queue.cancel_join_thread()
-                            self._output_queue.cancel_join_thread()
-                            for idx in xrange(self._num_processes):
-                                self._processes[idx].terminate()
-                            logging.error("Translate worker process {0} crashed with exitcode {1}".format(self._processes[midx].pid, self._processes[midx].exitcode))
-                            sys.exit(1)
-            request_id, idx, output_item = resp
-            self._retrieved_translations[request_id][idx] = output_item
-
-        for idx in xrange(num_samples):
-            yield self._retrieved_translations[request_id][idx]
-
-        # then remove all entries with this request ID from the dictionary
-        del self._retrieved_translations[request_id]
+                    line = next(lines)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if doc_ids is not None:
+                    doc = next(doc_ids).strip()
+                    new_document = num_read == 0 or doc != previous_doc
+                    previous_doc = doc
+                else:
+                    new_document = num_read == 0 or (len(line) > 1 and line[1].strip() in ('', '<START>'))
+                if new_document:
+                    doc_id += 1
+                    targets.pop(num_read - 1, None)
+                    ready.append((num_read, line, doc_id, None))
+                elif num_read - 1 in targets:
+                    ready.append((num_read, line, doc_id, targets.pop(num_read - 1)))
+                else:
+                    waiting[num_read] = (line, doc_id)
+                num_read += 1
+
+            # send what can be sent
+            if ready:
+                input_items = []
+                cache_keys = []
+                for idx, line, doc, previous in ready:
+                    if previous is None:
+                        previous = '<START>'
+                    else:
+                        previous = ('' if translation_settings.char_level else ' ').join(previous)
+                    segments = (line[0], previous) + tuple(line[2:])
+                    input_item, words_s = self._make_input_item(idx, segments, translation_settings, doc_id=doc)
+                    sources[idx] = words_s
+                    input_items.append(input_item)
+                    cache_keys.append(self._cache_key(segments, translation_settings))
+                    in_flight.add(idx)
+                ready = []
+                self._put_batches(self._filter_cached(input_items, cache_keys, request_id), translation_settings)
+
+            # yield what is finished, in input order
+            while next_idx in finished:
+                finished.remove(next_idx)
+                words_s = sources.pop(next_idx)
+                yield self._make_translation(next_idx, retrieved.pop(next_idx), words_s[0], words_s[1:],
+                                             translation_settings)
+                next_idx += 1
+            if exhausted and next_idx == num_read:
+                break
 
+            # results of cached and repeated segments may already be there
+            done = [idx for idx in in_flight if idx in retrieved]
+            if not done:
+                self._receive_output()
+                continue
+            for idx in sorted(done):
+                in_flight.remove(idx)
+                finished.add(idx)
+                if retrieved[idx] is None:
+                    target_words = []
+                else:
+                    samples, scores = retrieved[idx][:2]
+                    if translation_settings.n_best is True:
+                        samples = samples[numpy.argmin(scores)]
+                    target_words = seqs2words(samples, self._word_idict_trg, join=False)
+                # hand the translation on to the next sentence of the document
+                if idx + 1 in waiting:
+                    line, doc = waiting.pop(idx + 1)
+                    ready.append((idx + 1, line, doc, target_words))
+                elif idx + 1 >= num_read:
+                    targets[idx] = target_words
 
-    def translate_no_queue(self, input_, aux_input_, translation_settings):
+        self._last_document = (doc_id, None)
+        self._forget_request(request_id)
 
-        1
 
+    def translate_no_queue(self, input_, aux_input_, translation_settings):
+        """
+        Translates @param input_ (and @param aux_input_ if multi-source) in
+        the calling process, without going through the worker queues, and
+        returns the translations. This is what `translate` does without
+        workers (`num_processes` 0); with workers, the models are loaded in
+        the calling process as well on first use.
+        """
+        request_id = translation_settings.request_id
+        input_items = []
+        cache_keys = []
+        source_sentences = []
+        for idx, line in enumerate(zip(input_, *aux_input_)):
+            input_item, words_s = self._make_input_item(idx, line, translation_settings,
+                                                        doc_id=self._next_document(line))
+            input_items.append(input_item)
+            cache_keys.append(self._cache_key(line, translation_settings))
+            source_sentences.append(words_s)
+
+        for batch in self._make_batches(self._filter_cached(input_items, cache_keys, request_id),
+                                        translation_settings):
+            self._translate_locally(batch)
+
+        retrieved = self._retrieved_translations[request_id]
+        translations = []
+        for idx, words_s in enumerate(source_sentences):
+            translations.append(self._make_translation(idx, retrieved.pop(idx), words_s[0], words_s[1:],
+                                                       translation_settings))
+        self._forget_request(request_id)
+        return translations
 
     ### EXPOSED TRANSLATION FUNCTIONS ###
     # modified to use predicted translations when using previous target sentence as additional input
 
-    def translate(self, source_segments, translation_settings, aux_source_segments=[]):
+    def _make_translation(self, i, trans, source_words, current_aux, translation_settings):
         """
-        Returns the translation of @param source_segments (and @param aux_source_segments if multi-source)
+        Converts the output item @param trans of sentence @param i into a
+        `Translation` (or an n-best list of them).
         """
-        logging.info('Translating {0} segments...\n'.format(len(source_segments)))
-        if len(aux_source_segments) > 0:
-            n_samples, multiple_source_sentences = self._send_jobs_multisource(source_segments,
-                                                                               aux_source_segments,
-                                                                               translation_settings)
-        else:
-            # TODO: make this one the generic send jobs
-            n_samples, multiple_source_sentences = self._send_jobs_multisource(source_segments, [], translation_settings)
-
-        #os.sys.stderr.write(str(translation_settings.predicted_trg)+"\n")
-
-        translations = []
-
-        for i, trans in enumerate(self._retrieve_jobs(n_samples, translation_settings.request_id)):
-
-            # previous target sentence (take predicted previous sentence)
-            if translation_settings.predicted_trg and aux_source_segments:
-                if i==0:
-                    current_aux = "<START>"
-                else:
-                    os.sys.stderr.write("Using previous translation...")
-                    current_aux = translations[i-1]
-
-            # just use the auxiliary input provided
-            else:
-                # handle potential multi-source input
-                current_aux = [ss[i] for ss in multiple_source_sentences[1:]]
-
-            samples, scores, word_probs, alignments, hyp_graph = trans
-
-            # n-best list
-            if translation_settings.n_best is True:
-                order = numpy.argsort(scores)
-                n_best_list = []
-                for j in order:
-                    current_alignment = None if not translation_settings.get_alignment else alignments[0][j]
-
-                    aux_current_alignments = [] # list for multi-source
-                    for e in range(len(self.num_encoders - 1)):
-                        aux_current_alignments.append(None if not translation_settings.get_alignment else alignments[e + 1][j])
-
-                    translation = Translation(sentence_id=i,
-                                              source_words=multiple_source_sentences[0][i],
-                                              target_words=seqs2words(samples[j], self._word_idict_trg, join=False),
-                                              score=scores[j],
-                                              alignment=current_alignment,
-                                              target_probs=word_probs[j],
-                                              hyp_graph=hyp_graph,
-                                              hypothesis_id=j,
-                                              aux_source_words=current_aux, # list of extra inputs
-                                              aux_alignment=aux_current_alignments)
-                    n_best_list.append(translation)
-                translations.append(n_best_list)
-            # single-best translation
-            else:
-                current_alignment = None if not translation_settings.get_alignment else alignments[0]
+        # segment given up on after crashing the workers
+        if trans is None:
+            translation = Translation(sentence_id=i,
+                                      source_words=source_words,
+                                      target_words=[],
+                                      score=numpy.inf,
+                                      target_probs=[],
+                                      aux_source_words=current_aux,
+                                      failed=True)
+            return [translation] if translation_settings.n_best is True else translation
+
+        samples, scores, word_probs, alignments, hyp_graph = trans
+
+        # n-best list
+        if translation_settings.n_best is True:
+            order = numpy.argsort(scores)
+            n_best_list = []
+            for j in order:
+                current_alignment = None if not translation_settings.get_alignment else alignments[0][j]
 
-                aux_current_alignments = []  # list for multi-source
+                aux_current_alignments = [] # list for multi-source
                 for e in range(self.num_encoders - 1):
-                    aux_current_alignments.append(None if not translation_settings.get_alignment else alignments[e + 1])
+                    aux_current_alignments.append(None if not translation_settings.get_alignment else alignments[e + 1][j])
 
                 translation = Translation(sentence_id=i,
-                                          source_words=multiple_source_sentences[0][i],
-                                          target_words=seqs2words(samples, self._word_idict_trg, join=False),
-                                          score=scores,
+                                          source_words=source_words,
+                                          target_words=seqs2words(samples[j], self._word_idict_trg, join=False),
+                                          score=scores[j],
                                           alignment=current_alignment,
-                                          target_probs=word_probs,
+                                          target_probs=word_probs[j],
                                           hyp_graph=hyp_graph,
+                                          hypothesis_id=j,
                                           aux_source_words=current_aux, # list of extra inputs
                                           aux_alignment=aux_current_alignments)
-                translations.append(translation)
-        return translations
-
-    def translate_file(self, input_object, translation_settings, aux_input_objects=[]):
+                n_best_list.append(translation)
+            return n_best_list
+        # single-best translation
+        else:
+            current_alignment = None if not translation_settings.get_alignment else alignments[0]
+
+            aux_current_alignments = []  # list for multi-source
+            for e in range(self.num_encoders - 1):
+                aux_current_alignments.append(None if not translation_settings.get_alignment else alignments[e + 1])
+
+            return Translation(sentence_id=i,
+                               source_words=source_words,
+                               target_words=seqs2words(samples, self._word_idict_trg, join=False),
+                               score=scores,
+                               alignment=current_alignment,
+                               target_probs=word_probs,
+                               hyp_graph=hyp_graph,
+                               aux_source_words=current_aux, # list of extra inputs
+                               aux_alignment=aux_current_alignments)
+
+    def _retrieve_translations(self, n_samples, multiple_source_sentences, translation_settings, start=0):
         """
+        Yields the translations of @param n_samples segments, sent to the
+        workers starting with sentence id @param start, in input order.
         """
-        source_segments = input_object.readlines()
-        # multi-source
-        aux_source_segments = []
+        for i, trans in enumerate(self._retrieve_jobs(n_samples, translation_settings.request_id, start=start)):
+            # handle potential multi-source input
+            current_aux = [ss[i] for ss in multiple_source_sentences[1:]]
+            yield self._make_translation(start + i, trans, multiple_source_sentences[0][i],
+                                         current_aux, translation_settings)
 
-        for aux in aux_input_objects:
-            aux_source_segments.append(aux.readlines())
+    def translate(self, source_segments, translation_settings, aux_source_segments=[], doc_ids=None):
+        """
+        Returns the translation of @param source_segments (and @param aux_source_segments if multi-source).
+        With `translation_settings.predicted_trg`, @param doc_ids optionally
+        gives the document of each segment (see `_translate_documents`).
+        """
+        logging.info('Translating {0} segments...\n'.format(len(source_segments)))
+        if translation_settings.predicted_trg and self.multisource:
+            return list(self._translate_documents(zip(source_segments, *aux_source_segments),
+                                                  translation_settings, doc_ids=doc_ids))
+        if self._num_processes == 0:
+            return self.translate_no_queue(source_segments, aux_source_segments, translation_settings)
+        n_samples, multiple_source_sentences = self._send_jobs_multisource(source_segments,
+                                                                           aux_source_segments,
+                                                                           translation_settings)
+        return list(self._retrieve_translations(n_samples, multiple_source_sentences, translation_settings))
+
+    def translate_stream(self, input_object, translation_settings, aux_input_objects=[], doc_index_object=None):
+        """
+        Translates @param input_object (and @param aux_input_objects if
+        multi-source) and yields the translations in input order as soon as
+        they are available.
+
+        The input is read lazily, `translation_settings.chunk_size` lines at
+        a time. The next chunk is sent to the workers before the translations
+        of the current one are yielded, so at most two chunks are in flight
+        and memory use does not grow with the input.
+
+        With `translation_settings.predicted_trg`, the documents are decoded
+        as chains of sentences instead (see `_translate_documents`), and
+        @param doc_index_object optionally gives the document id of each
+        line.
+        """
+        # readline (rather than file iteration) does not wait for a full read-ahead buffer on pipes
+        lines = itertools.izip(*[iter(f.readline, '') for f in [input_object] + list(aux_input_objects)])
+        chunk_size = max(1, translation_settings.chunk_size)
+
+        if translation_settings.predicted_trg and self.multisource:
+            doc_ids = iter(doc_index_object.readline, '') if doc_index_object is not None else None
+            for translation in self._translate_documents(lines, translation_settings, doc_ids=doc_ids):
+                yield translation
+            return
+
+        pending = deque()
+        start = 0
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if chunk:
+                logging.info('Translating segments {0} to {1}...\n'.format(start, start + len(chunk) - 1))
+                segments = zip(*chunk)
+                n_samples, multiple_source_sentences = self._send_jobs_multisource(segments[0],
+                                                                                   segments[1:],
+                                                                                   translation_settings,
+                                                                                   start=start)
+                pending.append((start, n_samples, multiple_source_sentences))
+                start += n_samples
+            if not pending:
+                break
+            if len(pending) > 1 or not chunk:
+                chunk_start, n_samples, multiple_source_sentences = pending.popleft()
+                for translation in self._retrieve_translations(n_samples, multiple_source_sentences,
+                                                               translation_settings, start=chunk_start):
+                    yield translation
 
-        return self.translate(source_segments, translation_settings, aux_source_segments=aux_source_segments)
+    def translate_file(self, input_object, translation_settings, aux_input_objects=[]):
+        """
+        """
+        return list(self.translate_stream(input_object, translation_settings, aux_input_objects=aux_input_objects))
 
 
     def translate_string(self, segment, translation_settings):
@@ -754,6 +1597,10 @@ class Translator(object):
         else:
             output_file.write("\n".join(output_items) + "\n")
 
+        # nothing more to write for a segment given up on
+        if translation.failed:
+            return
+
         # write alignments to file?
         if translation_settings.get_alignment:
             self.write_alignment(translation, translation_settings)
@@ -779,20 +1626,26 @@ class Translator(object):
             for nbest_list in translations:
                 for translation in nbest_list:
                     self.write_translation(output_file, translation, translation_settings)
+                output_file.flush()
         else:
             for translation in translations:
                 self.write_translation(output_file, translation, translation_settings)
+                output_file.flush()
 
 
-def main(input_file, output_file, decoder_settings, translation_settings, aux_input_files=[]):
+def main(input_file, output_file, decoder_settings, translation_settings, aux_input_files=[], doc_index_file=None):
     """
     Translates a source language file (or STDIN) into a target language file
     (or STDOUT).
     """
     translator = Translator(decoder_settings)
+    start = time.time()
 
     # set encoder number and multi-source bool
-    if len(aux_input_files) > 0:
+    if translation_settings.predicted_trg and translator._options[0]['multisource_type'] is not None:
+        # the first auxiliary input is the previous translation, so the model decides the number of inputs
+        translator.multisource = True
+    elif len(aux_input_files) > 0:
         translator.num_encoders = len(aux_input_files) + 1
         if translator._options[0]['multisource_type'] != 'init-decoder':
             translator.num_attentions = len(aux_input_files) + 1
@@ -803,10 +1656,23 @@ def main(input_file, output_file, decoder_settings, translation_settings, aux_in
         translator.multisource = False
         translator.num_encoders = 1
 
-    translations = translator.translate_file(input_file, translation_settings, aux_input_objects=aux_input_files)
+    translations = translator.translate_stream(input_file, translation_settings, aux_input_objects=aux_input_files,
+                                               doc_index_object=doc_index_file)
 
     translator.write_translations(output_file, translations, translation_settings)
 
+    elapsed = time.time() - start
+    for stats in translator.get_worker_stats():
+        logging.info('Worker {0}: {1} sentences in {2} batches, busy {3:.1f}s of {4:.1f}s ({5:.0%})'.format(
+            stats['process_id'], stats['sentences'], stats['batches'], stats['busy'], elapsed,
+            stats['busy'] / elapsed if elapsed else 0.))
+    if translation_settings.early_stopping:
+        stats = translator.get_search_stats()
+        logging.info('Early stopping ended the search of {0} of {1} sentences after {2} steps in total, dropping {3} '
+                     'live hypotheses: at most {4} steps and {5} of {6} hypothesis scorings saved'.format(
+                         stats.get('early_stopped', 0), stats.get('sentences', 0), stats.get('steps', 0),
+                         stats.get('hyps_dropped', 0), stats.get('steps_saved', 0), stats.get('hyps_saved', 0),
+                         stats.get('hyps_scored', 0) + stats.get('hyps_saved', 0)))
     logging.info('Done')
     translator.shutdown()
 
@@ -829,4 +1695,5 @@ if __name__ == "__main__":
     # start logging
     level = logging.DEBUG if decoder_settings.verbose else logging.WARNING
     logging.basicConfig(level=level, format='%(levelname)s: %(message)s')
-    main(input_file, output_file, decoder_settings, translation_settings, aux_input_files=aux_input_file)
+    main(input_file, output_file, decoder_settings, translation_settings, aux_input_files=aux_input_file,
+         doc_index_file=args.document_index)
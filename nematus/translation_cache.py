@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Size-bounded cache of decoding results, so that repeated segments are not
+translated again. Entries are evicted in least-recently-used order; they can
+optionally be kept in a local on-disk store that survives restarts.
+"""
+
+import os
+import json
+import shelve
+import hashlib
+import logging
+import threading
+
+from collections import OrderedDict
+
+from model_dir import is_model_dir, MANIFEST
+
+
+def file_fingerprint(path):
+    """
+    Returns the size, modification time and SHA-1 hash of the file @param
+    path, or None if it does not exist.
+    """
+    if not os.path.isfile(path):
+        return None
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime, sha1.hexdigest()]
+
+
+def model_fingerprint(path):
+    """
+    Returns a fingerprint of the model at @param path and of its `.json`
+    config, for cache keys, so that an on-disk cache is not reused after a
+    model file has been replaced under the same name. The arrays of a model
+    directory are not hashed: its manifest is, and their sizes and
+    modification times are included.
+    """
+    if is_model_dir(path):
+        arrays = [[name, os.path.getsize(os.path.join(path, name)), os.path.getmtime(os.path.join(path, name))]
+                  for name in sorted(os.listdir(path)) if name.endswith('.npy')]
+        params = [file_fingerprint(os.path.join(path, MANIFEST)), arrays]
+    elif os.path.isfile(path):
+        params = file_fingerprint(path)
+    else:
+        params = file_fingerprint(path + '.npz')
+    return [params, file_fingerprint(path + '.json')]
+
+
+class TranslationCache(object):
+    """
+    LRU cache of worker output items, keyed on the model set, the segment(s)
+    and the translation settings that affect the output.
+    """
+
+    def __init__(self, max_size, filename=None):
+        """
+        Keeps at most @param max_size entries. If @param filename is given,
+        entries are also written to (and at startup read from) a `shelve`
+        database at this path.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if filename is None:
+            self._store = None
+        else:
+            self._store = shelve.open(filename, protocol=2)
+            for key in self._store.keys():
+                if len(self._entries) >= self.max_size:
+                    del self._store[key]
+                else:
+                    self._entries[key] = self._store[key]
+            logging.info('Loaded {0} cached translations from {1}'.format(len(self._entries), filename))
+
+    @staticmethod
+    def make_key(*fields):
+        """
+        Builds a cache key from JSON-serialisable @param fields. Byte strings
+        are decoded as latin-1, which maps any input to a distinct key.
+        """
+        return json.dumps(fields, encoding='latin-1')
+
+    def get(self, key):
+        """
+        Returns the entry for @param key, or None on a miss.
+        """
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            # re-insert as most recently used
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Adds an entry, evicting the least recently used ones if the cache is
+        full.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if self._store is not None:
+                self._store[key] = value
+            while len(self._entries) > self.max_size:
+                evicted, _ = self._entries.popitem(last=False)
+                if self._store is not None:
+                    del self._store[evicted]
+
+    def stats(self):
+        """
+        Returns the current size and the hit/miss counters.
+        """
+        return {'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses}
+
+    def close(self):
+        """
+        Writes the on-disk store, if any.
+        """
+        if self._store is not None:
+            self._store.close()
+            self._store = None
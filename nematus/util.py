@@ -2,10 +2,15 @@
 Utility functions
 '''
 
+import os
 import sys
 import json
+import mmap
 import cPickle as pkl
 import re
+from collections import OrderedDict
+
+import numpy
 
 #json loads strings as unicode; we currently still work with Python 2 strings, and need conversion
 def unicode_to_utf8(d):
@@ -49,3 +54,72 @@ def seqs2words(seq, inverse_target_dictionary, join=True):
         else:
             words.append('UNK')
     return ' '.join(words) if join else words
+
+
+def config_floatX():
+    """
+    Returns Theano's floatX setting (from THEANO_FLAGS, then from the
+    .theanorc files, float32 by default) without importing Theano, which
+    would initialise the device in the calling process.
+    """
+    from ConfigParser import SafeConfigParser
+
+    for flag in os.environ.get('THEANO_FLAGS', '').split(','):
+        key, _, value = flag.partition('=')
+        if key.strip() == 'floatX':
+            return value.strip()
+    default_rc = os.pathsep.join(['~/.theanorc', '~/.theanorc.txt'])
+    theanorc = [os.path.expanduser(f) for f in os.environ.get('THEANORC', default_rc).split(os.pathsep)]
+    config = SafeConfigParser()
+    config.read(theanorc)
+    if config.has_option('global', 'floatX'):
+        return config.get('global', 'floatX')
+    return 'float32'
+
+
+def load_shared_params(path, dtype='float32'):
+    """
+    Loads the model parameters (not the optimizer state) from the archive
+    @param path into anonymous shared memory, as read-only arrays of type
+    @param dtype (int8 parameters are dequantized first). Processes forked
+    afterwards read the same physical pages instead of holding their own
+    copies, and can use them without conversion if @param dtype is floatX.
+    Arrays of a model directory (see model_dir.py) that already have this
+    type are simply memory-mapped, which shares them as well.
+    """
+    from model_dir import open_params
+    archive = open_params(path)
+    params = OrderedDict()
+    for name in archive.files:
+        if name.startswith('adam_') or name == 'zipped_params':
+            continue
+        value = archive[name]
+        if isinstance(value, numpy.memmap) and value.dtype == dtype:
+            params[name] = value
+            continue
+        value = value.astype(dtype, copy=False)
+        buf = mmap.mmap(-1, max(value.nbytes, 1))
+        shared = numpy.frombuffer(buf, dtype=value.dtype, count=value.size).reshape(value.shape)
+        shared[...] = value
+        shared.flags.writeable = False
+        params[name] = shared
+    return params
+
+
+def process_memory(pid):
+    """
+    Returns the resident memory of process @param pid in kB, in total (rss)
+    and split into private (anon), file-backed (file) and shared memory
+    (shmem), as far as /proc reports it (Linux only; empty otherwise).
+    """
+    fields = {'VmRSS': 'rss', 'RssAnon': 'anon', 'RssFile': 'file', 'RssShmem': 'shmem'}
+    memory = {}
+    try:
+        with open('/proc/{0}/status'.format(pid)) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in fields:
+                    memory[fields[key]] = int(value.split()[0])
+    except IOError:
+        pass
+    return memory
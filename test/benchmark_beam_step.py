@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark of the candidate selection in a beam search step
+(`nmt.gen_sample_batch`), with f_next returning probabilities or
+log-probabilities. The models are replaced by functions that return fixed
+random distributions, so only the work done outside of Theano is timed.
+
+As a baseline, the selection alone is also timed as it was done before
+(`argpartition` over the flattened live_k x V scores of each sentence) and
+as it is done now (the k best words of each hypothesis, then the k best of
+these k x k candidates of each sentence).
+"""
+
+import sys
+import os
+import argparse
+import time
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+from nmt import gen_sample_batch
+from theano_util import floatX
+
+
+def fake_sampler(n_sent, k, voc_size, log_probs, dim=8, seed=1234):
+    rng = numpy.random.RandomState(seed)
+    p = rng.uniform(size=(n_sent * k, voc_size)).astype(floatX)
+    # no EOS, so every step keeps the full beam
+    p[:, 0] = 1e-12
+    p /= p.sum(1)[:, None]
+    if log_probs:
+        p = numpy.log(p)
+
+    def f_init(x, x_mask):
+        return [numpy.zeros((1, n_sent, dim), dtype=floatX), x, x]
+
+    def f_next(next_w, ctx, pctx, x_mask, hyp_sents, state):
+        return [p[:len(next_w)], None, numpy.zeros((1, len(next_w), dim), dtype=floatX)]
+
+    return f_init, f_next
+
+
+def select_flat(cand_scores, k, n_sent):
+    voc_size = cand_scores.shape[1]
+    selected = []
+    for s in range(n_sent):
+        rows = numpy.arange(s * k, (s + 1) * k)
+        ranks_flat = cand_scores[rows].flatten().argpartition(k - 1)[:k]
+        selected.append((rows[ranks_flat // voc_size], ranks_flat % voc_size))
+    return selected
+
+
+def select_per_row(cand_scores, k, n_sent):
+    best_columns = cand_scores.argpartition(k - 1, axis=1)[:, :k]
+    best_scores = cand_scores[numpy.arange(len(cand_scores))[:, None], best_columns]
+    selected = []
+    for s in range(n_sent):
+        rows = numpy.arange(s * k, (s + 1) * k)
+        ranks_flat = best_scores[rows].flatten().argpartition(k - 1)[:k]
+        trans_indices = rows[ranks_flat // k]
+        selected.append((trans_indices, best_columns[trans_indices, ranks_flat % k]))
+    return selected
+
+
+def time_selection(select, voc_size, k, n_sent, steps):
+    rng = numpy.random.RandomState(1234)
+    cand_scores = rng.uniform(size=(n_sent * k, voc_size)).astype(floatX)
+    start = time.time()
+    for _ in range(steps):
+        select(cand_scores, k, n_sent)
+    return (time.time() - start) / steps
+
+
+def time_step(voc_size, k, n_sent, n_models, log_probs, steps):
+    x = numpy.zeros((1, 5, n_sent), dtype='int64')
+    x_mask = numpy.ones((5, n_sent), dtype=floatX)
+    samplers = [fake_sampler(n_sent, k, voc_size, log_probs, seed=i) for i in range(n_models)]
+    fs_init = [f_init for f_init, _ in samplers]
+    fs_next = [f_next for _, f_next in samplers]
+    start = time.time()
+    gen_sample_batch(fs_init, fs_next, [x], [x_mask], k=k, maxlen=steps, log_probs=log_probs)
+    return (time.time() - start) / steps
+
+
+def main(vocab_sizes, k, n_sent, n_models, steps):
+    sys.stdout.write('beam size {0}, {1} sentences, {2} model(s): ms per step\n'.format(k, n_sent, n_models))
+    sys.stdout.write('{0:>8} {1:^30} {2:^30}\n'.format('', 'selection only', 'whole step'))
+    sys.stdout.write('{0:>8} {1:>10} {2:>10} {3:>8} {4:>10} {5:>10} {6:>8}\n'.format(
+        'vocab', 'flat', 'per row', 'speedup', 'probs', 'log-probs', 'speedup'))
+    for voc_size in vocab_sizes:
+        t_flat = time_selection(select_flat, voc_size, k, n_sent, steps)
+        t_per_row = time_selection(select_per_row, voc_size, k, n_sent, steps)
+        t_probs = time_step(voc_size, k, n_sent, n_models, False, steps)
+        t_log_probs = time_step(voc_size, k, n_sent, n_models, True, steps)
+        sys.stdout.write('{0:>8} {1:>10.2f} {2:>10.2f} {3:>7.1f}x {4:>10.2f} {5:>10.2f} {6:>7.1f}x\n'.format(
+            voc_size, t_flat * 1000, t_per_row * 1000, t_flat / t_per_row,
+            t_probs * 1000, t_log_probs * 1000, t_probs / t_log_probs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the candidate selection of a beam search step")
+    parser.add_argument('--vocab-sizes', type=int, nargs='+', default=[1000, 30000, 90000], metavar='INT',
+                        help="Vocabulary sizes (default: %(default)s)")
+    parser.add_argument('-k', type=int, default=12, help="Beam size (default: %(default)s)")
+    parser.add_argument('--sentences', type=int, default=10, metavar='INT',
+                        help="Sentences per batch (default: %(default)s)")
+    parser.add_argument('--models', type=int, default=1, metavar='INT',
+                        help="Models in the ensemble (default: %(default)s)")
+    parser.add_argument('--steps', type=int, default=20, metavar='INT',
+                        help="Decoding steps to time (default: %(default)s)")
+    args = parser.parse_args()
+
+    main(args.vocab_sizes, args.k, args.sentences, args.models, args.steps)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Latency of translating single segments (`Translator.translate_string`) in the
+calling process (`-p 0`, see `Translator.translate_no_queue`) and through one
+worker process and its queues (`-p 1`). Model loading is not timed.
+"""
+
+import sys
+import os
+import argparse
+import time
+
+sys.path.append(os.path.abspath('../nematus'))
+from translate import Translator
+from settings import DecoderSettings, TranslationSettings
+
+
+def time_segments(models, num_processes, segments, k, repeat):
+    decoder_settings = DecoderSettings()
+    decoder_settings.models = models
+    decoder_settings.num_processes = num_processes
+    translation_settings = TranslationSettings()
+    translation_settings.beam_width = k
+    translation_settings.request_id = 0
+
+    translator = Translator(decoder_settings)
+    # the first request waits for the worker to load the models
+    translator.translate_string(segments[0], translation_settings)
+    times = []
+    for _ in range(repeat):
+        for segment in segments:
+            start = time.time()
+            translator.translate_string(segment, translation_settings)
+            times.append(time.time() - start)
+    translator.shutdown()
+    return times
+
+
+def main(models, segments, k, repeat):
+    sys.stdout.write('{0} segment(s), beam size {1}: ms per segment\n'.format(len(segments), k))
+    sys.stdout.write('{0:>10} {1:>10} {2:>10} {3:>10}\n'.format('processes', 'mean', 'min', 'max'))
+    for num_processes in [0, 1]:
+        times = time_segments(models, num_processes, segments, k, repeat)
+        sys.stdout.write('{0:>10} {1:>10.2f} {2:>10.2f} {3:>10.2f}\n'.format(
+            num_processes, sum(times) / len(times) * 1000, min(times) * 1000, max(times) * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time single-segment translation with and without worker processes")
+    parser.add_argument('--models', '-m', type=str, nargs='+', required=True, metavar='MODEL',
+                        help="Model(s) to use")
+    parser.add_argument('--input', '-i', type=argparse.FileType('r'), default=sys.stdin, metavar='PATH',
+                        help="Segments to translate, one per line (default: standard input)")
+    parser.add_argument('-k', type=int, default=5, help="Beam size (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3, metavar='INT',
+                        help="Number of times each segment is translated (default: %(default)s)")
+    args = parser.parse_args()
+
+    main(args.models, args.input.readlines(), args.k, args.repeat)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import unittest
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+from encoder_cache import DocumentEncoder
+
+
+def fake_encode(x, x_mask):
+    # context: the token ids, one dimension per time step and sentence
+    return x[0][:, :, None].astype('float32') * x_mask[:, :, None]
+
+
+def fake_init_state(*inps):
+    ctxs = inps[0::2]
+    return [numpy.zeros((ctxs[0].shape[1], 2), dtype='float32')] + [ctx * 2 for ctx in ctxs]
+
+
+def prepare(seqs):
+    max_len = max(len(seq) for seq in seqs)
+    x = numpy.zeros((1, max_len, len(seqs)), dtype='int64')
+    x_mask = numpy.zeros((max_len, len(seqs)), dtype='float32')
+    for s, seq in enumerate(seqs):
+        x[0, :len(seq), s] = seq
+        x_mask[:len(seq), s] = 1.
+    return x, x_mask
+
+
+class TestDocumentEncoder(unittest.TestCase):
+    """
+    Tests for the reuse of encoder contexts across the sentences of a
+    document, with two encoders of the same weights
+    """
+
+    def setUp(self):
+        self.encoder = DocumentEncoder([fake_encode, fake_encode], fake_init_state, [0, 0])
+
+    def translate(self, doc_id, main, aux):
+        self.encoder.set_documents([doc_id])
+        return self.encoder(*(prepare([main]) + prepare([aux])))
+
+    def test_reuse(self):
+        sentences = [[3, 4, 0], [5, 0], [6, 7, 8, 0]]
+        previous = [2, 0]
+        for sentence in sentences:
+            init_state, ctx_main, ctx_aux, pctx_main, pctx_aux = self.translate(0, sentence, previous)
+            self.assertTrue(numpy.array_equal(ctx_main[:, 0, 0], sentence))
+            self.assertTrue(numpy.array_equal(ctx_aux[:, 0, 0], previous))
+            previous = sentence
+        # the auxiliary context of each sentence after the first is the main context of the previous one
+        self.assertEqual(self.encoder.hits, 2)
+        self.assertEqual(self.encoder.misses, 4)
+
+    def test_eviction(self):
+        # one segment per call, each in a new document: the cache does not grow
+        for doc_id in xrange(50):
+            self.translate(doc_id, [doc_id + 2, 0], [doc_id + 3, 0])
+            self.assertLessEqual(len(self.encoder), 2)
+
+    def test_long_document(self):
+        # one segment per call, all in one document: only the contexts of the last call are kept
+        previous = [2, 0]
+        for i in xrange(50):
+            sentence = [i + 3, i + 4, 0]
+            self.translate(0, sentence, previous)
+            previous = sentence
+            self.assertLessEqual(len(self.encoder), 3)
+        self.assertEqual(self.encoder.hits, 49)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the multi-source decoder layer (multi_gru_cond_layer):
+small models with random weights must give the same cost, alignments and
+sampler outputs as with the 2- and 3-input layers it replaced
+(bi_gru_cond_layer, tri_gru_cond_layer), which were recorded in
+multisource/layers.json with
+
+THEANO_FLAGS=floatX=float32,device=cpu python test_multisource_layers.py --record
+"""
+
+import sys
+import os
+import inspect
+import json
+import unittest
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+import theano
+import nmt
+from theano_util import init_theano_params, floatX
+from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+
+REFERENCE = os.path.join('multisource', 'layers.json')
+
+# number of inputs, multisource_type, layer normalisation
+CONFIGS = [(2, 'att-concat', False),
+           (2, 'att-gate', False),
+           (2, 'att-hier', False),
+           (2, 'att-concat', True),
+           (3, 'att-hier', False),
+           (3, 'att-hier', True)]
+
+
+def config_name(num_inputs, multisource_type, layer_normalisation):
+    return '{0}-{1}{2}'.format(num_inputs, multisource_type, '-ln' if layer_normalisation else '')
+
+
+def build_options(num_inputs, multisource_type, layer_normalisation):
+    spec = inspect.getargspec(nmt.train)
+    options = dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+    options.update(dim_word=8, dim=6, n_words=20, n_words_src=[15] * num_inputs, dim_per_factor=[8], factors=1,
+                   extra_sources=['x'] * (num_inputs - 1), multisource_type=multisource_type,
+                   layer_normalisation=layer_normalisation, enc_depth_bidirectional=1)
+    return options
+
+
+def run_model(num_inputs, multisource_type, layer_normalisation):
+    """
+    Returns the cost and alignments of a batch of 3 sentence pairs, and the
+    output of one step of f_next (target word probabilities, state and
+    alignments) for 4 hypotheses, with a model with random weights.
+    """
+    options = build_options(num_inputs, multisource_type, layer_normalisation)
+    numpy.random.seed(1)
+    params = nmt.init_params(options)
+    for name in params:
+        params[name] = numpy.random.uniform(-.5, .5, params[name].shape).astype(floatX)
+    tparams = init_theano_params(params)
+
+    # inputs of different lengths, with padding
+    rng = numpy.random.RandomState(2)
+    xs, x_masks = [], []
+    for length in [4, 7, 3][:num_inputs]:
+        xs.append(rng.randint(1, 15, size=(1, length, 3)).astype('int64'))
+        x_mask = numpy.ones((length, 3), dtype=floatX)
+        x_mask[length - 1:, 0] = 0
+        x_mask[length - 2:, 2] = 0
+        x_masks.append(x_mask)
+    y = rng.randint(1, 20, size=(5, 3)).astype('int64')
+    y_mask = numpy.ones((5, 3), dtype=floatX)
+    inputs = []
+    for x, x_mask in zip(xs, x_masks):
+        inputs += [x, x_mask]
+
+    trng, use_noise, x_vars, x_mask_vars, y_var, y_mask_var, opt_ret, cost = nmt.build_multisource_model(tparams,
+                                                                                                       options)
+    cost_inps = []
+    for x_var, x_mask_var in zip(x_vars, x_mask_vars):
+        cost_inps += [x_var, x_mask_var]
+    f_cost = theano.function(cost_inps + [y_var, y_mask_var],
+                             [cost] + [opt_ret['dec_alphas' + str(i)] for i in range(num_inputs)],
+                             on_unused_input='ignore')
+    outputs = f_cost(*(inputs + [y, y_mask]))
+
+    f_init, f_next = nmt.build_multi_sampler(tparams, options, use_noise, RandomStreams(3), return_alignment=True)
+    init = f_init(*inputs)
+    init_state, ctxs, pctxs = init[0], init[1:1 + num_inputs], init[1 + num_inputs:]
+    sentence_idx = numpy.array([0, 1, 2, 2], dtype='int64')
+    prev_words = numpy.array([-1, 3, 4, 5], dtype='int64')
+    step = f_next(*([prev_words] + list(ctxs) + list(pctxs) + x_masks + [sentence_idx, init_state[:, sentence_idx]]))
+    # leave out the sampled words
+    outputs += [step[0]] + list(step[2:])
+    return [numpy.asarray(output) for output in outputs]
+
+
+def record():
+    reference = {}
+    for config in CONFIGS:
+        reference[config_name(*config)] = [output.tolist() for output in run_model(*config)]
+    with open(REFERENCE, 'w') as f:
+        json.dump(reference, f)
+
+
+class TestMultisourceLayers(unittest.TestCase):
+    """
+    Regression tests for multi-source decoding with 2 and 3 inputs
+    """
+
+    def setUp(self):
+        with open(REFERENCE) as f:
+            self.reference = json.load(f)
+
+    def outputsEqual(self, num_inputs, multisource_type, layer_normalisation=False):
+        expected = self.reference[config_name(num_inputs, multisource_type, layer_normalisation)]
+        outputs = run_model(num_inputs, multisource_type, layer_normalisation)
+        self.assertEqual(len(outputs), len(expected))
+        for output, expected_output in zip(outputs, expected):
+            numpy.testing.assert_allclose(output, numpy.array(expected_output, dtype=output.dtype),
+                                          rtol=1e-4, atol=1e-6)
+
+    def test_concat(self):
+        self.outputsEqual(2, 'att-concat')
+
+    def test_gate(self):
+        self.outputsEqual(2, 'att-gate')
+
+    def test_hier(self):
+        self.outputsEqual(2, 'att-hier')
+
+    def test_concat_layernorm(self):
+        self.outputsEqual(2, 'att-concat', True)
+
+    def test_hier_three_inputs(self):
+        self.outputsEqual(3, 'att-hier')
+
+    def test_hier_three_inputs_layernorm(self):
+        self.outputsEqual(3, 'att-hier', True)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--record']:
+        record()
+    else:
+        unittest.main()
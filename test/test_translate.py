@@ -81,6 +81,24 @@ class TestTranslate(unittest.TestCase):
         os.chdir('../..')
         self.outputEqual('en-de/ref','en-de/out')
 
+    # English-German WMT16 system, several sentences per batch (limited by token count): same output as one
+    def test_ende_batch(self):
+        os.chdir('models/en-de/')
+
+        decoder_settings, translation_settings = self.get_settings()
+        translation_settings.batch_size = 4
+        translation_settings.max_tokens = 100
+
+        translate(
+                  input_file=open('../../en-de/in'),
+                  output_file=open('../../en-de/out_batch','w'),
+                  decoder_settings=decoder_settings,
+                  translation_settings=translation_settings
+                  )
+
+        os.chdir('../..')
+        self.outputEqual('en-de/ref','en-de/out_batch')
+
     # English-Romanian WMT16 system, dropout
     def test_enro(self):
         os.chdir('models/en-ro/')